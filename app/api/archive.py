@@ -0,0 +1,233 @@
+""" Streaming ZIP archives of the user files
+
+The archive is written while it's sent: each entry is opened when its turn comes, read in
+chunks, its CRC computed and deflated on the fly, and its sizes written after the content in
+a data descriptor, so the archive is never built in memory or in a temp file and a single file
+is open at a time. Only the central directory (a few bytes per entry) is kept until the end.
+Files that are already compressed (images, video, audio, archives...) are stored as they are.
+
+ZIP64 records are added when an entry or the archive goes over 4 GiB.
+"""
+import os
+import struct
+import time
+import zlib
+from typing import Callable, List, NamedTuple, Optional, Tuple
+
+from starlette.concurrency import run_in_threadpool, run_until_first_complete
+from starlette.responses import Response
+from starlette.types import Receive, Scope, Send
+
+from api.config import settings
+from api.responses import FileSource, close_file, content_disposition, open_file
+from api.storage.file_cache import CachedFile
+
+ZIP64_LIMIT = 0xFFFFFFFF
+# Deflate can make an incompressible entry slightly larger than the file, keep a margin
+ZIP64_ENTRY_SIZE = ZIP64_LIMIT - 64 * 1024 ** 2
+
+FLAGS = 0x0808  # Sizes and CRC in a data descriptor, UTF-8 names
+STORED, DEFLATED = 0, 8
+
+# Media types of contents that deflate can't make smaller
+COMPRESSED_MEDIA_TYPES = {
+    "application/gzip", "application/x-gzip", "application/zip", "application/x-7z-compressed",
+    "application/x-rar-compressed", "application/x-bzip2", "application/x-xz", "application/zstd",
+    "application/pdf", "application/epub+zip",
+}
+UNCOMPRESSED_MEDIA_TYPES = {"image/svg+xml", "image/bmp", "image/x-ms-bmp", "image/tiff", "audio/wav", "audio/x-wav"}
+
+
+def is_compressed(media_type: str) -> bool:
+    """ Whether a content of this media type is already compressed """
+    media_type = media_type.split(";")[0].strip().lower()
+    if media_type.split("/")[0] in ("image", "video", "audio"):
+        return media_type not in UNCOMPRESSED_MEDIA_TYPES
+    return media_type in COMPRESSED_MEDIA_TYPES
+
+
+def dos_datetime(mtime: float) -> Tuple[int, int]:
+    """ Returns the MS-DOS time and date of a timestamp, as stored in ZIP headers """
+    local = time.localtime(mtime)
+    if local.tm_year < 1980:
+        return 0, (1 << 5) | 1  # 1980-01-01, the earliest DOS date
+    return (
+        (local.tm_hour << 11) | (local.tm_min << 5) | (local.tm_sec // 2),
+        ((local.tm_year - 1980) << 9) | (local.tm_mon << 5) | local.tm_mday,
+    )
+
+
+class ArchiveEntry(NamedTuple):
+    name: str
+    path: str
+    checksum: Optional[str]
+    size: int
+    compress: bool
+
+
+class _CentralRecord(NamedTuple):
+    name: bytes
+    method: int
+    dos_time: int
+    dos_date: int
+    crc: int
+    compressed_size: int
+    size: int
+    offset: int
+
+
+def _read_chunk(source: FileSource, offset: int, size: int, crc: int, compressor) -> Tuple[int, int, bytes]:
+    # Runs in the threadpool, zlib releases the GIL while computing the CRC and deflating
+    if isinstance(source, CachedFile):
+        data = source.content[offset:offset + size]
+    else:
+        data = os.pread(source.fd, size, offset)
+    crc = zlib.crc32(data, crc)
+    return len(data), crc, compressor.compress(data) if compressor is not None else data
+
+
+class ZipArchiveResponse(Response):
+    """Sends a ZIP archive of the entries, built while it's sent.
+
+    `on_sent` is called once with the amount of bytes sent to the client,
+    even if the client disconnects in the middle of the download.
+    `release_entry` is called once per entry, after the entry is written or when the
+    response ends without writing it, e.g. to release the blob of the entry.
+    """
+
+    chunk_size = 256 * 1024
+
+    def __init__(
+        self,
+        entries: List[ArchiveEntry],
+        filename: str,
+        on_sent: Callable[[int], None] = None,
+        release_entry: Callable[[ArchiveEntry], None] = None,
+    ):
+        self.entries = entries
+        self.on_sent = on_sent
+        self.release_entry = release_entry
+        self.sent = 0
+        self.status_code = 200
+        self.media_type = "application/zip"
+        self.background = None
+        self.init_headers({"content-disposition": content_disposition(filename)})
+        self._pending = bytearray()
+        self._released = 0  # Entries before this one are already released
+
+    async def listen_for_disconnect(self, receive: Receive):
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                break
+
+    async def write(self, send: Send, data: bytes, flush: bool = False):
+        # Headers and small entries are grouped in messages of about chunk_size bytes
+        self._pending += data
+        if self._pending and (flush or len(self._pending) >= self.chunk_size):
+            body = bytes(self._pending)
+            self._pending.clear()
+            await send({"type": "http.response.body", "body": body, "more_body": True})
+            self.sent += len(body)
+
+    async def write_entry(self, send: Send, entry: ArchiveEntry, offset: int) -> _CentralRecord:
+        # Small files are read from the file cache if they are in it, an archive doesn't fill the cache
+        source = await run_in_threadpool(open_file, entry.path, entry.checksum, entry.size, False)
+        try:
+            return await self.write_source(send, entry, source, offset)
+        finally:
+            close_file(source)
+
+    async def write_source(self, send: Send, entry: ArchiveEntry, source: FileSource, offset: int) -> _CentralRecord:
+        if isinstance(source, CachedFile):
+            size, mtime = len(source.content), source.mtime
+        else:
+            size, mtime = source.stat.st_size, source.stat.st_mtime
+        name = entry.name.encode()
+        method = DEFLATED if entry.compress else STORED
+        dos_time, dos_date = dos_datetime(mtime)
+
+        # The sizes are not known before the content is written, a large entry announces them in ZIP64
+        zip64 = size >= ZIP64_ENTRY_SIZE
+        extra = struct.pack("<HHQQ", 1, 16, 0, 0) if zip64 else b""
+        await self.write(send, struct.pack(
+            "<IHHHHHIIIHH", 0x04034b50, 45 if zip64 else 20, FLAGS, method, dos_time, dos_date,
+            0, ZIP64_LIMIT if zip64 else 0, ZIP64_LIMIT if zip64 else 0, len(name), len(extra)) + name + extra)
+
+        compressor = zlib.compressobj(settings.ARCHIVE_COMPRESS_LEVEL, zlib.DEFLATED, -15) if entry.compress else None
+        crc, read, compressed_size = 0, 0, 0
+        while read < size:
+            count, crc, data = await run_in_threadpool(
+                _read_chunk, source, read, min(self.chunk_size, size - read), crc, compressor)
+            if not count:  # The file was truncated
+                break
+            read += count
+            compressed_size += len(data)
+            await self.write(send, data)
+        if compressor is not None:
+            data = compressor.flush()
+            compressed_size += len(data)
+            await self.write(send, data)
+
+        if zip64:
+            descriptor = struct.pack("<IIQQ", 0x08074b50, crc, compressed_size, read)
+        else:
+            descriptor = struct.pack("<IIII", 0x08074b50, crc, compressed_size, read)
+        await self.write(send, descriptor)
+        return _CentralRecord(name, method, dos_time, dos_date, crc, compressed_size, read, offset)
+
+    async def write_central_directory(self, send: Send, records: List[_CentralRecord], offset: int):
+        start = offset
+        for record in records:
+            # Values that don't fit in 32 bits go to the ZIP64 extra field, in this order
+            zip64_values = [value for value in (record.size, record.compressed_size, record.offset)
+                            if value >= ZIP64_LIMIT]
+            extra = struct.pack(f"<HH{len(zip64_values)}Q", 1, 8 * len(zip64_values), *zip64_values) \
+                if zip64_values else b""
+            version = 45 if zip64_values else 20
+            header = struct.pack(
+                "<IHHHHHHIIIHHHHHII", 0x02014b50, 0x0300 | version, version, FLAGS, record.method,
+                record.dos_time, record.dos_date, record.crc,
+                min(record.compressed_size, ZIP64_LIMIT), min(record.size, ZIP64_LIMIT),
+                len(record.name), len(extra), 0, 0, 0, 0o100644 << 16, min(record.offset, ZIP64_LIMIT))
+            await self.write(send, header + record.name + extra)
+            offset += len(header) + len(record.name) + len(extra)
+
+        size = offset - start
+        if len(records) >= 0xFFFF or size >= ZIP64_LIMIT or start >= ZIP64_LIMIT:
+            await self.write(send, struct.pack(
+                "<IQHHIIQQQQ", 0x06064b50, 44, 45, 45, 0, 0, len(records), len(records), size, start))
+            await self.write(send, struct.pack("<IIQI", 0x07064b50, 0, offset, 1))
+        entries = min(len(records), 0xFFFF)
+        await self.write(send, struct.pack(
+            "<IHHHHIIH", 0x06054b50, 0, 0, entries, entries, min(size, ZIP64_LIMIT), min(start, ZIP64_LIMIT), 0),
+            flush=True)
+
+    async def send_archive(self, send: Send):
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        records = []
+        offset = 0
+        for index, entry in enumerate(self.entries):
+            record = await self.write_entry(send, entry, offset)
+            records.append(record)
+            # Each entry is released as soon as it's written
+            self._released = index + 1
+            if self.release_entry:
+                await run_in_threadpool(self.release_entry, entry)
+            offset = self.sent + len(self._pending)
+        await self.write_central_directory(send, records, offset)
+        await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        try:
+            await run_until_first_complete(
+                (self.send_archive, {"send": send}),
+                (self.listen_for_disconnect, {"receive": receive}),
+            )
+        finally:
+            if self.release_entry:
+                for entry in self.entries[self._released:]:
+                    self.release_entry(entry)
+            self._released = len(self.entries)
+            if self.on_sent and self.sent:
+                self.on_sent(self.sent)
@@ -1,16 +1,29 @@
+import os
+import re
 from typing import Any, Union, Optional
 from fastapi import APIRouter, Body, Form, Depends, HTTPException
 from api.schemas.token import Token, TokenInDB
+from api.schemas.user import User
 from pydantic import BaseModel
-from api.auth.deps import generate_access_token
+from api.auth.deps import generate_access_token, run_store
+from api.auth.passwords import DUMMY_HASH, HasherBusy, hash_password, password_hasher, verify_password
+from api.fast_json import trusted
 from api.database import db
 from api.config import settings
+from api.storage.journal import journal
 import uuid
 
 router = APIRouter()
 
+# User ids name the directory of the user files
+USER_ID_PATTERN = re.compile(r"[A-Za-z0-9_-]{1,64}")
+
+def hasher_busy() -> HTTPException:
+    return HTTPException(
+        status_code=503, detail="Too many logins, try again later", headers={"Retry-After": "1"})
+
 @router.post("/auth", response_model=Token)
-def auth(
+async def auth(
     user_id: str = Form(...),
     password: str = Form(...)
 ):
@@ -21,9 +34,50 @@ def auth(
     https://tools.ietf.org/html/rfc6749#section-4.3.2
     """
 
-    # Validate user credentials
-    # This demo requires a hardcoded user
-    if not user_id == settings.DEMO_USER_ID or not password == settings.DEMO_USER_PASSWORD:
+    # Validate user credentials, unknown users are checked against a dummy hash to take the same time
+    password_hash = await run_store(db["users"].registry.get, user_id)
+    try:
+        valid = await password_hasher.run(verify_password, password, password_hash or DUMMY_HASH)
+    except HasherBusy:
+        raise hasher_busy()
+    if password_hash is None or not valid:
         raise HTTPException(
             status_code=400, detail="Incorrect user_id or password")
-    return Token(token = generate_access_token(user_id))
+    return trusted(Token(token = await run_store(generate_access_token, user_id)))
+
+@router.post("/users", response_model=User, status_code=201)
+async def register_user(
+    user_id: str = Form(...),
+    password: str = Form(...)
+):
+    """
+    Registers a new user, who can then get access tokens from /auth.
+    """
+    if not settings.USER_REGISTRATION:
+        raise HTTPException(status_code=403, detail="Registration is closed")
+
+    # The files of the user are stored in ./files/{user_id}, next to the blobs directory
+    if not USER_ID_PATTERN.fullmatch(user_id) or \
+            os.path.normpath(f"./files/{user_id}") == os.path.normpath(settings.BLOBS_PATH):
+        raise HTTPException(status_code=400, detail="Invalid user_id")
+    if len(password) < settings.USER_PASSWORD_MIN_LENGTH:
+        raise HTTPException(
+            status_code=400, detail=f"Password must have at least {settings.USER_PASSWORD_MIN_LENGTH} characters")
+    if await run_store(db["users"].registry.__contains__, user_id):
+        raise HTTPException(status_code=409, detail="user_id already taken")
+
+    try:
+        password_hash = await password_hasher.run(hash_password, password)
+    except HasherBusy:
+        raise hasher_busy()
+
+    # Checked again, another registration of the same id could have finished while hashing
+    if not await run_store(add_user, user_id, password_hash):
+        raise HTTPException(status_code=409, detail="user_id already taken")
+    return User(user_id=user_id)
+
+def add_user(user_id: str, password_hash: bytes) -> bool:
+    if not db["users"].registry.add(user_id, password_hash):
+        return False
+    journal.record("user_put", user_id, password_hash)
+    return True
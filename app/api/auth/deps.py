@@ -1,12 +1,16 @@
 
 from datetime import datetime, timedelta
-from typing import Any, Union
-from pydantic import BaseModel
-from fastapi import APIRouter, Body, Form, Depends, HTTPException
-from api.schemas.token import Token, TokenInDB
+from typing import Any, Callable, NamedTuple, Union
+from fastapi import APIRouter, Body, Form, Depends, HTTPException, Security
+from api.schemas.token import Token
 from api.schemas.user import User
 from api.database import db
 from api.config import settings
+from api.auth.signing import sign, unsign
+from api.core.expiry import expiry_index
+from api.storage.journal import journal
+from api.storage.records import TokenRecord
+import os
 import uuid
 
 from fastapi.openapi.models import HTTPBearer as HTTPBearerModel
@@ -14,18 +18,20 @@ from typing import List, Optional
 
 from fastapi.exceptions import HTTPException
 from fastapi.security.utils import get_authorization_scheme_param
+from starlette.concurrency import run_in_threadpool
 from starlette.requests import Request
 from starlette.status import HTTP_401_UNAUTHORIZED
 from fastapi.security.http import HTTPBase
 
-class HTTPAuthorizationCredentials(BaseModel):
-    scheme: str
-    credentials: str
+class Principal(NamedTuple):
+    """ Authenticated caller of a request """
+    user_id: str
+    token: TokenRecord
 
-def get_token(request: Request) -> Optional[str]:
-    authorization: str = request.headers.get("Authorization")
+def parse_bearer_token(authorization: Optional[str]) -> str:
+    """ Returns the token of a `Bearer` Authorization header, 401 instead of the default 403 as required in the doc spec """
     scheme, param = get_authorization_scheme_param(authorization)
-    if not authorization or scheme.lower() != "bearer":
+    if not authorization or not param or scheme.lower() != "bearer":
         raise HTTPException(
             status_code=HTTP_401_UNAUTHORIZED,
             detail="Not authenticated",
@@ -33,24 +39,72 @@ def get_token(request: Request) -> Optional[str]:
         )
     return param
 
-def get_datetime_now():
+async def get_datetime_now():
     """ This function allows to mock the current time at testing """
     return datetime.now()
 
-def get_user_access_token(token: str = Depends(get_token), datetime_now = Depends(get_datetime_now)) -> Optional[TokenInDB]:
-    """Returns the token information from db of a token.
+async def run_store(function: Callable[..., Any], *args: Any) -> Any:
+    """ Runs a function that reads or changes the db stores, from an async route or dependency """
+    # The in memory stores answer in microseconds, sqlite transactions and journal fsyncs would block the loop
+    if settings.STATE_BACKEND == "memory" and not journal.enabled:
+        return function(*args)
+    return await run_in_threadpool(function, *args)
 
-    As this demo doesn't follow OAuth2, and the token doesn't have any data inside
-    we asume that the owner of the token is the demo user.
+def get_signed_access_token(token: str, datetime_now: datetime) -> TokenRecord:
+    """Validates a signed access token and consumes one of its calls.
 
-    Ideally here we would decode the signed jwt to extract information about the token owner.
+    Signature and expiration are checked from the token itself, the only state
+    kept in db is the number of remaining calls of the token.
     Args:
-        token (str, optional) 
+        token (str)
         datetime_now
     """
+    payload = unsign(token)
+    if payload is None:
+        raise HTTPException(
+            status_code=HTTP_401_UNAUTHORIZED,
+            detail="invalid token"
+        )
+    user_id, expires_at, calls, nonce = payload.rsplit(":", 3)
+    expires_at = datetime.fromtimestamp(int(expires_at))
+
+    # Validate the expiration date
+    if datetime_now >= expires_at:
+        raise HTTPException(
+            status_code=HTTP_401_UNAUTHORIZED,
+            detail="token expired"
+        )
 
-    # Check that the token exists
-    token_data = db["users"][settings.DEMO_USER_ID]["access_tokens"].get(token)
+    # Validate that the token that the user is using has available_calls quota, the counter
+    # is decremented atomically as several requests can use the token at the same time
+    available_calls, created = db["token_calls"].consume(nonce, int(calls), expires_at)
+    if created:
+        # First use of the token, its counter lives until the token expires
+        expiry_index.schedule("token_calls", nonce, expires_at)
+    if available_calls is None:
+        raise HTTPException(
+            status_code=401,
+            detail="token expired"
+        )
+
+    # The record is only informative for the routes, it's not stored
+    return TokenRecord(nonce, expires_at, available_calls, user_id)
+
+def get_user_access_token(token: str, datetime_now: datetime) -> TokenRecord:
+    """Returns the token information from db of a token.
+
+    Signed tokens (settings.ACCESS_TOKEN_FORMAT == "signed") carry their owner, expiration
+    and calls quota inside, the opaque ones are random ids stored with their owner.
+    Args:
+        token (str)
+        datetime_now
+    """
+    # Opaque tokens are uuid4, they never contain the signature separator
+    if "." in token:
+        return get_signed_access_token(token, datetime_now)
+
+    # Check that the token exists, the tokens of all the users are in a single index
+    token_data = db["access_tokens"].get(token)
     if not token_data:
         raise HTTPException(
             status_code=HTTP_401_UNAUTHORIZED,
@@ -64,30 +118,30 @@ def get_user_access_token(token: str = Depends(get_token), datetime_now = Depend
             detail="token expired"
         )
 
-    # Validate that the token that the user is using has available_calls quota
-    if token_data.available_calls <= 0:
+    # Validate that the token that the user is using has available_calls quota and
+    # update number of available calls for the token, in a single atomic step
+    available_calls = db["access_tokens"].consume_call(token_data.id)
+    if available_calls is None:
         raise HTTPException(
             status_code=401,
             detail="token expired"
         )
+    # Concurrent requests of the token can journal their counts in any order, the replay keeps the lowest
+    journal.record("token_calls", token_data.user_id, token_data.id, available_calls)
 
-    # Update number of available calls for the token
-    token_data.available_calls = token_data.available_calls - 1
-    db["users"][settings.DEMO_USER_ID]["access_tokens"][token_data.id] = token_data
-
-    return token_data
+    # The stored record is shared by the requests of the token, the route gets its own copy
+    return TokenRecord(token_data.id, token_data.expires_at, available_calls, token_data.user_id)
 
-def get_current_user(token: str = Depends(get_token), token_data: TokenInDB = Depends(get_user_access_token)) -> str:
-    """Returns the user_id from a token
+def authenticate(token: str, datetime_now: datetime) -> Principal:
+    """Resolves a token into the principal of the request, consuming one of its calls.
 
-    As this demo doesn't follow OAuth2, and the token doesn't have any data inside
-    we asume that the owner of the token is the demo user.
-
-    Ideally here we would decode the signed jwt to extract information about the token owner.
+    Tokens without owner, from older journals, belong to the demo user.
     Args:
-        token (str, optional): 
+        token (str): Token of the Authorization header.
+        datetime_now
     """
-    return settings.DEMO_USER_ID
+    token_data = get_user_access_token(token, datetime_now)
+    return Principal(token_data.user_id or settings.DEMO_USER_ID, token_data)
 
 def generate_access_token(user_id: str) -> str:
     """Creates a new access token for the given user.
@@ -96,51 +150,58 @@ def generate_access_token(user_id: str) -> str:
         user_id (str): The user id to which the access token will be generated.
 
     Returns:
-        token (str): Random access token (uuid4) created for the user, doesn't follow OAuth2 spec.
+        token (str): Random access token (uuid4) created for the user, or a signed token
+            if settings.ACCESS_TOKEN_FORMAT is "signed". Doesn't follow OAuth2 spec.
     """
-    # Generate a new access token and save it in the database
-    token_id = str(uuid.uuid4())
     expires_at = datetime.now() + timedelta(
         minutes=settings.ACCESS_TOKEN_EXPIRE_MINUTES
     )
-    db["users"][user_id]["access_tokens"][token_id] = TokenInDB(
+
+    # Signed tokens are not stored, their calls counter is created on the first use
+    if settings.ACCESS_TOKEN_FORMAT == "signed":
+        nonce = os.urandom(8).hex()
+        return sign(f"{user_id}:{int(expires_at.timestamp())}:{settings.ACCESS_TOKEN_EXPIRE_QUOTA}:{nonce}")
+
+    # Generate a new access token and save it in the database
+    token_id = str(uuid.uuid4())
+    token_data = TokenRecord(
         id=token_id,
         expires_at=expires_at,
-        available_calls=settings.ACCESS_TOKEN_EXPIRE_QUOTA
+        available_calls=settings.ACCESS_TOKEN_EXPIRE_QUOTA,
+        user_id=user_id
     )
+    db["access_tokens"].add(token_data)
+    journal.record("token_put", user_id, token_data)
+    expiry_index.schedule("access_token", token_id, expires_at)
 
     return token_id
 
-# Required class to override the default 403 error into 401 as required in the doc spec
-class CustomHTTPBearer(HTTPBase):
-    def __init__(
-        self,
-        *,
-        bearerFormat: Optional[str] = None,
-        scheme_name: Optional[str] = None,
-        auto_error: bool = True,
-    ):
+def remove_access_token(token_id: str) -> bool:
+    return db["access_tokens"].remove(token_id)
+
+def remove_token_calls(nonce: str) -> bool:
+    return db["token_calls"].remove(nonce)
+
+expiry_index.register("access_token", remove_access_token)
+expiry_index.register("token_calls", remove_token_calls)
+
+class BearerAuth(HTTPBase):
+    """Authentication of the routes, declared as a bearer scheme in the OpenAPI docs.
+
+    The Authorization header is parsed and the token resolved once per request, FastAPI
+    caches the returned Principal for every dependency of the request that uses `bearer_auth`.
+    """
+
+    def __init__(self, *, bearerFormat: Optional[str] = None, scheme_name: Optional[str] = None):
         self.model = HTTPBearerModel(bearerFormat=bearerFormat)
         self.scheme_name = scheme_name or self.__class__.__name__
-        self.auto_error = auto_error
-
-    async def __call__(
-        self, request: Request
-    ) -> Optional[HTTPAuthorizationCredentials]:
-        authorization: str = request.headers.get("Authorization")
-        scheme, credentials = get_authorization_scheme_param(authorization)
-        if not (authorization and scheme and credentials):
-            raise HTTPException(
-                status_code=HTTP_401_UNAUTHORIZED,
-                detail="Not authenticated",
-                headers={"WWW-Authenticate": "Bearer"},
-            )
-
-        if scheme.lower() != "bearer":
-            raise HTTPException(
-                status_code=HTTP_401_UNAUTHORIZED,
-                detail="Not authenticated",
-                headers={"WWW-Authenticate": "Bearer"},
-            )
-
-        return HTTPAuthorizationCredentials(scheme=scheme, credentials=credentials)
\ No newline at end of file
+
+    async def __call__(self, request: Request, datetime_now: datetime = Depends(get_datetime_now)) -> Principal:
+        token = parse_bearer_token(request.headers.get("Authorization"))
+        return await run_store(authenticate, token, datetime_now)
+
+bearer_auth = BearerAuth()
+
+async def get_current_user(principal: Principal = Security(bearer_auth)) -> str:
+    """ Returns the user_id of the authenticated caller """
+    return principal.user_id
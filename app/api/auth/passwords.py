@@ -0,0 +1,72 @@
+""" Password hashes of the registered users
+
+Passwords are hashed with PBKDF2-HMAC-SHA256 and a random salt. Each hash keeps its own
+iterations, so PASSWORD_HASH_ITERATIONS can be raised without invalidating the stored hashes.
+
+Hashing is slow on purpose, it runs in a small executor of its own (hashlib releases the GIL
+while hashing): it never blocks the event loop nor takes the threadpool of the routes, and the
+logins beyond PASSWORD_HASH_MAX_PENDING are rejected instead of queued without bound.
+"""
+import asyncio
+import hashlib
+import hmac
+import os
+import struct
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable
+
+from api.config import settings
+
+SALT_SIZE = 16
+HEADER = struct.Struct("<I")  # Iterations, followed by the salt and the sha256 digest
+
+
+def hash_password(password: str, iterations: int = None) -> bytes:
+    """ Returns the hash of a new password, to store it """
+    iterations = settings.PASSWORD_HASH_ITERATIONS if iterations is None else iterations
+    salt = os.urandom(SALT_SIZE)
+    return HEADER.pack(iterations) + salt + hashlib.pbkdf2_hmac("sha256", password.encode(), salt, iterations)
+
+
+def verify_password(password: str, password_hash: bytes) -> bool:
+    """ Whether the password is the one of a hash returned by `hash_password` """
+    iterations, = HEADER.unpack_from(password_hash)
+    salt = password_hash[HEADER.size:HEADER.size + SALT_SIZE]
+    digest = hashlib.pbkdf2_hmac("sha256", password.encode(), salt, iterations)
+    return hmac.compare_digest(digest, password_hash[HEADER.size + SALT_SIZE:])
+
+
+class HasherBusy(Exception):
+    """ Too many passwords waiting to be hashed """
+
+
+class PasswordHasher:
+    def __init__(self, workers: int, max_pending: int):
+        """
+        Args:
+            workers (int): Threads hashing passwords.
+            max_pending (int): Hashes running or waiting for a thread, more raise HasherBusy.
+        """
+        self.max_pending = max_pending
+        self.pending = 0
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="password-hasher")
+        self._lock = threading.Lock()
+
+    async def run(self, function: Callable[..., Any], *args: Any) -> Any:
+        """ Runs `hash_password` or `verify_password` in the executor """
+        with self._lock:
+            if self.pending >= self.max_pending:
+                raise HasherBusy()
+            self.pending += 1
+        try:
+            return await asyncio.get_event_loop().run_in_executor(self._executor, function, *args)
+        finally:
+            with self._lock:
+                self.pending -= 1
+
+
+password_hasher = PasswordHasher(settings.PASSWORD_HASH_WORKERS, settings.PASSWORD_HASH_MAX_PENDING)
+
+# Checked for unknown users, so a login takes the same time whether the user exists or not
+DUMMY_HASH = hash_password(os.urandom(16).hex(), iterations=settings.PASSWORD_HASH_ITERATIONS)
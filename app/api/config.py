@@ -1,4 +1,6 @@
 """ Settings singleton that gets autocompleted from env vars """
+import secrets
+from typing import Optional
 from pydantic import BaseSettings
 
 class Settings(BaseSettings):
@@ -7,15 +9,98 @@ class Settings(BaseSettings):
 
     ACCESS_TOKEN_EXPIRE_MINUTES: int = 1
     ACCESS_TOKEN_EXPIRE_QUOTA: int = 5
+    ACCESS_TOKEN_FORMAT: str = "opaque" # "opaque" (random id stored in db) or "signed" (stateless HMAC)
+
+    # Key used to sign stateless tokens, set it from env vars to keep tokens valid across restarts
+    SECRET_KEY: str = secrets.token_urlsafe(32)
 
     USER_MAX_FILES: int = 99
+    # File removed when a user reaches USER_MAX_FILES: "fifo" (oldest upload), "lru" (least recently
+    # downloaded), "lfu" (least downloaded) or "size" (least recently downloaded of the largest files)
+    EVICTION_POLICY: str = "fifo"
+    UPLOAD_MAX_SIZE: int = 100 * 1024 ** 2 # 100 Megabytes in bytes
+    # Responses serialized with orjson and not validated again by FastAPI, needs the "fast" extra
+    FAST_RESPONSES: bool = False
+
+    # Files of a page of GET /me, by default and at most
+    FILES_PAGE_LIMIT: int = 100
+    FILES_PAGE_MAX_LIMIT: int = 1000
+    # Files of a POST /me/batch request, each one up to UPLOAD_MAX_SIZE
+    UPLOAD_BATCH_MAX_FILES: int = 99
+
+    # Uploads of a user are serialized by a lock, users are spread over this many locks
+    USER_LOCK_STRIPES: int = 64
+
+    # File contents are stored once by checksum, shared by all the files with the same content
+    BLOBS_PATH: str = "./files/blobs"
+
+    # Files up to FILE_CACHE_MAX_FILE_SIZE are served from memory, the cache holds up to FILE_CACHE_MAX_BYTES
+    FILE_CACHE_MAX_BYTES: int = 64 * 1024 ** 2 # 64 Megabytes in bytes, 0 disables the cache
+    FILE_CACHE_MAX_FILE_SIZE: int = 256 * 1024
+
+    # Open descriptors of the most downloaded larger files, shared by their downloads
+    FD_CACHE_MAX_ENTRIES: int = 256
+
+    # Deflate level of the files compressed in the ZIP archives, already compressed media types are stored
+    ARCHIVE_COMPRESS_LEVEL: int = 6
+
+    # Downloads can be sent by the reverse proxy: "x-accel-redirect" (nginx) or "x-sendfile" (apache, lighttpd).
+    # The api only checks auth, quota and share links, nginx serves DOWNLOAD_OFFLOAD_LOCATION from BLOBS_PATH
+    DOWNLOAD_OFFLOAD: Optional[str] = None
+    DOWNLOAD_OFFLOAD_LOCATION: str = "/internal/blobs/"
+    # An offloaded download keeps its blob this long after the response, until the proxy has opened it
+    DOWNLOAD_OFFLOAD_GRACE_SECONDS: int = 60
+
+    # Where the db lives: "memory" (process local, one worker) or "sqlite" (shared by all the workers)
+    STATE_BACKEND: str = "memory"
+    SQLITE_PATH: str = "./files/state.db"
+
+    # Evicted and overwritten contents are removed from disk by a background task, in batches
+    DELETION_INTERVAL_MS: int = 200
+    DELETION_BATCH: int = 256
+    DELETION_MAX_ATTEMPTS: int = 5
+    # Files found at startup in the user directories and not referenced by the db are removed,
+    # if they are older than this (a temp file can belong to an upload of another worker)
+    ORPHAN_MIN_AGE_SECONDS: int = 60 * 60
+
+    # Folder of the db journal (e.g. "./files/journal"), the db is only kept in memory if it's not set.
+    # Only used by the "memory" backend, sqlite already persists the db
+    JOURNAL_PATH: Optional[str] = None
+    # Records are fsynced every N records or every N milliseconds, 1 fsyncs every mutation
+    JOURNAL_FSYNC_EVERY: int = 64
+    JOURNAL_FSYNC_INTERVAL_MS: int = 100
+    JOURNAL_SNAPSHOT_EVERY: int = 100_000
+
+    SHARE_LINK_EXPIRE_MINUTES: int = 60 * 24
+    SHARE_LINK_FORMAT: str = "stored" # "stored" (random id stored in db) or "signed" (stateless HMAC)
+    # Bytes of each of the two generations of the Bloom filter of used signed share links
+    SHARE_LINK_NONCE_FILTER_SIZE: int = 1024 ** 2
+
+    # Expired tokens and share links are removed from db in batches by a background task
+    EXPIRY_SWEEP_INTERVAL_SECONDS: int = 10
+    EXPIRY_SWEEP_BATCH: int = 1000
+
+    # Bearer token of the monitoring to read the internal counters from /stats, disabled if it's not set
+    STATS_TOKEN: Optional[str] = None
     
+    # Registered at startup if it doesn't exist, more users are registered with POST /users
     DEMO_USER_ID: str = "username"
     DEMO_USER_PASSWORD: str = "password"
-    
+    USER_REGISTRATION: bool = True
+    USER_PASSWORD_MIN_LENGTH: int = 8
+    # PBKDF2-HMAC-SHA256 iterations of the new password hashes, computed by PASSWORD_HASH_WORKERS threads
+    PASSWORD_HASH_ITERATIONS: int = 600_000
+    PASSWORD_HASH_WORKERS: int = 2
+    # Logins and registrations waiting for a hashing thread, the next ones are answered with 503
+    PASSWORD_HASH_MAX_PENDING: int = 64
+    # The files and quotas of a user are loaded on the first request, and released from memory
+    # after USER_IDLE_SECONDS without requests if there's nothing to keep (always with sqlite)
+    USER_IDLE_SECONDS: int = 600
+
     
     DOWNLOAD_QUOTA_TRAFFIC: int = 1024 ** 2 # 1 Megabyte in bytes
     DOWNLOAD_QUOTA_MINUTES: int = 5
+    DOWNLOAD_QUOTA_MODE: str = "sliding_window" # "sliding_window" or "token_bucket"
 
     class Config:
         case_sensitive = True
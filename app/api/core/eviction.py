@@ -0,0 +1,186 @@
+""" Eviction policies, they choose the file removed when a user reaches USER_MAX_FILES
+
+Every policy keeps the ids of the files of a user and is told when a file is added,
+updated (overwritten), downloaded or removed. `pop` removes and returns the id of the
+file to evict. All the operations are O(1), so the eviction cost doesn't grow with the files.
+"""
+from collections import OrderedDict
+from typing import Dict, Optional
+
+from api.config import settings
+
+
+class FifoPolicy:
+    """ Evicts the first uploaded file, downloads are ignored """
+
+    def __init__(self):
+        self._order: "OrderedDict[str, None]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._order)
+
+    def add(self, file_id: str, size: int):
+        self._order[file_id] = None
+
+    def update(self, file_id: str, size: int):
+        pass
+
+    def access(self, file_id: str):
+        pass
+
+    def remove(self, file_id: str):
+        self._order.pop(file_id, None)
+
+    def pop(self) -> Optional[str]:
+        if not self._order:
+            return None
+        return self._order.popitem(last=False)[0]
+
+
+class LruPolicy(FifoPolicy):
+    """ Evicts the file downloaded (or uploaded) the longest time ago """
+
+    def update(self, file_id: str, size: int):
+        self.access(file_id)
+
+    def access(self, file_id: str):
+        if file_id in self._order:
+            self._order.move_to_end(file_id)
+
+
+class LfuPolicy:
+    """Evicts the least downloaded file, the least recently used one among them.
+
+    Files are kept in buckets by download count, and the counts with files are linked
+    in increasing order, so the least used bucket is always the head of the list.
+    """
+
+    def __init__(self):
+        self._counts: Dict[str, int] = {}
+        self._buckets: Dict[int, "OrderedDict[str, None]"] = {}
+        self._next: Dict[int, Optional[int]] = {}
+        self._prev: Dict[int, Optional[int]] = {}
+        self._head: Optional[int] = None
+
+    def __len__(self) -> int:
+        return len(self._counts)
+
+    def _link(self, count: int, after: Optional[int]):
+        """ Creates the bucket of `count`, right after the bucket `after` (or as head) """
+        following = self._head if after is None else self._next[after]
+        self._buckets[count] = OrderedDict()
+        self._prev[count] = after
+        self._next[count] = following
+        if following is not None:
+            self._prev[following] = count
+        if after is None:
+            self._head = count
+        else:
+            self._next[after] = count
+
+    def _discard(self, file_id: str, count: int):
+        bucket = self._buckets[count]
+        del bucket[file_id]
+        if bucket:
+            return
+        # Unlink the empty bucket
+        previous, following = self._prev.pop(count), self._next.pop(count)
+        del self._buckets[count]
+        if previous is None:
+            self._head = following
+        else:
+            self._next[previous] = following
+        if following is not None:
+            self._prev[following] = previous
+
+    def add(self, file_id: str, size: int):
+        if self._head != 0:
+            self._link(0, None)
+        self._counts[file_id] = 0
+        self._buckets[0][file_id] = None
+
+    def update(self, file_id: str, size: int):
+        pass
+
+    def access(self, file_id: str):
+        count = self._counts.get(file_id)
+        if count is None:
+            return
+        if count + 1 not in self._buckets:
+            self._link(count + 1, count)
+        self._buckets[count + 1][file_id] = None
+        self._counts[file_id] = count + 1
+        self._discard(file_id, count)
+
+    def remove(self, file_id: str):
+        count = self._counts.pop(file_id, None)
+        if count is not None:
+            self._discard(file_id, count)
+
+    def pop(self) -> Optional[str]:
+        if self._head is None:
+            return None
+        file_id = next(iter(self._buckets[self._head]))
+        self.remove(file_id)
+        return file_id
+
+
+class SizeAwarePolicy:
+    """Evicts the least recently used file of the largest size class.
+
+    Sizes are grouped in powers of two, so there are less than 64 classes and
+    finding the largest one doesn't depend on the amount of files.
+    """
+
+    def __init__(self):
+        self._classes: Dict[str, int] = {}
+        self._buckets: Dict[int, "OrderedDict[str, None]"] = {}
+
+    def __len__(self) -> int:
+        return len(self._classes)
+
+    def add(self, file_id: str, size: int):
+        size_class = size.bit_length()
+        self._classes[file_id] = size_class
+        self._buckets.setdefault(size_class, OrderedDict())[file_id] = None
+
+    def update(self, file_id: str, size: int):
+        self.remove(file_id)
+        self.add(file_id, size)
+
+    def access(self, file_id: str):
+        size_class = self._classes.get(file_id)
+        if size_class is not None:
+            self._buckets[size_class].move_to_end(file_id)
+
+    def remove(self, file_id: str):
+        size_class = self._classes.pop(file_id, None)
+        if size_class is None:
+            return
+        bucket = self._buckets[size_class]
+        del bucket[file_id]
+        if not bucket:
+            del self._buckets[size_class]
+
+    def pop(self) -> Optional[str]:
+        if not self._buckets:
+            return None
+        file_id = next(iter(self._buckets[max(self._buckets)]))
+        self.remove(file_id)
+        return file_id
+
+
+EVICTION_POLICIES = {
+    "fifo": FifoPolicy,
+    "lru": LruPolicy,
+    "lfu": LfuPolicy,
+    "size": SizeAwarePolicy,
+}
+
+
+def create_eviction_policy():
+    """ Returns the eviction policy of a user, following the current settings """
+    try:
+        return EVICTION_POLICIES[settings.EVICTION_POLICY]()
+    except KeyError:
+        raise ValueError(f"Unknown EVICTION_POLICY: {settings.EVICTION_POLICY}")
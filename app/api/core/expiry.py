@@ -0,0 +1,97 @@
+""" Expiry index for records with a deadline (access tokens, share links...)
+
+Records are indexed by deadline in a min-heap and removed in bounded batches
+by a background task started with the app, so expired records don't stay in db forever.
+Each kind of record registers a handler that removes a record by key.
+A key can be scheduled again before its entry is swept (e.g. a partition still in use), the stats
+count the entries of the heap apart from the live keys, the distinct keys with a pending entry.
+"""
+import asyncio
+import heapq
+import itertools
+import logging
+import threading
+from collections import Counter
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Tuple
+
+from api.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+class ExpiryIndex:
+    def __init__(self):
+        self._heap: List[Tuple[datetime, int, str, Any]] = []
+        self._sequence = itertools.count()  # Tie breaker, keys of different kinds are not comparable
+        self._handlers: Dict[str, Callable[[Any], bool]] = {}
+        self._lock = threading.Lock()
+        self._pending: Counter = Counter()  # Entries in the heap, by (kind, key)
+        self.entries: Counter = Counter()
+        self.live: Counter = Counter()
+        self.swept: Counter = Counter()
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def register(self, kind: str, handler: Callable[[Any], bool]):
+        """Registers the function that removes the expired records of a kind.
+
+        Args:
+            kind (str): Name of the kind of record.
+            handler (Callable): Receives the record key, returns True if the record was removed,
+                False if it was already gone (e.g. a share link already used).
+        """
+        self._handlers[kind] = handler
+
+    def schedule(self, kind: str, key: Any, deadline: datetime):
+        with self._lock:
+            heapq.heappush(self._heap, (deadline, next(self._sequence), kind, key))
+            self.entries[kind] += 1
+            if not self._pending[kind, key]:
+                self.live[kind] += 1
+            self._pending[kind, key] += 1
+
+    def sweep(self, now: datetime, max_batch: int) -> int:
+        """Removes up to `max_batch` records whose deadline is before `now`.
+
+        Returns:
+            int: Number of entries popped from the index.
+        """
+        popped = 0
+        while popped < max_batch:
+            with self._lock:
+                if not self._heap or self._heap[0][0] > now:
+                    break
+                _, _, kind, key = heapq.heappop(self._heap)
+                self.entries[kind] -= 1
+                self._pending[kind, key] -= 1
+                if not self._pending[kind, key]:
+                    del self._pending[kind, key]
+                    self.live[kind] -= 1
+            popped += 1
+            if self._handlers[kind](key):
+                self.swept[kind] += 1
+        return popped
+
+    def stats(self) -> dict:
+        return {
+            "entries": dict(self.entries),
+            "live": dict(self.live),
+            "swept": dict(self.swept),
+        }
+
+
+expiry_index = ExpiryIndex()
+
+
+async def run_expiry_sweeper():
+    """ Background task, sweeps the expired records every EXPIRY_SWEEP_INTERVAL_SECONDS """
+    while True:
+        try:
+            # Yield to the event loop between batches to keep the latency of the requests low
+            while expiry_index.sweep(datetime.now(), settings.EXPIRY_SWEEP_BATCH) == settings.EXPIRY_SWEEP_BATCH:
+                await asyncio.sleep(0)
+        except Exception:
+            logger.exception("Expiry sweep failed")
+        await asyncio.sleep(settings.EXPIRY_SWEEP_INTERVAL_SECONDS)
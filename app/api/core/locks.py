@@ -0,0 +1,26 @@
+""" Striped locks, to serialize the changes of a key without a global lock
+
+Keys are spread over a fixed amount of locks by hash, so the changes of different
+users (almost) never wait for each other and the memory doesn't grow with the keys.
+The locks belong to the process, the sqlite backend uses transactions between workers.
+"""
+import threading
+from typing import Hashable, List
+
+from api.config import settings
+
+
+class StripedLock:
+    def __init__(self, stripes: int):
+        self._locks: List[threading.Lock] = [threading.Lock() for _ in range(stripes)]
+
+    def __len__(self) -> int:
+        return len(self._locks)
+
+    def __call__(self, key: Hashable) -> threading.Lock:
+        """ Returns the lock of the key, use it as a context manager """
+        return self._locks[hash(key) % len(self._locks)]
+
+
+# Changes of the files of a user, e.g. `with user_locks(user_id):`
+user_locks = StripedLock(settings.USER_LOCK_STRIPES)
@@ -0,0 +1,98 @@
+""" Download quota engines
+
+Both engines answer the same question ("how many bytes can the user still download?")
+in constant time, no matter how many downloads the user has done.
+The engine used for the users is selected with `settings.DOWNLOAD_QUOTA_MODE`.
+The downloads of a user check and consume their quota from the threadpool and the event loop
+at the same time, each engine changes its state under its own lock.
+"""
+import threading
+from collections import deque
+from datetime import datetime, timedelta
+from typing import Deque, Tuple
+
+from api.config import settings
+
+
+class SlidingWindowQuota:
+    """Traffic quota over the last `window` of time.
+
+    Downloads are kept as `(timestamp, size)` tuples in a deque ordered by timestamp together
+    with a running total of their sizes, expired downloads are dropped from the left side,
+    so each download is added and removed exactly once (amortized O(1) per request).
+    """
+
+    def __init__(self, limit: int, window: timedelta):
+        self.limit = limit
+        self.window = window
+        self.records: Deque[Tuple[datetime, int]] = deque()
+        self.total = 0
+        self._lock = threading.Lock()
+
+    def _expire(self, now: datetime):
+        threshold = now - self.window
+        while self.records and self.records[0][0] < threshold:
+            self.total -= self.records.popleft()[1]
+
+    def remaining(self, now: datetime) -> int:
+        """ Returns the bytes that can still be downloaded, negative if the quota was surpassed """
+        with self._lock:
+            self._expire(now)
+            return self.limit - self.total
+
+    def consume(self, size: int, now: datetime, file_id: str):
+        with self._lock:
+            self.records.append((now, size))
+            self.total += size
+
+
+class TokenBucketQuota:
+    """Traffic quota as a token bucket.
+
+    The bucket holds up to `limit` bytes and refills continuously at `limit` bytes per `window`,
+    so the state of a user is just two numbers. The bucket can go below zero, as the download
+    that surpasses the quota is still accepted.
+    """
+
+    def __init__(self, limit: int, window: timedelta):
+        self.limit = limit
+        self.rate = limit / window.total_seconds()  # Bytes per second
+        self.tokens = float(limit)
+        self.updated_at = None
+        self._lock = threading.Lock()
+
+    def _refill(self, now: datetime):
+        if self.updated_at is not None and now > self.updated_at:
+            elapsed = (now - self.updated_at).total_seconds()
+            self.tokens = min(self.limit, self.tokens + elapsed * self.rate)
+        if self.updated_at is None or now > self.updated_at:
+            self.updated_at = now
+
+    def remaining(self, now: datetime) -> int:
+        """ Returns the bytes that can still be downloaded, negative if the quota was surpassed """
+        with self._lock:
+            self._refill(now)
+            return int(self.tokens)
+
+    def consume(self, size: int, now: datetime, file_id: str):
+        with self._lock:
+            self._refill(now)
+            self.tokens -= size
+
+
+QUOTA_MODES = {
+    "sliding_window": SlidingWindowQuota,
+    "token_bucket": TokenBucketQuota,
+}
+
+
+def create_download_quota():
+    """ Returns a new download quota engine for a user, following the current settings """
+    try:
+        quota_class = QUOTA_MODES[settings.DOWNLOAD_QUOTA_MODE]
+    except KeyError:
+        raise ValueError(f"Unknown DOWNLOAD_QUOTA_MODE: {settings.DOWNLOAD_QUOTA_MODE}")
+    return quota_class(
+        limit=settings.DOWNLOAD_QUOTA_TRAFFIC,
+        window=timedelta(minutes=settings.DOWNLOAD_QUOTA_MINUTES)
+    )
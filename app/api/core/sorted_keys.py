@@ -0,0 +1,102 @@
+""" Sorted set of keys for the secondary indexes of the stores
+
+The keys are kept in sorted sublists of up to 2 * `load` keys, with the greatest key of each
+sublist in a separate list. Adding or removing a key bisects both lists and shifts at most one
+sublist, and walking the keys from any key starts with the same two bisections, so the cost
+of a page of keys doesn't grow with the number of keys.
+"""
+from bisect import bisect_left, bisect_right, insort
+from typing import Any, Iterable, Iterator, List
+
+
+class SortedKeys:
+    def __init__(self, load: int = 512):
+        self.load = load
+        self._lists: List[list] = []
+        self._maxes: list = []
+        self._len = 0
+
+    def __len__(self) -> int:
+        return self._len
+
+    def __iter__(self) -> Iterator[Any]:
+        return self.irange()
+
+    def add(self, key):
+        """ Adds a key, it must not be already in the set """
+        if not self._lists:
+            self._lists.append([key])
+            self._maxes.append(key)
+        else:
+            index = bisect_left(self._maxes, key)
+            if index == len(self._maxes):
+                index -= 1
+                self._lists[index].append(key)
+                self._maxes[index] = key
+            else:
+                insort(self._lists[index], key)
+            self._split(index)
+        self._len += 1
+
+    def update(self, keys: Iterable):
+        """ Adds keys that are not already in the set, an empty set sorts them all at once """
+        if self._lists:
+            for key in keys:
+                self.add(key)
+            return
+        keys = sorted(keys)
+        self._lists = [keys[start:start + self.load] for start in range(0, len(keys), self.load)]
+        self._maxes = [sublist[-1] for sublist in self._lists]
+        self._len = len(keys)
+
+    def _split(self, index: int):
+        keys = self._lists[index]
+        if len(keys) > 2 * self.load:
+            half = keys[self.load:]
+            del keys[self.load:]
+            self._maxes[index] = keys[-1]
+            self._lists.insert(index + 1, half)
+            self._maxes.insert(index + 1, half[-1])
+
+    def remove(self, key):
+        """Removes a key.
+
+        Raises:
+            KeyError: The key is not in the set.
+        """
+        index = bisect_left(self._maxes, key)
+        if index == len(self._maxes):
+            raise KeyError(key)
+        keys = self._lists[index]
+        position = bisect_left(keys, key)
+        if keys[position] != key:
+            raise KeyError(key)
+        del keys[position]
+        self._len -= 1
+        if keys:
+            self._maxes[index] = keys[-1]
+        else:
+            del self._lists[index]
+            del self._maxes[index]
+
+    def irange(self, start=None, exclusive: bool = False) -> Iterator[Any]:
+        """Iterates the keys in order from `start`, the set must not change while iterating.
+
+        Args:
+            start (optional): First key, or the key before the first one if `exclusive`. All the keys if None.
+            exclusive (bool): Whether `start` itself is skipped.
+        """
+        if start is None:
+            index, position = 0, 0
+        else:
+            find = bisect_right if exclusive else bisect_left
+            index = find(self._maxes, start)
+            if index == len(self._maxes):
+                return
+            position = find(self._lists[index], start)
+        while index < len(self._lists):
+            keys = self._lists[index]
+            while position < len(keys):
+                yield keys[position]
+                position += 1
+            index, position = index + 1, 0
@@ -1,20 +1,222 @@
 """ Singleton dict as in memory db
-Added the hardcoded demo user as we don't have any account creation endpoints
+The demo user of the settings is registered at startup, more users are registered with POST /users.
+The state of each user is a partition loaded on demand (see api/storage/users.py).
+
+When settings.JOURNAL_PATH is set, the mutations are written to a journal
+(see api/storage/journal.py) and the db is restored from it at startup.
+Reads always go to the in memory dict.
+
+When settings.STATE_BACKEND is "sqlite", the stores of the db are backed by a SQLite
+database (see api/storage/sqlite.py) shared by all the worker processes, so a token
+issued by a worker is valid in the others and the quotas count the downloads of all of them.
 """
+import gc
+import os
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Iterator, List
 
+from api.auth.passwords import hash_password
 from api.config import settings
+from api.core.eviction import create_eviction_policy
+from api.core.expiry import expiry_index
+from api.core.quota import create_download_quota
+from api.storage.blobs import RefCounts, blob_store
+from api.storage.file_store import FileStore
+from api.storage.journal import Record, journal
+from api.storage.nonces import create_used_nonces
+from api.storage.records import (
+    FileRecord, ShareLinkRecord, TokenRecord, file_columns, file_record, restore_files, share_link_record, token_record
+)
+from api.storage.stores import CallCounters, ShareLinkStore, TokenStore
+from api.storage.users import UserPartitions, UserRegistry
 
-db = {
-    "users": {
-        f"{settings.DEMO_USER_ID}": {
-            "user_id": f"{settings.DEMO_USER_ID}",
-            "access_tokens": {},
-            "files": [],
+state = None
+if settings.STATE_BACKEND == "sqlite":
+    from api.storage import sqlite
+
+    os.makedirs(os.path.dirname(settings.SQLITE_PATH) or ".", exist_ok=True)
+    state = sqlite.SqliteState(settings.SQLITE_PATH)
+    blob_store.refs = sqlite.SqliteRefCounts(state)
+    # Signed tokens must be valid in every worker, they share the key unless it's set from env vars
+    if "SECRET_KEY" not in settings.__fields_set__:
+        settings.SECRET_KEY = state.shared_value("secret_key", settings.SECRET_KEY)
+elif settings.STATE_BACKEND != "memory":
+    raise ValueError(f"Unknown STATE_BACKEND: {settings.STATE_BACKEND}")
+
+
+def create_user(user_id: str) -> dict:
+    """ Returns the partition of a user, with the stores of the current backend """
+    if state is not None:
+        return {
+            "user_id": user_id,
+            "files": sqlite.SqliteFileStore(state, user_id, settings.EVICTION_POLICY),
             "quotas": {
-                "by_download_traffic": settings.DOWNLOAD_QUOTA_TRAFFIC
+                "by_download_traffic": sqlite.create_sqlite_download_quota(state, user_id)
             },
-            "last_downloads": []
+        }
+    return {
+        "user_id": user_id,
+        "files": FileStore(create_eviction_policy()),
+        "quotas": {
+            "by_download_traffic": create_download_quota()
         },
-    },
-    "share_links":{}
+    }
+
+
+@contextmanager
+def transaction() -> Iterator[None]:
+    """Makes the changes of the db inside atomic for all the workers, with the sqlite backend.
+
+    The in memory db belongs to a single process, the user locks already serialize its changes.
+    """
+    if state is None:
+        yield
+        return
+    with state.transaction():
+        yield
+
+
+def releasable_user(user: dict) -> bool:
+    """ Whether the partition of a user can be released from memory without losing its state """
+    if state is not None:
+        return True
+    quota = user["quotas"]["by_download_traffic"]
+    return len(user["files"]) == 0 and quota.remaining(datetime.now()) >= quota.limit
+
+
+db = {
+    # Partitions of the registered users, by user id
+    "users": UserPartitions(
+        UserRegistry() if state is None else sqlite.SqliteUserRegistry(state),
+        create_user, releasable_user, settings.USER_IDLE_SECONDS
+    ),
+    # Opaque access tokens of all the users, by token id
+    "access_tokens": TokenStore() if state is None else sqlite.SqliteTokenStore(state),
+    "share_links": ShareLinkStore() if state is None else sqlite.SqliteShareLinkStore(state),
+    # Remaining calls of the signed access tokens, by token nonce
+    "token_calls": CallCounters() if state is None else sqlite.SqliteCallCounters(state),
+    # Nonces of the signed share links already used
+    "used_share_nonces": create_used_nonces() if state is None else sqlite.SqliteUsedNonces(state)
 }
+expiry_index.register("user_partition", db["users"].release)
+
+# The settings are the reference of the demo user, it's not written to the journal
+if settings.DEMO_USER_ID:
+    db["users"].registry.put(settings.DEMO_USER_ID, hash_password(settings.DEMO_USER_PASSWORD))
+
+
+# Journal records, replaying any of them twice must give the same state.
+# Journals written before api/storage/records.py have pydantic models, they are converted
+
+def _user_put(user_id: str, password_hash: bytes):
+    db["users"].registry.put(user_id, password_hash)
+
+def _file_put(user_id: str, file: FileRecord):
+    db["users"][user_id]["files"].put(file_record(file))
+
+def _user_files(user_id: str, *columns: list):
+    # Files of a user in the snapshots, columns of the fields of FileRecord.state load faster than records
+    db["users"][user_id]["files"].load(restore_files(*columns))
+
+def _file_del(user_id: str, file_id: str):
+    if file_id in db["users"][user_id]["files"]:
+        db["users"][user_id]["files"].remove(file_id)
+
+def _share_put(share_link: ShareLinkRecord):
+    db["share_links"].add(share_link_record(share_link))
+
+def _share_del(share_id: str):
+    db["share_links"].remove(share_id)
+
+def _token_put(user_id: str, token: TokenRecord):
+    token = token_record(token)
+    token.user_id = user_id
+    db["access_tokens"].add(token)
+
+def _token_calls(user_id: str, token_id: str, available_calls: int):
+    # The calls of a token only go down, the counts of concurrent requests are journaled in any order
+    token = db["access_tokens"].get(token_id)
+    if token is not None:
+        token.available_calls = min(token.available_calls, available_calls)
+
+RECORD_HANDLERS = {
+    "user_put": _user_put,
+    "file_put": _file_put,
+    "user_files": _user_files,
+    "file_del": _file_del,
+    "share_put": _share_put,
+    "share_del": _share_del,
+    "token_put": _token_put,
+    "token_calls": _token_calls,
+}
+
+
+def capture_records() -> List[Record]:
+    """ Returns the records that rebuild the current db, for the journal snapshots """
+    records = [("user_put", (user_id, password_hash)) for user_id, password_hash in db["users"].registry.items()
+               if user_id != settings.DEMO_USER_ID]
+    # The partitions that are not loaded have nothing to keep
+    for user_id, user in db["users"].items():
+        files = list(user["files"])
+        if files:
+            records.append(("user_files", (user_id, *file_columns(files))))
+    records.extend(("token_put", (token.user_id, token)) for token in db["access_tokens"].values())
+    records.extend(("share_put", (share_link,)) for share_link in list(db["share_links"].values()))
+    return records
+
+
+def restore():
+    """Opens the journal and rebuilds the db from it.
+
+    Expired tokens and share links are dropped, blob references and expiry deadlines
+    are rebuilt from the restored records. Signed access tokens get their full calls quota back.
+    """
+    journal.open(settings.JOURNAL_PATH, settings.JOURNAL_FSYNC_EVERY)
+    # Replaying creates millions of objects and no garbage, the collector would rescan them
+    # all along the way. They are frozen after, they live as long as the process
+    gc.disable()
+    try:
+        for op, args in journal.replay():
+            RECORD_HANDLERS[op](*args)
+    finally:
+        gc.enable()
+    gc.freeze()
+
+    now = datetime.now()
+    checksums = Counter()
+    for user_id, user in db["users"].items():
+        checksums.update(file.checksum for file in user["files"])
+    for token in db["access_tokens"].values():
+        if token.expires_at <= now:
+            db["access_tokens"].remove(token.id)
+        else:
+            expiry_index.schedule("access_token", token.id, token.expires_at)
+    for share_link in list(db["share_links"].values()):
+        if share_link.expires_at and share_link.expires_at <= now:
+            db["share_links"].remove(share_link.id)
+        else:
+            checksums[share_link.file.checksum] += 1
+            if share_link.expires_at:
+                expiry_index.schedule("share_link", share_link.id, share_link.expires_at)
+    blob_store.refs = RefCounts(checksums)
+
+    # Compact the replayed records, the next restart only reads the snapshot
+    journal.snapshot(capture_records)
+
+
+def load_shared_state():
+    """Prepares the sqlite backend when a worker starts.
+
+    Tokens that expired while no worker was running are removed, the ones still stored
+    and the share links are scheduled in the expiry index of this worker. Every worker
+    schedules them, removing them is idempotent.
+    """
+    state.remove_expired(datetime.now())
+    for token in db["access_tokens"].values():
+        expiry_index.schedule("access_token", token.id, token.expires_at)
+    for share_link in db["share_links"].values():
+        if share_link.expires_at:
+            # Already expired links are removed on the first sweep
+            expiry_index.schedule("share_link", share_link.id, share_link.expires_at)
@@ -1,13 +1,21 @@
+import asyncio
 from fastapi import FastAPI
 from fastapi.exceptions import RequestValidationError
 from fastapi.responses import JSONResponse
 from api.auth import auth
-from api.routes import files
+from api.routes import files, stats
 from api.config import settings
+from api.core.expiry import run_expiry_sweeper
+from api.fast_json import FastJSONResponse
+from api.storage.deletions import run_deletion_worker
+from api.database import capture_records, load_shared_state, restore
+from api.storage.journal import journal, run_journal_maintenance
+from starlette.concurrency import run_in_threadpool
 
 app = FastAPI(
     title=settings.PROJECT_NAME,
-    description=settings.PROJECT_DESCRIPTION
+    description=settings.PROJECT_DESCRIPTION,
+    default_response_class=FastJSONResponse if settings.FAST_RESPONSES else JSONResponse
 )
 
 # Redirect all the Validation Errors from FastApi from 422 to 400
@@ -18,3 +26,27 @@ async def validation_exception_handler(request, exc):
 # Load API routes to FastAPI app 
 app.include_router(auth.router, tags=["auth"])
 app.include_router(files.router, tags=["files"])
+app.include_router(stats.router, tags=["stats"])
+
+# Background tasks living as long as the app
+@app.on_event("startup")
+async def start_background_tasks():
+    if settings.STATE_BACKEND == "sqlite":
+        await run_in_threadpool(load_shared_state)
+    elif settings.JOURNAL_PATH:
+        # Restore the db before serving any request
+        await run_in_threadpool(restore)
+        app.state.journal_maintenance = asyncio.create_task(run_journal_maintenance(capture_records))
+    app.state.expiry_sweeper = asyncio.create_task(run_expiry_sweeper())
+    # Once the db is restored, the files it doesn't reference can be removed
+    await run_in_threadpool(files.enqueue_orphan_files)
+    app.state.deletion_worker = asyncio.create_task(run_deletion_worker())
+
+@app.on_event("shutdown")
+async def stop_background_tasks():
+    app.state.expiry_sweeper.cancel()
+    app.state.deletion_worker.cancel()
+    if settings.STATE_BACKEND == "memory" and settings.JOURNAL_PATH:
+        app.state.journal_maintenance.cancel()
+        journal.close()
+
@@ -0,0 +1,356 @@
+""" File download responses with HTTP Range and conditional requests support
+
+Downloads answer `Range` requests (single and multiple ranges) with `206 Partial Content`,
+honoring `If-Range`, and always send `Accept-Ranges`, `ETag` and `Last-Modified`,
+so clients can resume a broken download instead of starting over.
+Clients that already have the current version get a `304 Not Modified` from `If-None-Match`.
+Small files are served from the file cache (see api/storage/file_cache.py) when possible,
+the larger ones share open descriptors (see api/storage/fd_cache.py).
+"""
+import os
+import uuid
+from email.utils import formatdate, parsedate_to_datetime
+from typing import Callable, List, Optional, Tuple, Union
+from urllib.parse import quote
+
+from fastapi import HTTPException
+from starlette.concurrency import run_in_threadpool, run_until_first_complete
+from starlette.requests import Request
+from starlette.responses import Response
+from starlette.types import Receive, Scope, Send
+
+from api.config import settings
+from api.storage.fd_cache import OpenFile, fd_cache
+from api.storage.file_cache import CachedFile, file_cache
+
+MAX_RANGES = 16  # More ranges than this are served as the full file
+
+
+def parse_range(header: str, size: int) -> Optional[List[Tuple[int, int]]]:
+    """Parses a `Range` header into sorted, merged (start, end) byte ranges, end excluded.
+
+    Returns:
+        None if the header is malformed or not in bytes (the header is ignored),
+        an empty list if no range can be satisfied (416 response).
+    """
+    unit, _, ranges_spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or not ranges_spec:
+        return None
+
+    ranges = []
+    for spec in ranges_spec.split(","):
+        first, dash, last = spec.strip().partition("-")
+        if not dash or not (first or last) or (first and not first.isdigit()) or (last and not last.isdigit()):
+            return None
+        if not first:  # Suffix range, the last N bytes
+            start, end = max(size - int(last), 0), size
+        else:
+            start = int(first)
+            end = min(int(last) + 1, size) if last else size
+            if last and int(last) < start:
+                return None
+        if start < end:
+            ranges.append((start, end))
+    if len(ranges) > MAX_RANGES:
+        return None
+
+    # Merge overlapping and adjacent ranges, so a file is never sent more than once
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def content_disposition(filename: str) -> str:
+    quoted_filename = quote(filename)
+    if quoted_filename != filename:
+        return f"attachment; filename*=utf-8''{quoted_filename}"
+    return f'attachment; filename="{filename}"'
+
+
+def checksum_etag(checksum: str) -> str:
+    """ Strong ETag of a content, it can be computed from the file metadata without touching disk """
+    return f'"{checksum}"'
+
+
+def file_etag(stat_result: os.stat_result, checksum: Optional[str] = None) -> str:
+    """ Strong ETag, from the content checksum if it's known or from the file size and mtime """
+    if checksum:
+        return checksum_etag(checksum)
+    return f'"{stat_result.st_size:x}-{stat_result.st_mtime_ns:x}"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """ Checks the `If-None-Match` header against the current ETag, using the weak comparison """
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    current = etag[2:] if etag.startswith("W/") else etag
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == current:
+            return True
+    return False
+
+
+def not_modified(etag: str) -> Response:
+    return Response(status_code=304, headers={"etag": etag})
+
+
+def offload_response(path: str, filename: str, media_type: str, checksum: Optional[str] = None) -> Response:
+    """Returns an empty response that tells the reverse proxy to send the file (settings.DOWNLOAD_OFFLOAD).
+
+    The proxy answers the Range and conditional requests itself, from the file it serves.
+    """
+    headers = {
+        "content-disposition": content_disposition(filename),
+    }
+    if checksum:
+        headers["etag"] = checksum_etag(checksum)
+    if settings.DOWNLOAD_OFFLOAD == "x-accel-redirect":
+        # Internal nginx location of BLOBS_PATH
+        relative_path = os.path.relpath(path, settings.BLOBS_PATH).replace(os.sep, "/")
+        headers["x-accel-redirect"] = quote(settings.DOWNLOAD_OFFLOAD_LOCATION + relative_path)
+    elif settings.DOWNLOAD_OFFLOAD == "x-sendfile":
+        headers["x-sendfile"] = os.path.abspath(path)
+    else:
+        raise ValueError(f"Unknown DOWNLOAD_OFFLOAD: {settings.DOWNLOAD_OFFLOAD}")
+    return Response(headers=headers, media_type=media_type)
+
+
+def if_range_matches(if_range: str, etag: str, mtime: float) -> bool:
+    """ Checks the `If-Range` header, ranges are only served if the client has the current file """
+    if if_range.startswith('"') or if_range.startswith("W/"):
+        # Weak ETags never match, If-Range requires a strong comparison
+        return if_range == etag
+    try:
+        return int(parsedate_to_datetime(if_range).timestamp()) == int(mtime)
+    except (TypeError, ValueError):
+        return False
+
+
+class FileRangeResponse(Response):
+    """Sends byte ranges of an open file, releasing it when done.
+
+    The ranges are read with `os.pread` in chunks of `chunk_size` from the descriptor shared through
+    the fd cache, without seeking, so concurrent downloads of a blob don't open it again. The ASGI
+    servers of this api don't send files from the descriptor themselves, DOWNLOAD_OFFLOAD leaves
+    sending the whole file to the reverse proxy.
+    `on_sent` is called once with the amount of file bytes sent to the client,
+    even if the client disconnects in the middle of the download.
+    """
+
+    chunk_size = 256 * 1024
+
+    def __init__(
+        self,
+        file: OpenFile,
+        parts: List[Tuple[bytes, int, int]],
+        trailer: bytes = b"",
+        status_code: int = 200,
+        headers: dict = None,
+        media_type: str = None,
+        on_sent: Callable[[int], None] = None,
+    ):
+        self.file = file
+        self.parts = parts
+        self.trailer = trailer
+        self.status_code = status_code
+        self.media_type = media_type
+        self.on_sent = on_sent
+        self.sent = 0
+        self.background = None
+        self.init_headers(headers)
+        self.headers["content-length"] = str(
+            sum(len(header) + end - start for header, start, end in parts) + len(trailer))
+
+    async def listen_for_disconnect(self, receive: Receive):
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                break
+
+    async def read(self, size: int, offset: int) -> bytes:
+        return await run_in_threadpool(os.pread, self.file.fd, size, offset)
+
+    def close(self):
+        fd_cache.release(self.file)
+
+    async def send_range(self, send: Send, start: int, end: int):
+        offset = start
+        while offset < end:
+            chunk = await self.read(min(self.chunk_size, end - offset), offset)
+            if not chunk:  # The file was truncated
+                break
+            await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            offset += len(chunk)
+            self.sent += len(chunk)
+
+    async def send_parts(self, send: Send):
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        for header, start, end in self.parts:
+            if header:
+                await send({"type": "http.response.body", "body": header, "more_body": True})
+            await self.send_range(send, start, end)
+        await send({"type": "http.response.body", "body": self.trailer, "more_body": False})
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        try:
+            await run_until_first_complete(
+                (self.send_parts, {"send": send}),
+                (self.listen_for_disconnect, {"receive": receive}),
+            )
+        finally:
+            self.close()
+            if self.on_sent and self.sent:
+                self.on_sent(self.sent)
+
+
+class MemoryRangeResponse(FileRangeResponse):
+    """ Sends byte ranges of a content already in memory, each range in a single message """
+
+    chunk_size = 2 ** 62
+
+    def __init__(self, content: bytes, parts: List[Tuple[bytes, int, int]], **kwargs):
+        super().__init__(None, parts, **kwargs)
+        self.content = content
+
+    async def read(self, size: int, offset: int) -> bytes:
+        return self.content[offset:offset + size]
+
+    def close(self):
+        pass
+
+
+FileSource = Union[OpenFile, CachedFile]
+
+
+def open_file(path: str, checksum: Optional[str] = None, size: Optional[int] = None, cache: bool = True) -> FileSource:
+    """Opens the file for reading, raises a 404 if it doesn't exist.
+
+    Args:
+        path (str): File in the filesystem.
+        checksum (str, optional): Checksum of the content, small files with a checksum are cached.
+        size (int, optional): Size of the file if it's known, larger files don't look into the cache.
+        cache (bool): Whether a small file missing from the cache is read into it, otherwise it's opened.
+
+    Returns:
+        The open file, or the content of the file from the cache.
+    """
+    cacheable = checksum is not None and file_cache.accepts(size if size is not None else 0)
+    if cacheable:
+        cached = file_cache.get(checksum)
+        if cached is not None:
+            return cached
+    try:
+        if checksum is not None and not cacheable:
+            # Blobs never change, their descriptors are shared by the downloads
+            return fd_cache.acquire(path)
+        fd = os.open(path, os.O_RDONLY)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Not found")
+
+    file = OpenFile(fd, os.fstat(fd))
+    if not cache or not cacheable or not file_cache.accepts(file.stat.st_size):
+        return file
+    try:
+        content = os.pread(fd, file.stat.st_size, 0)
+    finally:
+        os.close(fd)
+    cached = CachedFile(content, file.stat.st_mtime)
+    file_cache.put(checksum, cached)
+    return cached
+
+
+def close_file(source: FileSource):
+    """ Closes a file returned by `open_file` that wasn't given to a response """
+    if isinstance(source, OpenFile):
+        fd_cache.release(source)
+
+
+def file_response(
+    request: Request,
+    path: str,
+    filename: str,
+    media_type: str,
+    checksum: Optional[str] = None,
+    on_sent: Callable[[int], None] = None,
+    source: Optional[FileSource] = None,
+) -> Response:
+    """Returns the file, or the byte ranges of the file requested with the `Range` header.
+
+    Args:
+        request (Request): Download request, its `Range` and `If-Range` headers are used.
+        path (str): File in the filesystem.
+        filename (str): Name of the file for the user.
+        media_type (str): Media type of the file.
+        checksum (str, optional): Checksum of the content, used as ETag.
+        on_sent (Callable, optional): Called with the amount of file bytes sent to the client.
+        source (optional): The file already opened with `open_file`, the response closes it.
+    """
+    if source is None:
+        source = open_file(path, checksum)
+
+    if isinstance(source, CachedFile):
+        size, mtime = len(source.content), source.mtime
+        etag = checksum_etag(checksum)
+        def make_response(parts, **kwargs) -> Response:
+            return MemoryRangeResponse(source.content, parts, on_sent=on_sent, **kwargs)
+    else:
+        # The open file is used from now on, so an overwrite of the path doesn't affect this download
+        size, mtime = source.stat.st_size, source.stat.st_mtime
+        etag = file_etag(source.stat, checksum)
+        def make_response(parts, **kwargs) -> Response:
+            return FileRangeResponse(source, parts, on_sent=on_sent, **kwargs)
+
+    headers = {
+        "accept-ranges": "bytes",
+        "etag": etag,
+        "last-modified": formatdate(mtime, usegmt=True),
+        "content-disposition": content_disposition(filename),
+    }
+
+    ranges = None
+    range_header = request.headers.get("range")
+    if range_header:
+        if_range = request.headers.get("if-range")
+        if not if_range or if_range_matches(if_range, etag, mtime):
+            ranges = parse_range(range_header, size)
+
+    if ranges is None:
+        return make_response([(b"", 0, size)], headers=headers, media_type=media_type)
+
+    if not ranges:
+        if not isinstance(source, CachedFile):
+            fd_cache.release(source)
+        headers["content-range"] = f"bytes */{size}"
+        return Response(status_code=416, headers=headers)
+
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        headers["content-range"] = f"bytes {start}-{end - 1}/{size}"
+        return make_response([(b"", start, end)], status_code=206, headers=headers, media_type=media_type)
+
+    boundary = uuid.uuid4().hex
+    parts = []
+    for start, end in ranges:
+        part_header = (
+            f"--{boundary}\r\n"
+            f"Content-Type: {media_type}\r\n"
+            f"Content-Range: bytes {start}-{end - 1}/{size}\r\n\r\n"
+        ).encode("latin-1")
+        # Each part after the first one starts after the CRLF that ends the previous part
+        parts.append(((b"\r\n" if parts else b"") + part_header, start, end))
+    return make_response(
+        parts,
+        trailer=f"\r\n--{boundary}--\r\n".encode("latin-1"),
+        status_code=206,
+        headers=headers,
+        media_type=f"multipart/byteranges; boundary={boundary}"
+    )
@@ -1,210 +1,621 @@
 
 from datetime import datetime, timedelta
-from typing import Any, Union
-from fastapi import APIRouter, Body, Form, Depends,Security, Header, HTTPException, File, UploadFile
-from fastapi.responses import FileResponse
+from typing import Any, Callable, List, Optional, Tuple, Union
+from fastapi import APIRouter, Body, Form, Depends, Header, HTTPException, Query
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import Request
+from starlette.responses import Response
 from api.schemas.user import User
-from api.schemas.file import BaseFile, FileInDBBase, ShareUrlInDB, UserFiles, FileInDB, DownloadRecord, ShareUrl
-from api.database import db
+from api.schemas.file import BaseFile, BatchUpload, BatchUploadResult, UserFiles, ShareUrl
+from api.database import db, transaction
 from api.config import settings
+import base64
+import json
 import os
-from fastapi.security import HTTPAuthorizationCredentials
-from api.auth.deps import get_current_user, get_user_access_token, CustomHTTPBearer
+import time
+from api.auth.deps import get_current_user
+from api.archive import ArchiveEntry, ZipArchiveResponse, is_compressed
+from api.auth.signing import sign, unsign
+from api.core.expiry import expiry_index
+from api.fast_json import trusted, user_files_response
+from api.core.locks import user_locks
+from api.responses import (
+    checksum_etag, etag_matches, file_response, not_modified, offload_response, open_file
+)
+from api.storage.blobs import blob_store
+from api.storage.deletions import deletion_queue
+from api.storage.file_store import PageFilters
+from api.storage.journal import journal
+from api.storage.records import FileRecord, ShareLinkRecord
+from api.storage.uploads import (
+    RejectedUpload, StoredUpload, receive_multipart_file, receive_multipart_files, receive_stream
+)
 import uuid
-from shutil import copyfileobj
-from functools import reduce
 
 router = APIRouter()
-security = CustomHTTPBearer()
 
-def update_current_quota(user_id: str):
-    # Filter for valid (recent) downloads
-    valid_downloads = [download for download in db["users"][user_id]["last_downloads"] if lambda element: element.timestamp >=
-                       datetime.now() - timedelta(minutes=settings.DOWNLOAD_QUOTA_MINUTES)]
-    db["users"][user_id]["last_downloads"] = valid_downloads
+def get_user(user_id: str) -> Optional[dict]:
+    """Returns the partition of a user, None if the user is not registered.
 
-    # Calculate currente allowance
-    download_traffic_quota = settings.DOWNLOAD_QUOTA_TRAFFIC - \
-        sum([download.size for download in valid_downloads])
+    It's taken under the user lock, so it can't be released while the request uses it (see api/storage/users.py).
+    """
+    with user_locks(user_id):
+        return db["users"].get(user_id)
 
-    db["users"][user_id]["quotas"]["by_download_traffic"] = download_traffic_quota
-    return download_traffic_quota
 
+def evict_user_files(user_id: str, count: int):
+    """Removes `count` files of the user to make room for new ones.
 
-def add_file_to_db(user_id: str, file: FileInDB):
-    # Validate that the current limit of files is less that the demo limit
-    if len(db["users"][user_id]["files"]) == settings.USER_MAX_FILES:
-        # Remove first file if the quota of files is maxed out
-        os.remove(db["users"][user_id]["files"][0].route)
-        del db["users"][user_id]["files"][0]
-    db["users"][user_id]["files"].append(file)
+    The oldest files are removed, unless settings.EVICTION_POLICY says otherwise.
+    """
+    user_files = db["users"][user_id]["files"]
+    for _ in range(min(count, len(user_files))):
+        evicted_file = user_files.pop_victim()
+        journal.record("file_del", user_id, evicted_file.id)
+        blob_store.decref(evicted_file.checksum)
 
 
-@router.get("/me", response_model=UserFiles)
-async def get_user_files(
-    token: HTTPAuthorizationCredentials = Security(security),
+@router.get("/me", response_model=UserFiles, response_model_exclude_none=True)
+def get_user_files(
+    request: Request,
+    response: Response,
+    limit: Optional[int] = Query(None, ge=1, le=settings.FILES_PAGE_MAX_LIMIT),
+    cursor: Optional[str] = None,
+    name_prefix: Optional[str] = None,
+    media_type: Optional[str] = None,
+    min_size: Optional[int] = Query(None, ge=0),
+    max_size: Optional[int] = Query(None, ge=0),
     user_id: User = Depends(get_current_user)
 ):
     """
     Returns all files on the user space.
+
+    With `limit`, `cursor` or any filter (`name_prefix`, `media_type`, `min_size`, `max_size`) the files
+    are returned in pages, send `next_cursor` as `cursor` with the same filters to get the next page.
+    A page can have less than `limit` files and still be followed by more, the last page has no `next_cursor`.
+
+    The ETag changes only when the list of files changes, send it as `If-None-Match` to get a 304 otherwise.
+    """
+    user_files = get_user(user_id)["files"]
+    etag = user_files.etag
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return not_modified(etag)
+
+    response.headers["etag"] = etag
+    paged = limit is not None or cursor is not None or name_prefix or media_type \
+        or min_size is not None or max_size is not None
+    if not paged:
+        # The uploads of the user change the files while they're listed, the list is a snapshot
+        with user_locks(user_id):
+            files = list(user_files)
+        if settings.FAST_RESPONSES:
+            return user_files_response(user_id, files, headers={"etag": etag})
+        return UserFiles(user=user_id, files=[BaseFile(name=file_data.name, url=file_data.url) for file_data in files])
+
+    filters = PageFilters(name_prefix, media_type, min_size, max_size)
+    after = decode_cursor(cursor, filters.order) if cursor else None
+    # The indexes change with the uploads of the user, the page is read while they can't
+    with user_locks(user_id):
+        try:
+            files, next_key = user_files.page(filters, limit or settings.FILES_PAGE_LIMIT, after)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+    next_cursor = encode_cursor(filters.order, next_key) if next_key is not None else None
+    if settings.FAST_RESPONSES:
+        return user_files_response(user_id, files, next_cursor, headers={"etag": etag})
+    return UserFiles(
+        user=user_id,
+        files=[BaseFile(name=file_data.name, url=file_data.url) for file_data in files],
+        next_cursor=next_cursor
+    )
+
+
+def encode_cursor(order: str, key: Any) -> str:
+    """ Returns the opaque cursor of the next page, the key of the last file of the page in its order """
+    return base64.urlsafe_b64encode(json.dumps([order, key]).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, order: str) -> Any:
+    """ Returns the key of a cursor, raises a 400 if it's invalid or from other filters """
+    try:
+        cursor_order, key = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if cursor_order != order:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return key
+
+
+def get_user_directory(user_id: str) -> str:
+    """ Returns the directory for the files of the user, creating it if needed """
+    directory = f"./files/{user_id}"
+    os.makedirs(directory, exist_ok=True)
+    return directory
+
+
+def enqueue_orphan_files() -> int:
+    """Enqueues for deletion the files on disk that the db doesn't reference, at startup.
+
+    Those are the blobs without references and the files left in the user directories
+    (temp files of interrupted uploads, files stored before the blob store) older than ORPHAN_MIN_AGE_SECONDS.
+
+    Returns:
+        int: Number of files enqueued.
     """
-    return UserFiles(user=user_id, files=[BaseFile(**dict(file_data)) for file_data in db["users"][user_id]["files"]])
+    orphans = blob_store.enqueue_orphans()
+    threshold = time.time() - settings.ORPHAN_MIN_AGE_SECONDS
+    # Only the directories of registered users, there can be millions of users without files
+    blobs_path = os.path.normpath(settings.BLOBS_PATH)
+    for user_dir in os.scandir("./files") if os.path.isdir("./files") else []:
+        if not user_dir.is_dir() or os.path.normpath(user_dir.path) == blobs_path \
+                or user_dir.name not in db["users"]:
+            continue
+        for entry in os.scandir(user_dir.path):
+            if entry.is_file() and entry.stat().st_mtime < threshold:
+                deletion_queue.enqueue(entry.path)
+                orphans += 1
+    return orphans
+
+
+def store_user_file(user_id: str, upload: StoredUpload) -> BaseFile:
+    """Moves a received upload into the user space, the file is overwritten if exists.
+
+    Uploads of the same user are serialized by the user lock, the uploads of other users don't wait.
+    An overwrite replaces the file entry, the downloads of the previous version keep reading its blob.
+
+    Args:
+        user_id (str): Owner of the file.
+        upload (StoredUpload): Upload received into a temp file of the user directory.
+    """
+    return store_user_files(user_id, [upload])[0]
+
+
+def store_user_files(user_id: str, uploads: List[StoredUpload]) -> List[BaseFile]:
+    """Moves received uploads into the user space, existing files are overwritten.
+
+    The whole batch is stored under one user lock, with a single eviction pass for its new files.
+    With the sqlite backend the batch is also a single transaction, so the uploads of other workers
+    can't interleave between the lookups, the limit of files and the changes.
+    Uploads with the same name overwrite each other in order, as separate requests would.
+
+    Args:
+        user_id (str): Owner of the files.
+        uploads (List[StoredUpload]): Uploads received into temp files of the user directory.
+
+    Returns:
+        List[BaseFile]: Stored file of each upload, in the same order.
+    """
+    # Only the last upload of each name is stored, the previous ones would be overwritten right away
+    latest = {upload.filename: upload for upload in uploads}
+    for upload in uploads:
+        if latest[upload.filename] is not upload:
+            deletion_queue.enqueue(upload.path)
+
+    def write_file(write: Callable[[FileRecord], None], new_file: FileRecord):
+        try:
+            write(new_file)
+        except BaseException:
+            # The blob reference of a file that wasn't stored is released
+            blob_store.decref(new_file.checksum)
+            raise
+        journal.record("file_put", user_id, new_file)
+        stored[new_file.name] = new_file
+
+    stored = {}
+    put_checksums = []
+    replaced = []
+    try:
+        with user_locks(user_id), transaction():
+            user_files = db["users"][user_id]["files"]
+            new_uploads = []
+            for upload in latest.values():
+                # Verify if the file already exists for that user
+                file_found = user_files.get_by_name(upload.filename)
+                if not file_found:
+                    new_uploads.append(upload)
+                    continue
+
+                # Contents are stored once by checksum, a duplicated upload only adds a reference to the existing blob.
+                # New blobs are renamed into place, a blob path never has a partially written file
+                file_route = blob_store.put(upload.path, upload.checksum)
+                put_checksums.append(upload.checksum)
+
+                # Update file route, size, media_type and checksum in a new entry, the readers keep the previous one
+                new_file = file_found.replace(
+                    route=file_route,
+                    size=upload.size,
+                    media_type=upload.media_type,
+                    checksum=upload.checksum
+                )
+                write_file(user_files.put, new_file)
+                replaced.append(file_found)
+
+            # Validate that the current limit of files is less that the demo limit, making room for all the new files at once
+            evict_user_files(user_id, len(user_files) + len(new_uploads) - settings.USER_MAX_FILES)
+            for upload in new_uploads:
+                file_route = blob_store.put(upload.path, upload.checksum)
+                put_checksums.append(upload.checksum)
+                # Generate file metadata
+                file_id = str(uuid.uuid4())[:8]
+                while file_id in user_files:  # Short ids can collide
+                    file_id = str(uuid.uuid4())[:8]
+                new_file = FileRecord(
+                    name=upload.filename,
+                    route=file_route,
+                    id=file_id,
+                    media_type=upload.media_type,
+                    size=upload.size,
+                    checksum=upload.checksum
+                )
+                write_file(user_files.add, new_file)
+    except BaseException:
+        # A failed sqlite transaction is rolled back with the references it took, the blobs
+        # moved into place by the batch are deleted if nothing else references them
+        for checksum in put_checksums:
+            blob_store.collect(checksum)
+        raise
+
+    # The previous contents are deleted if nothing else references them
+    for file_found in replaced:
+        blob_store.decref(file_found.checksum)
+    return [BaseFile(name=stored[upload.filename].name, url=stored[upload.filename].url) for upload in uploads]
 
 
 @router.post("/me", response_model=BaseFile)
-def upload_user_file(
+async def upload_user_file(
+    request: Request,
     user_id: User = Depends(get_current_user),
-    file: UploadFile = File(...),
-    token: HTTPAuthorizationCredentials = Security(security),
 ):
     """
     Receives a file and stores in the user space, file is overwritten if exists.
+
+    The file is sent as multipart/form-data in the `file` field.
     """
-    # Verify if the file already exists for that user
-    file_name = file.filename
-
-    file_found = False
-    file_found_idx = None
-    for idx, file_data in enumerate(db["users"][user_id]["files"]):
-        if file_data.name == file_name:
-            file_found = file_data
-            file_found_idx = idx
-            break
-    
-    # If the file is found (check by filename), overwrite the existing file
-    if file_found:
-        # Delete the existing file
-        os.remove(file_found.route)
-        
-        with open(file_found.route, "wb") as buffer:
-            copyfileobj(file.file, buffer)
-
-        # Update file size and media_type
-        file_size = os.path.getsize(file_found.route)
-        db["users"][user_id]["files"][file_found_idx].size = file_size
-        db["users"][user_id]["files"][file_found_idx].media_type = file.content_type
-        return BaseFile(name=file_name, url=file_found.url)
-        
-    # Generate file metadata
-    file_id = str(uuid.uuid4())[:8]
-    file_url = f"/f/{file_id}"
-    file_route = f"./files/{user_id}/{file_id}"
-
-    # For security reasons, we don't use the input filename in filesystem
-    if not os.path.exists(os.path.dirname(file_route)):
-        try:
-            os.makedirs(os.path.dirname(file_route))
-        except OSError: # Guard against race condition
-            raise HTTPException(status_code=500)
-
-    with open(file_route, "wb") as buffer:
-        copyfileobj(file.file, buffer)
-
-    # To measure the size of the files, we first save them and then get the size.
-    # We could use a different approach, like chunking and adding up each chunk
-    # But as the demo doc says, "File upload could be simple, no need to handle file chunks,
-    # resumed uploads or improved upload tricks"
-    file_size = os.path.getsize(file_route)
-
-    add_file_to_db(user_id, FileInDB(
-        name=file_name,
-        url=file_url,
-        route=file_route,
-        id=file_id,
-        media_type=file.content_type,
-        size=file_size
-    ))
-    return BaseFile(name=file_name, url=file_url)
+    # The body is streamed into a temp file, its size and checksum are computed while it's written
+    upload = await receive_multipart_file(request, get_user_directory(user_id))
+    return trusted(await run_in_threadpool(store_user_file, user_id, upload))
+
+
+@router.post("/me/batch", response_model=BatchUpload)
+async def upload_user_files(
+    request: Request,
+    user_id: User = Depends(get_current_user),
+):
+    """
+    Receives many files in one request and stores them in the user space, files are overwritten if exist.
+
+    The files are sent as multipart/form-data, each one in a `files` field, and written to storage as they arrive.
+    Returns the result of each file in the order they were sent, the files too large or beyond
+    `UPLOAD_BATCH_MAX_FILES` are not stored.
+    """
+    # A batch can't store more files than the user can have, it would evict its own files
+    max_files = min(settings.UPLOAD_BATCH_MAX_FILES, settings.USER_MAX_FILES)
+    received = await receive_multipart_files(request, get_user_directory(user_id), max_files)
+    uploads = [upload for upload in received if isinstance(upload, StoredUpload)]
+    stored = iter(await run_in_threadpool(store_user_files, user_id, uploads))
+
+    results = []
+    for upload in received:
+        if isinstance(upload, RejectedUpload):
+            results.append(BatchUploadResult(
+                name=upload.filename, status_code=upload.status_code, detail=upload.detail))
+        else:
+            file = next(stored)
+            results.append(BatchUploadResult(name=file.name, url=file.url))
+    return trusted(BatchUpload(files=results))
+
+
+@router.put("/me/{filename}", response_model=BaseFile)
+async def upload_user_file_raw(
+    filename: str,
+    request: Request,
+    user_id: User = Depends(get_current_user),
+):
+    """
+    Receives a file as the raw request body and stores in the user space, file is overwritten if exists.
+
+    Same as `POST /me` without the multipart/form-data parsing, the body is usually sent as application/octet-stream.
+    """
+    upload = await receive_stream(request, get_user_directory(user_id), filename)
+    return trusted(await run_in_threadpool(store_user_file, user_id, upload))
 
 
 @router.get("/f/{file_id}")
 def download_user_file(
     file_id: str,
+    request: Request,
     user_id: User = Depends(get_current_user),
-    token: HTTPAuthorizationCredentials = Security(security),
 ):
     """
     Downloads a file from the user.
     """
     # Find the user file
-    file_found = False
-    for file_data in db["users"][user_id]["files"]:
-        if file_data.id == file_id:
-            file_found = file_data
-            break
+    user = get_user(user_id)
+    file_found = user["files"].get(file_id)
 
     if not file_found:
         raise HTTPException(status_code=404, detail="Not found")
 
+    # The client already has this version of the file, it doesn't count against the quota
+    if file_found.checksum:
+        etag = checksum_etag(file_found.checksum)
+        if etag_matches(request.headers.get("if-none-match"), etag):
+            return not_modified(etag)
+
     # As described in the doc spec, the first download that surpases the quota limit, is accepted.
-    # For that reasom, we check the last quota, to determine if we need to update it.
-    # Lazy approach, reducing the number of times that we update current quota from 2 to less that 2 per request
-    if not db["users"][user_id]["quotas"]["by_download_traffic"] > 0:
-        update_current_quota(user_id)
+    # For that reason, we only check that there is some quota left before the download.
+    now = datetime.now()
+    quota = user["quotas"]["by_download_traffic"]
+    if not quota.remaining(now) > 0:
+        raise HTTPException(status_code=429, detail="Rate limit exceeded")
+
+    if settings.DOWNLOAD_OFFLOAD:
+        # The proxy opens the blob after this response, an upload of the user can't release it before
+        with user_locks(user_id):
+            file_found = user["files"].get(file_id)
+            if not file_found:
+                raise HTTPException(status_code=404, detail="Not found")
+            if file_found.checksum:
+                blob_store.incref(file_found.checksum)
+            user["files"].touch(file_id)
+        release_after_offload(file_found.checksum)
+        # The proxy sends the file, the bytes it sends aren't known so the whole file is charged
+        quota.consume(file_found.size, now, file_found.id)
+        return offload_response(file_found.route, file_found.name, file_found.media_type, file_found.checksum)
+
+    # The file is opened while no upload of the user can release its blob, the lock is only held for the lookup
+    with user_locks(user_id):
+        file_found = user["files"].get(file_id)
+        if not file_found:
+            raise HTTPException(status_code=404, detail="Not found")
+        source = open_file(file_found.route, file_found.checksum, file_found.size)
+        # Downloaded files are kept longer by the lru, lfu and size eviction policies
+        user["files"].touch(file_id)
+
+    # Only the bytes actually sent are added to the user quota, e.g. a resumed download pays the missing range
+    def consume_quota(sent: int):
+        quota.consume(sent, datetime.now(), file_found.id)
+
+    return file_response(
+        request,
+        path=file_found.route,
+        filename=file_found.name,
+        media_type=file_found.media_type,
+        checksum=file_found.checksum,
+        on_sent=consume_quota,
+        source=source
+    )
+
+@router.get("/me/archive")
+def download_user_archive(
+    ids: Optional[List[str]] = Query(None),
+    user_id: User = Depends(get_current_user),
+):
+    """
+    Downloads the files of the user in a ZIP archive, all of them or only the ones in `ids`.
 
-    # If we keep being limited by the quota, return an error
-    if not db["users"][user_id]["quotas"]["by_download_traffic"] > 0:
+    The archive is built while it's sent, the bytes sent are added to the download quota.
+    """
+    now = datetime.now()
+    user = get_user(user_id)
+    quota = user["quotas"]["by_download_traffic"]
+    if not quota.remaining(now) > 0:
         raise HTTPException(status_code=429, detail="Rate limit exceeded")
 
-    # Add a record to the last downloads and update the user quota
-    db["users"][user_id]["last_downloads"].append(
-        DownloadRecord(timestamp=datetime.now(), size=file_found.size, file_id=file_found.id))
-    update_current_quota(user_id)
+    # The archive holds a reference to the blob of each file until the file is written, so the
+    # files are only looked up under the lock and opened one by one while the archive is sent
+    with user_locks(user_id):
+        user_files = user["files"]
+        if ids is None:
+            files = list(user_files)
+        else:
+            files = [user_files.get(file_id) for file_id in dict.fromkeys(ids)]
+            if not all(files):
+                raise HTTPException(status_code=404, detail="Not found")
+        for file_found in files:
+            if file_found.checksum:
+                blob_store.incref(file_found.checksum)
+            user_files.touch(file_found.id)
+    entries = [
+        ArchiveEntry(file_found.name, file_found.route, file_found.checksum, file_found.size,
+                     not is_compressed(file_found.media_type))
+        for file_found in files
+    ]
+
+    def consume_quota(sent: int):
+        quota.consume(sent, datetime.now(), "archive")
+
+    def release_entry(entry: ArchiveEntry):
+        if entry.checksum:
+            blob_store.decref(entry.checksum)
+
+    return ZipArchiveResponse(entries, filename=f"{user_id}.zip", on_sent=consume_quota, release_entry=release_entry)
 
-    return FileResponse(path=file_found.route, filename=file_found.name, media_type=file_found.media_type)
 
 @router.get("/f/{file_id}/share", response_model=ShareUrl)
 def generate_user_file_share_url(
     file_id: str,
     user_id: User = Depends(get_current_user),
-    token: HTTPAuthorizationCredentials = Security(security),
 ):
     """
     Generates a shareable url to download a file from the user.
     """
-    # Find the user file
-    file_found = False
-    for file_data in db["users"][user_id]["files"]:
-        if file_data.id == file_id:
-            file_found = file_data
-            break
+    if settings.SHARE_LINK_FORMAT == "signed":
+        return generate_signed_share_url(file_id, user_id)
+
+    # Find the user file, an upload of the user can't release its blob until the link holds a reference
+    with user_locks(user_id):
+        file_found = db["users"][user_id]["files"].get(file_id)
+
+        if not file_found:
+            raise HTTPException(status_code=404, detail="Not found")
+
+        # The share link keeps the shared content alive, even if the file is overwritten or evicted
+        blob_store.incref(file_found.checksum)
 
-    if not file_found:
-        raise HTTPException(status_code=404, detail="Not found")
-    
     # Generate a new shareable link
     share_id= str(uuid.uuid4())[:6]
-    share_url = f"/s/{share_id}"
+    while share_id in db["share_links"]:  # Short ids can collide
+        share_id = str(uuid.uuid4())[:6]
+    expires_at = datetime.now() + timedelta(minutes=settings.SHARE_LINK_EXPIRE_MINUTES)
 
-    db["share_links"][share_id] = ShareUrlInDB(
-        share_url = share_url,
+    # Records are never changed once stored, the link references the current record of the file
+    share_link_data = ShareLinkRecord(
         id = share_id,
-        file = FileInDBBase(**dict(file_found)),
-        owner = user_id
+        file = file_found,
+        owner = user_id,
+        expires_at = expires_at
     )
+    db["share_links"].add(share_link_data)
+    journal.record("share_put", share_link_data)
+    expiry_index.schedule("share_link", share_id, expires_at)
+
+    return trusted(ShareUrl(share_url=share_link_data.share_url))
 
-    return ShareUrl(share_url=share_url)
+def generate_signed_share_url(file_id: str, user_id: str) -> ShareUrl:
+    """Returns a signed share link, nothing is stored (settings.SHARE_LINK_FORMAT == "signed").
+
+    The link carries the owner, the file id, the expiration and a random nonce. Unlike the stored
+    links, it downloads the version of the file at the time it's used, if the file still exists.
+    """
+    if file_id not in get_user(user_id)["files"]:
+        raise HTTPException(status_code=404, detail="Not found")
+
+    expires_at = datetime.now() + timedelta(minutes=settings.SHARE_LINK_EXPIRE_MINUTES)
+    nonce = os.urandom(8).hex()
+    token = sign(f"{user_id}:{file_id}:{int(expires_at.timestamp())}:{nonce}", purpose="share")
+    return trusted(ShareUrl(share_url=f"/s/{token}"))
 
 @router.get("/s/{share_id}")
 def download_share_url_file(
-    share_id: str
+    share_id: str,
+    request: Request
 ):
     """
     Downloads a file from the a sharing url.
     """
+    # Signed links carry their data, the stored ones are uuid prefixes, which never contain the separator
+    if "." in share_id:
+        return download_signed_share_url_file(share_id, request)
 
-    # Find the requested share_id data
-    share_link_data = db["share_links"].get(share_id)
+    # Find the requested share_id data, share links can be used once so the link is removed
+    share_link_data = db["share_links"].claim(share_id)
     if not share_link_data:
         raise HTTPException(status_code=404, detail="Not found")
-    
-    # Check if the share link has been used
-    if not share_link_data.valid:
+    journal.record("share_del", share_id)
+
+    keep_reference = False
+    try:
+        # Check if the share link has expired, the sweeper may not have removed it yet
+        if share_link_data.expires_at and datetime.now() >= share_link_data.expires_at:
+            raise HTTPException(status_code=404, detail="Not found")
+
+        # The download of the link is an access to the file of the owner, if it still exists
+        with user_locks(share_link_data.owner):
+            owner = db["users"].get(share_link_data.owner)
+            if owner is not None:
+                owner["files"].touch(share_link_data.file.id)
+
+        if settings.DOWNLOAD_OFFLOAD:
+            # The proxy opens the blob after this response, it's released once the proxy had time to open it
+            keep_reference = True
+            release_after_offload(share_link_data.file.checksum)
+            return offload_response(
+                share_link_data.file.route,
+                share_link_data.file.name,
+                share_link_data.file.media_type,
+                share_link_data.file.checksum
+            )
+
+        # Return the file
+        return file_response(
+            request,
+            path=share_link_data.file.route,
+            filename=share_link_data.file.name,
+            media_type=share_link_data.file.media_type,
+            checksum=share_link_data.file.checksum,
+            source=open_file(share_link_data.file.route, share_link_data.file.checksum, share_link_data.file.size)
+        )
+    finally:
+        # The blob can be deleted now, the response already holds the open file
+        if not keep_reference:
+            blob_store.decref(share_link_data.file.checksum)
+
+
+def validate_signed_share_link(token: str, datetime_now: datetime) -> Tuple[str, str]:
+    """Checks a signed share link and marks it as used.
+
+    Args:
+        token (str): Signed share link, without the `/s/` prefix.
+        datetime_now
+
+    Returns:
+        Tuple[str, str]: Owner and id of the shared file.
+    """
+    payload = unsign(token, purpose="share")
+    if payload is None:
+        raise HTTPException(status_code=404, detail="Not found")
+    owner, file_id, expires_at, nonce = payload.rsplit(":", 3)
+    expires_at = datetime.fromtimestamp(int(expires_at))
+    if datetime_now >= expires_at:
         raise HTTPException(status_code=404, detail="Not found")
-    
-    # Mark the share link as used
-    share_link_data.valid = False
-    db["share_links"][share_id] = share_link_data
 
-    # Return the file
-    return FileResponse(path=share_link_data.file.route, filename=share_link_data.file.name, media_type=share_link_data.file.media_type)
\ No newline at end of file
+    # Share links can be used once
+    if not db["used_share_nonces"].add(nonce, expires_at):
+        raise HTTPException(status_code=404, detail="Not found")
+    return owner, file_id
+
+
+def download_signed_share_url_file(token: str, request: Request) -> Response:
+    owner, file_id = validate_signed_share_link(token, datetime.now())
+    # The link doesn't hold a reference to the blob, it's opened while no upload of the owner can release it
+    with user_locks(owner):
+        user = db["users"].get(owner)
+        if user is None:
+            raise HTTPException(status_code=404, detail="Not found")
+        file_found = user["files"].get(file_id)
+        if not file_found:
+            raise HTTPException(status_code=404, detail="Not found")
+        user["files"].touch(file_id)
+        if settings.DOWNLOAD_OFFLOAD:
+            if file_found.checksum:
+                blob_store.incref(file_found.checksum)
+        else:
+            source = open_file(file_found.route, file_found.checksum, file_found.size)
+
+    if settings.DOWNLOAD_OFFLOAD:
+        release_after_offload(file_found.checksum)
+        return offload_response(file_found.route, file_found.name, file_found.media_type, file_found.checksum)
+    return file_response(
+        request,
+        path=file_found.route,
+        filename=file_found.name,
+        media_type=file_found.media_type,
+        checksum=file_found.checksum,
+        source=source
+    )
+
+
+def remove_share_link(share_id: str) -> bool:
+    share_link_data = db["share_links"].remove(share_id)
+    if share_link_data is None:
+        return False
+    journal.record("share_del", share_id)
+    blob_store.decref(share_link_data.file.checksum)
+    return True
+
+def release_after_offload(checksum: Optional[str]):
+    """Releases a reference to the blob of an offloaded download once the proxy had time to open it.
+
+    The caller took the reference while the blob couldn't be released, e.g. under the user lock.
+    """
+    if checksum:
+        release_at = datetime.now() + timedelta(seconds=settings.DOWNLOAD_OFFLOAD_GRACE_SECONDS)
+        expiry_index.schedule("blob_reference", checksum, release_at)
+
+def release_blob_reference(checksum: str) -> bool:
+    blob_store.decref(checksum)
+    return True
+
+expiry_index.register("share_link", remove_share_link)
+expiry_index.register("blob_reference", release_blob_reference)
@@ -0,0 +1,36 @@
+import hmac
+from typing import Optional
+
+from fastapi import APIRouter, Header, HTTPException
+from api.auth.deps import parse_bearer_token
+from api.config import settings
+from api.core.expiry import expiry_index
+from api.database import db
+from api.storage.blobs import blob_store
+from api.storage.deletions import deletion_queue
+from api.storage.fd_cache import fd_cache
+from api.storage.file_cache import file_cache
+
+router = APIRouter()
+
+@router.get("/stats", include_in_schema=False)
+def get_stats(authorization: Optional[str] = Header(None)):
+    """
+    Returns the internal counters of the api subsystems, for monitoring.
+
+    Only enabled with settings.STATS_TOKEN, which the monitoring sends as a bearer token.
+    """
+    if not settings.STATS_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    token = parse_bearer_token(authorization)
+    if not hmac.compare_digest(token.encode(), settings.STATS_TOKEN.encode()):
+        raise HTTPException(status_code=401, detail="invalid token")
+    return {
+        "expiry": expiry_index.stats(),
+        "blobs": blob_store.stats(),
+        "deletions": deletion_queue.stats(),
+        "file_cache": file_cache.stats(),
+        "fd_cache": fd_cache.stats(),
+        "used_share_nonces": db["used_share_nonces"].stats(),
+        "users": db["users"].stats(),
+    }
@@ -1,5 +1,5 @@
 
-from typing import List
+from typing import List, Optional
 from datetime import datetime
 from pydantic import BaseModel
 from api.schemas.user import User
@@ -8,6 +8,7 @@ class BaseFile(BaseModel):
     name: str
     url: str
 
+# The db keeps the records of api/storage/records.py, the *InDB models are only read from older journals
 class FileInDBBase(BaseFile):
     route: str
     id: str
@@ -15,22 +16,27 @@ class FileInDBBase(BaseFile):
 
 class FileInDB(FileInDBBase):
     size: int
+    checksum: Optional[str] = None # sha256 of the content
 
 class UserFiles(BaseModel):
     user: str
     files: List[BaseFile]
+    next_cursor: Optional[str] = None # Only for pages that are followed by more files
 
+class BatchUploadResult(BaseModel):
+    name: str
+    url: Optional[str] = None # Only for the stored files
+    status_code: int = 200
+    detail: Optional[str] = None
 
-class DownloadRecord(BaseModel):
-    timestamp: datetime
-    size: int
-    file_id: str
+class BatchUpload(BaseModel):
+    files: List[BatchUploadResult]
 
 class ShareUrl(BaseModel):
     share_url: str
 
 class ShareUrlInDB(ShareUrl):
     id: str
-    valid: bool = True
-    file: FileInDBBase
+    file: FileInDB
     owner: str
+    expires_at: Optional[datetime] = None
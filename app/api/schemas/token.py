@@ -1,5 +1,6 @@
 from pydantic import BaseModel
 from datetime import datetime
+from typing import Optional
 
 class Token(BaseModel):
     token: str
@@ -9,3 +10,4 @@ class TokenInDB(BaseModel):
     expires_at: datetime
     available_calls: int
     expired: bool = False
+    user_id: Optional[str] = None
@@ -0,0 +1,119 @@
+""" Content addressed blob store
+
+File contents are stored once, keyed by their sha256, no matter how many files
+(of any user) or share links point to them. Each blob keeps a reference count
+and is deleted from disk, by the deletion queue, after the last reference is released.
+"""
+import os
+import threading
+from contextlib import contextmanager
+
+from api.config import settings
+from api.storage.deletions import DeletionQueue, deletion_queue
+from api.storage.fd_cache import fd_cache
+from api.storage.file_cache import file_cache
+
+
+class RefCounts(dict):
+    """In memory reference counts, by checksum.
+
+    The blob files are created and deleted while `locked`, so a blob is never
+    deleted while another reference to it is being added.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def locked(self):
+        with self._lock:
+            yield
+
+    def incr(self, checksum: str) -> int:
+        self[checksum] = self.get(checksum, 0) + 1
+        return self[checksum]
+
+    def decr(self, checksum: str) -> int:
+        self[checksum] -= 1
+        if self[checksum] > 0:
+            return self[checksum]
+        del self[checksum]
+        return 0
+
+
+class BlobStore:
+    def __init__(self, root: str, refs=None, deletions: DeletionQueue = None):
+        self.root = root
+        self.refs = RefCounts() if refs is None else refs
+        self.deletions = deletion_queue if deletions is None else deletions
+
+    def path(self, checksum: str) -> str:
+        # Blobs are spread in subdirectories by the first byte of the checksum
+        return os.path.join(self.root, checksum[:2], checksum)
+
+    def put(self, temp_path: str, checksum: str) -> str:
+        """Adds a reference to the blob with the content of the temp file, storing it if it's new.
+
+        Args:
+            temp_path (str): File with the content, it's moved into the store or deleted if the blob exists.
+            checksum (str): sha256 hex digest of the content.
+
+        Returns:
+            str: Path of the blob.
+        """
+        path = self.path(checksum)
+        with self.refs.locked():
+            if self.refs.incr(checksum) > 1:
+                self.deletions.enqueue(temp_path)
+                return path
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(temp_path, path)
+        return path
+
+    def incref(self, checksum: str):
+        with self.refs.locked():
+            self.refs.incr(checksum)
+
+    def decref(self, checksum: str):
+        """ Releases a reference to the blob, the blob is deleted in the background after the last one """
+        with self.refs.locked():
+            if self.refs.decr(checksum) == 0:
+                self.deletions.enqueue(self.path(checksum), self._delete)
+
+    def collect(self, checksum: str):
+        """ Enqueues the blob for deletion, it's only deleted if nothing references it by then """
+        self.deletions.enqueue(self.path(checksum), self._delete)
+
+    def _delete(self, path: str):
+        # The same content can be uploaded again before the deletion queue gets to the blob
+        with self.refs.locked():
+            checksum = os.path.basename(path)
+            if not self.refs.get(checksum):
+                # Files of any user can share the blob, the cached content goes with the blob and not with a file
+                fd_cache.invalidate(path)
+                file_cache.invalidate(checksum)
+                os.remove(path)
+
+    def enqueue_orphans(self) -> int:
+        """ Enqueues for deletion the blobs on disk that nothing references, returns how many """
+        if not os.path.isdir(self.root):
+            return 0
+        orphans = 0
+        for directory in os.scandir(self.root):
+            if not directory.is_dir():
+                continue
+            for entry in os.scandir(directory.path):
+                if not self.refs.get(entry.name):
+                    self.deletions.enqueue(entry.path, self._delete)
+                    orphans += 1
+        return orphans
+
+    def stats(self) -> dict:
+        return {
+            "blobs": len(self.refs),
+            "references": sum(self.refs.values()),
+        }
+
+
+blob_store = BlobStore(settings.BLOBS_PATH)
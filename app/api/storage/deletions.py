@@ -0,0 +1,99 @@
+""" Deletion queue, files are removed from disk by a background task
+
+Requests only enqueue the files to remove (evicted and overwritten contents, temp files
+of duplicated uploads...), so their latency doesn't include the filesystem cleanup.
+The queue is drained in batches, failed deletions are retried up to DELETION_MAX_ATTEMPTS times.
+
+A file can be enqueued with its own delete function, e.g. the blob store checks that
+nothing references the blob again before removing it.
+"""
+import asyncio
+import logging
+import os
+import threading
+from collections import OrderedDict
+from typing import Callable, Optional, Tuple
+
+from starlette.concurrency import run_in_threadpool
+
+from api.config import settings
+
+logger = logging.getLogger(__name__)
+
+Delete = Callable[[str], None]
+
+
+class DeletionQueue:
+    def __init__(self, max_attempts: int = 5):
+        self.max_attempts = max_attempts
+        # Path -> (delete function, failed attempts), a path enqueued twice is removed once
+        self._pending: "OrderedDict[str, Tuple[Delete, int]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.deleted = 0
+        self.retried = 0
+        self.failed = 0
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def enqueue(self, path: str, delete: Optional[Delete] = None):
+        with self._lock:
+            if path not in self._pending:
+                self._pending[path] = (delete or os.remove, 0)
+
+    def drain(self, max_batch: int) -> int:
+        """Removes up to `max_batch` files from disk.
+
+        Returns:
+            int: Number of entries taken from the queue, including the failed ones.
+        """
+        taken = 0
+        retries = []
+        while taken < max_batch:
+            with self._lock:
+                if not self._pending:
+                    break
+                path, (delete, attempts) = self._pending.popitem(last=False)
+            taken += 1
+            try:
+                delete(path)
+            except FileNotFoundError:
+                pass
+            except OSError:
+                if attempts + 1 >= self.max_attempts:
+                    self.failed += 1
+                    logger.exception("Giving up deleting %s", path)
+                else:
+                    retries.append((path, delete, attempts + 1))
+                continue
+            self.deleted += 1
+
+        # Failed deletions are retried by the next batches, not by this one
+        with self._lock:
+            for path, delete, attempts in retries:
+                self._pending.setdefault(path, (delete, attempts))
+        self.retried += len(retries)
+        return taken
+
+    def stats(self) -> dict:
+        return {
+            "depth": len(self._pending),
+            "deleted": self.deleted,
+            "retried": self.retried,
+            "failed": self.failed,
+        }
+
+
+deletion_queue = DeletionQueue(settings.DELETION_MAX_ATTEMPTS)
+
+
+async def run_deletion_worker():
+    """ Background task, drains the deletion queue every DELETION_INTERVAL_MS """
+    while True:
+        try:
+            # Unlinks block, they run in the threadpool one batch at a time
+            while await run_in_threadpool(deletion_queue.drain, settings.DELETION_BATCH) == settings.DELETION_BATCH:
+                await asyncio.sleep(0)
+        except Exception:
+            logger.exception("Deletion queue drain failed")
+        await asyncio.sleep(settings.DELETION_INTERVAL_MS / 1000)
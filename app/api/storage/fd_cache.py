@@ -0,0 +1,115 @@
+""" Cache of open file descriptors of the blobs
+
+Downloads of the same blob share an open file descriptor and its stat, instead of
+opening and stat-ing the file on every request. Blobs never change once stored, an
+overwrite stores a new blob, so an entry is valid until the blob is deleted.
+
+The descriptors are reference counted: a descriptor evicted from the cache (LRU, up to
+FD_CACHE_MAX_ENTRIES) or invalidated while downloads are using it is closed by the last one.
+"""
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, NamedTuple
+
+from api.config import settings
+
+
+class OpenFile(NamedTuple):
+    fd: int
+    stat: os.stat_result
+
+
+class _Entry:
+    __slots__ = ("file", "users", "cached")
+
+    def __init__(self, file: OpenFile):
+        self.file = file
+        self.users = 0
+        self.cached = True
+
+
+class FdCache:
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._by_fd: Dict[int, _Entry] = {}  # Descriptors in use or cached
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def acquire(self, path: str) -> OpenFile:
+        """Returns the open file of the path, release it with `release` when done.
+
+        Raises:
+            FileNotFoundError: The file doesn't exist.
+        """
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None:
+                self._entries.move_to_end(path)
+                entry.users += 1
+                self.hits += 1
+                return entry.file
+            self.misses += 1
+
+        fd = os.open(path, os.O_RDONLY)
+        file = OpenFile(fd, os.fstat(fd))
+        if self.max_entries <= 0:
+            return file
+
+        with self._lock:
+            if path in self._entries:
+                # Opened by another request at the same time, keep the cached one
+                os.close(fd)
+                entry = self._entries[path]
+                entry.users += 1
+                return entry.file
+            entry = _Entry(file)
+            entry.users = 1
+            self._entries[path] = entry
+            self._by_fd[fd] = entry
+            while len(self._entries) > self.max_entries:
+                _, evicted = self._entries.popitem(last=False)
+                self._uncache(evicted)
+        return file
+
+    def release(self, file: OpenFile):
+        """ Releases a file returned by `acquire`, files not in the cache are closed """
+        with self._lock:
+            entry = self._by_fd.get(file.fd)
+            if entry is None or entry.file is not file:
+                os.close(file.fd)
+                return
+            entry.users -= 1
+            if not entry.cached and entry.users == 0:
+                del self._by_fd[file.fd]
+                os.close(file.fd)
+
+    def invalidate(self, path: str):
+        """ Removes the path from the cache, e.g. when the file is deleted """
+        with self._lock:
+            entry = self._entries.pop(path, None)
+            if entry is not None:
+                self._uncache(entry)
+
+    def _uncache(self, entry: _Entry):
+        # Called with the lock held, the descriptor is closed now or by the last download using it
+        entry.cached = False
+        if entry.users == 0:
+            del self._by_fd[entry.file.fd]
+            os.close(entry.file.fd)
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "open": len(self._by_fd),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+fd_cache = FdCache(settings.FD_CACHE_MAX_ENTRIES)
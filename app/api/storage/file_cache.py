@@ -0,0 +1,78 @@
+""" In memory cache of the content of small files
+
+Files up to FILE_CACHE_MAX_FILE_SIZE are kept in memory after their first download,
+so the next downloads are served without opening the file. Entries are keyed by the
+content checksum (blobs never change, an overwrite stores a new checksum) and the least
+recently used ones are evicted to keep the cache under FILE_CACHE_MAX_BYTES.
+An entry is only invalidated when the deletion queue removes its blob (see api/storage/blobs.py).
+"""
+import threading
+from collections import OrderedDict
+from typing import NamedTuple, Optional
+
+from api.config import settings
+
+
+class CachedFile(NamedTuple):
+    content: bytes
+    mtime: float  # Modification time of the file, for the Last-Modified header
+
+
+class FileCache:
+    def __init__(self, max_bytes: int, max_file_size: int):
+        self.max_bytes = max_bytes
+        self.max_file_size = max_file_size
+        self.size = 0  # Bytes of all the cached contents
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[str, CachedFile]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def accepts(self, size: int) -> bool:
+        """ Whether a file of `size` bytes can be cached """
+        return size <= self.max_file_size and size <= self.max_bytes
+
+    def get(self, key: str) -> Optional[CachedFile]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key: str, entry: CachedFile):
+        if not self.accepts(len(entry.content)):
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous.content)
+            self._entries[key] = entry
+            self.size += len(entry.content)
+            while self.size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted.content)
+
+    def invalidate(self, key: str):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.size -= len(entry.content)
+
+    def stats(self) -> dict:
+        requests = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / requests if requests else 0.0,
+        }
+
+
+file_cache = FileCache(settings.FILE_CACHE_MAX_BYTES, settings.FILE_CACHE_MAX_FILE_SIZE)
@@ -0,0 +1,273 @@
+""" Per-user file metadata store
+
+Files are kept in upload order and indexed by id, with a secondary index by name,
+so the routes never need to walk the whole list of files of a user.
+The eviction policy (see api/core/eviction.py) is kept up to date with every change.
+
+Pages of files (see `FileStore.page`) are read from sorted indexes by upload order, name,
+media type and size, so a page costs the same whatever the number of files of the user.
+"""
+import uuid
+from collections import OrderedDict
+from itertools import takewhile
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from api.core.eviction import FifoPolicy
+from api.core.sorted_keys import SortedKeys
+from api.storage.records import FileRecord
+
+MAX_SCAN_PER_FILE = 10  # A page looks at up to this many files per file returned
+
+
+class PageFilters:
+    """Filters of a page of files, all of them optional.
+
+    The files are walked in the order of the index that best narrows the filters, the `order`.
+    """
+
+    def __init__(self, name_prefix: str = None, media_type: str = None, min_size: int = None, max_size: int = None):
+        self.name_prefix = name_prefix
+        self.media_type = media_type
+        self.min_size = min_size
+        self.max_size = max_size
+        if name_prefix:
+            self.order = "name"
+        elif min_size is not None or max_size is not None:
+            self.order = "size"
+        elif media_type:
+            self.order = "media_type"
+        else:
+            self.order = "upload"
+
+    def matches(self, file: FileRecord) -> bool:
+        return (
+            (not self.name_prefix or file.name.startswith(self.name_prefix))
+            and (not self.media_type or file.media_type == self.media_type)
+            and (self.min_size is None or file.size >= self.min_size)
+            and (self.max_size is None or file.size <= self.max_size)
+        )
+
+
+def take_page(
+    candidates: Iterator[Tuple[Any, FileRecord]], filters: PageFilters, limit: int
+) -> Tuple[List[FileRecord], Optional[Any]]:
+    """Takes the files of a page from the candidates of the index, as (key, file) pairs in order.
+
+    Returns:
+        The files, and the key to start the next page after, None if there are no more files.
+    """
+    files = []
+    scanned = 0
+    key = None
+    for candidate_key, file in candidates:
+        # The next page starts after the last file looked at, even if it didn't match
+        if len(files) == limit or scanned == limit * MAX_SCAN_PER_FILE:
+            return files, key
+        key = candidate_key
+        scanned += 1
+        if filters.matches(file):
+            files.append(file)
+    return files, None
+
+
+class FileStore:
+    """Files of a single user, indexed by `id` and by `name`.
+
+    The primary index is an OrderedDict keyed by file id, which keeps the upload
+    order. The eviction policy chooses the file to remove with `pop_victim`.
+    """
+
+    def __init__(self, policy=None):
+        self._files: "OrderedDict[str, FileRecord]" = OrderedDict()
+        self.policy = FifoPolicy() if policy is None else policy
+        self._ids_by_name: Dict[str, str] = {}
+        # Sorted indexes for the pages, files are told apart by a sequence number in upload order
+        self._seqs: Dict[str, int] = {}
+        self._ids_by_seq: Dict[int, str] = {}
+        self._next_seq = 0
+        self._by_upload = SortedKeys()  # seq
+        self._by_name = SortedKeys()  # name
+        self._by_media_type = SortedKeys()  # (media_type, seq)
+        self._by_size = SortedKeys()  # (size, seq)
+        # Changes every time the list of files changes, the epoch tells apart stores with the same version
+        self.epoch = uuid.uuid4().hex[:8]
+        self.version = 0
+
+    @property
+    def etag(self) -> str:
+        """ Strong ETag of the list of files """
+        return f'"{self.epoch}-{self.version}"'
+
+    def __len__(self) -> int:
+        return len(self._files)
+
+    def __iter__(self) -> Iterator[FileRecord]:
+        """ Iterates the files from the oldest to the newest upload """
+        return iter(self._files.values())
+
+    def __contains__(self, file_id: str) -> bool:
+        return file_id in self._files
+
+    def get(self, file_id: str) -> Optional[FileRecord]:
+        return self._files.get(file_id)
+
+    def get_by_name(self, name: str) -> Optional[FileRecord]:
+        file_id = self._ids_by_name.get(name)
+        if file_id is None:
+            return None
+        return self._files[file_id]
+
+    def add(self, file: FileRecord):
+        """Adds a new file as the newest one.
+
+        Args:
+            file (FileRecord): File metadata, its id and name must not be already stored.
+        """
+        if file.id in self._files or file.name in self._ids_by_name:
+            raise ValueError(f"File {file.id} ({file.name}) already stored")
+        self._files[file.id] = file
+        self._ids_by_name[file.name] = file.id
+        self._seqs[file.id] = self._next_seq
+        self._ids_by_seq[self._next_seq] = file.id
+        self._by_upload.add(self._next_seq)
+        self._index(file, self._next_seq)
+        self._next_seq += 1
+        self.policy.add(file.id, file.size)
+        self.version += 1
+
+    def load(self, files: List[FileRecord]):
+        """Adds files as the newest ones, in order, as `put` would one by one.
+
+        The indexes of an empty store are sorted once instead, it restores the files of a user at startup.
+
+        Args:
+            files (list of FileRecord): File metadata, their ids and names must be unique.
+        """
+        if self._files or not files:
+            for file in files:
+                self.put(file)
+            return
+        ids = [file.id for file in files]
+        names = [file.name for file in files]
+        files_by_id = OrderedDict(zip(ids, files))
+        ids_by_name = dict(zip(names, ids))
+        if len(files_by_id) != len(files) or len(ids_by_name) != len(files):
+            raise ValueError("Files with the same id or name")
+        seqs = range(self._next_seq, self._next_seq + len(files))
+        self._files = files_by_id
+        self._ids_by_name = ids_by_name
+        self._seqs = dict(zip(ids, seqs))
+        self._ids_by_seq = dict(zip(seqs, ids))
+        self._by_upload.update(seqs)
+        self._by_name.update(names)
+        self._by_media_type.update(zip([file.media_type for file in files], seqs))
+        self._by_size.update(zip([file.size for file in files], seqs))
+        self._next_seq += len(files)
+        for file in files:
+            self.policy.add(file.id, file.size)
+        self.version += 1
+
+    def _index(self, file: FileRecord, seq: int):
+        self._by_name.add(file.name)
+        self._by_media_type.add((file.media_type, seq))
+        self._by_size.add((file.size, seq))
+
+    def _unindex(self, file: FileRecord, seq: int):
+        self._by_name.remove(file.name)
+        self._by_media_type.remove((file.media_type, seq))
+        self._by_size.remove((file.size, seq))
+
+    def _forget(self, file: FileRecord):
+        # Removes the file from the indexes, it's already removed from the primary one
+        del self._ids_by_name[file.name]
+        seq = self._seqs.pop(file.id)
+        del self._ids_by_seq[seq]
+        self._by_upload.remove(seq)
+        self._unindex(file, seq)
+
+    def put(self, file: FileRecord):
+        """ Adds the file, or replaces the stored file with the same id keeping its position """
+        previous = self._files.get(file.id)
+        if previous is None:
+            self.add(file)
+            return
+        if previous.name != file.name:
+            del self._ids_by_name[previous.name]
+            self._ids_by_name[file.name] = file.id
+            self.version += 1
+        seq = self._seqs[file.id]
+        self._unindex(previous, seq)
+        self._index(file, seq)
+        self._files[file.id] = file
+        self.policy.update(file.id, file.size)
+
+    def touch(self, file_id: str):
+        """ Tells the eviction policy that the file was downloaded """
+        if file_id in self._files:
+            self.policy.access(file_id)
+
+    def remove(self, file_id: str) -> FileRecord:
+        file = self._files.pop(file_id)
+        self._forget(file)
+        self.policy.remove(file_id)
+        self.version += 1
+        return file
+
+    def pop_victim(self) -> FileRecord:
+        """ Removes and returns the file chosen by the eviction policy """
+        file_id = self.policy.pop()
+        if file_id is None:
+            raise KeyError("pop_victim(): no files")
+        file = self._files.pop(file_id)
+        self._forget(file)
+        self.version += 1
+        return file
+
+    def page(self, filters: PageFilters, limit: int, after: Any = None) -> Tuple[List[FileRecord], Optional[Any]]:
+        """Returns a page of the files that match the filters.
+
+        The files are walked in `filters.order`, looking at up to MAX_SCAN_PER_FILE files per file
+        returned, so a page can have less than `limit` files and still be followed by more.
+
+        Args:
+            filters (PageFilters): Filters of the files.
+            limit (int): Maximum number of files of the page.
+            after (optional): Key returned with the previous page, None for the first page.
+
+        Returns:
+            The files, and the key to get the next page after, None if there are no more files.
+
+        Raises:
+            ValueError: `after` is not a key of the order of the filters.
+        """
+        files = self._files
+        if filters.order == "name":
+            if after is not None and not isinstance(after, str):
+                raise ValueError("Invalid page key")
+            names = takewhile(
+                lambda name: name.startswith(filters.name_prefix),
+                self._by_name.irange(filters.name_prefix if after is None else after, exclusive=after is not None))
+            candidates = ((name, files[self._ids_by_name[name]]) for name in names)
+        elif filters.order == "size":
+            if after is None:
+                start = (filters.min_size or 0, -1)
+            elif isinstance(after, list) and len(after) == 2 and all(isinstance(value, int) for value in after):
+                start = tuple(after)
+            else:
+                raise ValueError("Invalid page key")
+            keys = self._by_size.irange(start, exclusive=True)
+            if filters.max_size is not None:
+                keys = takewhile(lambda key: key[0] <= filters.max_size, keys)
+            candidates = (([size, seq], files[self._ids_by_seq[seq]]) for size, seq in keys)
+        else:
+            if after is not None and not isinstance(after, int):
+                raise ValueError("Invalid page key")
+            if filters.order == "media_type":
+                keys = takewhile(
+                    lambda key: key[0] == filters.media_type,
+                    self._by_media_type.irange((filters.media_type, -1 if after is None else after), exclusive=True))
+                seqs = (seq for _, seq in keys)
+            else:
+                seqs = self._by_upload.irange(-1 if after is None else after, exclusive=True)
+            candidates = ((seq, files[self._ids_by_seq[seq]]) for seq in seqs)
+        return take_page(candidates, filters, limit)
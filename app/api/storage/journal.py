@@ -0,0 +1,199 @@
+""" Write-ahead journal of the db mutations
+
+Every mutation of the db is appended to the journal as an `(op, args)` record,
+so the metadata survives restarts. Records are pickled one after the other in
+journal segments (`journal.<seq>`), fsynced in batches of `fsync_every` records
+or by the background task every JOURNAL_FSYNC_INTERVAL_MS.
+
+A snapshot is a compacted journal: the minimal records that rebuild the current state.
+Taking a snapshot starts a new segment, so the requests are never blocked while it's written,
+and removes the older segments. At startup the snapshot and the segments that follow it are replayed.
+The snapshot is written in columns: each run of up to SNAPSHOT_BATCH records of the same op is a
+single pickle of the lists of each argument, so a million records load in a few large pickles of
+plain values. Only the segments keep a pickle per record, they are appended one record at a time.
+
+Replaying a record twice must give the same state (e.g. "put" replaces, "delete" ignores missing keys),
+as a mutation made while the snapshot is taken can be both in the snapshot and in the new segment.
+The files are only read by this api, pickle is used because it's the fastest format to load.
+"""
+import asyncio
+import glob
+import logging
+import os
+import pickle
+import threading
+from itertools import groupby, islice, repeat
+from operator import itemgetter
+from typing import Any, Callable, Iterable, Iterator, Optional, Tuple
+
+from starlette.concurrency import run_in_threadpool
+
+from api.config import settings
+
+logger = logging.getLogger(__name__)
+
+Record = Tuple[str, tuple]
+
+SNAPSHOT_FILE = "snapshot"
+SEGMENT_PREFIX = "journal."
+SNAPSHOT_BATCH = 65536  # Records of a column batch of the snapshot
+
+
+class Journal:
+    def __init__(self):
+        self.directory: Optional[str] = None
+        self.fsync_every = 1
+        self.seq = 0
+        self.pending = 0  # Records written but not fsynced
+        self.records_since_snapshot = 0
+        self._file = None
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self._file is not None
+
+    def _segment_path(self, seq: int) -> str:
+        return os.path.join(self.directory, f"{SEGMENT_PREFIX}{seq}")
+
+    def _segments(self) -> Iterator[Tuple[int, str]]:
+        paths = glob.glob(os.path.join(self.directory, f"{SEGMENT_PREFIX}*"))
+        return iter(sorted((int(path.rsplit(".", 1)[1]), path) for path in paths))
+
+    def open(self, directory: str, fsync_every: int = 1):
+        """Opens the journal, the previous records are kept until `replay` and `snapshot` are called.
+
+        Args:
+            directory (str): Folder of the snapshot and the journal segments.
+            fsync_every (int): Number of records written before forcing them to disk.
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.fsync_every = fsync_every
+        self.seq = max((seq for seq, _ in self._segments()), default=0) + 1
+        self._file = open(self._segment_path(self.seq), "ab")
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._sync()
+                self._file.close()
+                self._file = None
+
+    def record(self, op: str, *args: Any):
+        """ Appends a mutation to the journal, does nothing if the journal is not enabled """
+        if self._file is None:
+            return
+        data = pickle.dumps((op, args), protocol=pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            self._file.write(data)
+            self.pending += 1
+            self.records_since_snapshot += 1
+            if self.pending >= self.fsync_every:
+                self._sync()
+
+    def _sync(self):
+        if self.pending:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self.pending = 0
+
+    def sync(self):
+        """ Forces the written records to disk """
+        with self._lock:
+            if self._file is not None:
+                self._sync()
+
+    @staticmethod
+    def _read(path: str) -> Iterator[Record]:
+        with open(path, "rb") as file:
+            while True:
+                try:
+                    # Each record is a separate pickle, they don't share the memo
+                    yield pickle.load(file)
+                except EOFError:
+                    return
+                except (pickle.UnpicklingError, ValueError, TypeError):
+                    # Torn write of the last record on a crash, the rest of the file is lost
+                    logger.warning("Truncated journal record in %s", path)
+                    return
+
+    def replay(self) -> Iterator[Record]:
+        """ Yields the records of the snapshot and the journal segments written after it """
+        snapshot_path = os.path.join(self.directory, SNAPSHOT_FILE)
+        first_seq = 0
+        if os.path.exists(snapshot_path):
+            records = self._read(snapshot_path)
+            header = next(records, None)
+            if header is not None:
+                first_seq = header[1][0]  # ("snapshot", (seq,))
+                for op, args in records:
+                    if op == "columns":
+                        # ("columns", (op, count, [column of each argument]))
+                        op, count, columns = args
+                        yield from zip(repeat(op), zip(*columns) if columns else repeat((), count))
+                    else:
+                        yield op, args
+        for seq, path in self._segments():
+            if first_seq <= seq < self.seq:
+                yield from self._read(path)
+
+    def snapshot(self, capture: Callable[[], Iterable[Record]]):
+        """Writes a snapshot of the current state and removes the segments it replaces.
+
+        Args:
+            capture (Callable): Returns the records that rebuild the current state. It's called
+                while the journal is locked, so it must only copy references, the records are
+                pickled after the lock is released.
+        """
+        with self._lock:
+            self._sync()
+            self._file.close()
+            self.seq += 1
+            self._file = open(self._segment_path(self.seq), "ab")
+            self.records_since_snapshot = 0
+            records = capture()
+            snapshot_seq = self.seq
+
+        snapshot_path = os.path.join(self.directory, SNAPSHOT_FILE)
+        temp_path = f"{snapshot_path}.tmp"
+        with open(temp_path, "wb") as file:
+            file.write(pickle.dumps(("snapshot", (snapshot_seq,)), protocol=pickle.HIGHEST_PROTOCOL))
+            for op, batch in groupby(records, key=itemgetter(0)):
+                while True:
+                    args = [args for _, args in islice(batch, SNAPSHOT_BATCH)]
+                    if not args:
+                        break
+                    if len(set(map(len, args))) > 1:
+                        # The arguments don't fit in columns, each record is written as in the segments
+                        for record_args in args:
+                            file.write(pickle.dumps((op, record_args), protocol=pickle.HIGHEST_PROTOCOL))
+                        continue
+                    columns = [list(column) for column in zip(*args)]
+                    pickler = pickle.Pickler(file, protocol=pickle.HIGHEST_PROTOCOL)
+                    # Without the memo, the columns are millions of distinct plain values and have no cycles
+                    pickler.fast = True
+                    pickler.dump(("columns", (op, len(args), columns)))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, snapshot_path)
+
+        for seq, path in self._segments():
+            if seq < snapshot_seq:
+                os.remove(path)
+
+
+journal = Journal()
+
+
+async def run_journal_maintenance(capture: Callable[[], Iterable[Record]]):
+    """ Background task, fsyncs the pending records and takes a snapshot every JOURNAL_SNAPSHOT_EVERY records """
+    while True:
+        await asyncio.sleep(settings.JOURNAL_FSYNC_INTERVAL_MS / 1000)
+        try:
+            if journal.pending:
+                await run_in_threadpool(journal.sync)
+            if journal.records_since_snapshot >= settings.JOURNAL_SNAPSHOT_EVERY:
+                await run_in_threadpool(journal.snapshot, capture)
+        except Exception:
+            logger.exception("Journal maintenance failed")
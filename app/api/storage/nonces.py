@@ -0,0 +1,93 @@
+""" Used nonces of the signed share links, so each link can only be used once
+
+The nonces are kept in a rotating Bloom filter: two generations of a fixed size, each one
+covering SHARE_LINK_EXPIRE_MINUTES. A nonce is added to the current generation and looked up
+in both, the oldest generation is dropped when the current one is full of time. A link expires
+before the generation with its nonce is dropped, so the memory is constant whatever the rate of links.
+
+A Bloom filter can have false positives: an unused link is rejected as used with a probability
+that depends on the filter size, e.g. about 0.2% with 1 MiB per generation and 500k links used
+in SHARE_LINK_EXPIRE_MINUTES. It never has false negatives, a link is never used twice.
+"""
+import hashlib
+import struct
+import threading
+import time
+from datetime import datetime
+from typing import Optional
+
+from api.config import settings
+
+HASHES = 4
+
+
+class _BloomFilter:
+    def __init__(self, size: int):
+        self.bits = bytearray(size)
+        self.size = size * 8
+        self.count = 0
+
+    def indexes(self, nonce: str):
+        digest = hashlib.blake2b(nonce.encode(), digest_size=4 * HASHES).digest()
+        return [index % self.size for index in struct.unpack(f"<{HASHES}I", digest)]
+
+    def contains(self, indexes) -> bool:
+        return all(self.bits[index >> 3] & (1 << (index & 7)) for index in indexes)
+
+    def add(self, indexes):
+        for index in indexes:
+            self.bits[index >> 3] |= 1 << (index & 7)
+        self.count += 1
+
+
+class UsedNonces:
+    def __init__(self, size: int, period_seconds: float):
+        """
+        Args:
+            size (int): Bytes of each generation of the filter.
+            period_seconds (float): Time covered by each generation, at least the lifetime of a link.
+        """
+        self.size = size
+        self.period = period_seconds
+        self._current = _BloomFilter(size)
+        self._previous: Optional[_BloomFilter] = None
+        self._started_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _rotate(self, now: float):
+        elapsed = now - self._started_at
+        if elapsed < self.period:
+            return
+        # After two periods without rotating, both generations only have expired links
+        self._previous = self._current if elapsed < 2 * self.period else None
+        self._current = _BloomFilter(self.size)
+        self._started_at = now
+
+    def add(self, nonce: str, expires_at: datetime = None) -> bool:
+        """Marks the nonce as used.
+
+        Args:
+            nonce (str): Nonce of the link.
+            expires_at (datetime, optional): Expiration of the link, the generations already cover it.
+
+        Returns:
+            bool: True if the nonce was not used before.
+        """
+        with self._lock:
+            self._rotate(time.monotonic())
+            indexes = self._current.indexes(nonce)
+            if self._current.contains(indexes) or (self._previous is not None and self._previous.contains(indexes)):
+                return False
+            self._current.add(indexes)
+            return True
+
+    def stats(self) -> dict:
+        return {
+            "bytes": self.size * (2 if self._previous is not None else 1),
+            "current": self._current.count,
+            "previous": self._previous.count if self._previous is not None else 0,
+        }
+
+
+def create_used_nonces() -> UsedNonces:
+    return UsedNonces(settings.SHARE_LINK_NONCE_FILTER_SIZE, settings.SHARE_LINK_EXPIRE_MINUTES * 60)
@@ -0,0 +1,148 @@
+""" Compact records of the in memory db
+
+A pydantic model carries a `__dict__` and a `__fields_set__` set per instance, which is most
+of its memory when the db holds millions of files. The stores keep these `__slots__` classes
+instead, and pydantic models are only built at the API boundary (requests and responses):
+    - Media types are interned, all the files of a type share the same string.
+    - Urls are derived from the ids, and the route of a file in the blob store from its checksum.
+    - Share links reference the record of the shared file, records are never changed once
+      stored (an overwrite stores a new record), so the link keeps the content it was created with.
+
+Records are pickled by the journal with their constructor arguments, the files with their
+`state`, which is restored without computing the route again. The snapshots store the files of
+a user in columns of their `state` fields, `restore_files` sets each field of all of them at once. The schemas of api/schemas that
+older journals contain are converted with `file_record`, `token_record` and `share_link_record`.
+"""
+import sys
+from collections import deque
+from datetime import datetime
+from itertools import repeat
+from operator import attrgetter
+from typing import List, Optional
+
+from api.storage.blobs import blob_store
+
+
+class FileRecord:
+    __slots__ = ("id", "name", "media_type", "size", "checksum", "_route", "_json")
+
+    def __init__(self, id: str, name: str, route: str, media_type: str, size: int, checksum: Optional[str] = None):
+        self.id = id
+        self.name = name
+        self.media_type = sys.intern(media_type)
+        self.size = size
+        self.checksum = checksum  # sha256 of the content
+        # Only the routes outside of the blob store are kept
+        self._route = None if checksum is not None and route == blob_store.path(checksum) else route
+        self._json = None  # BaseFile JSON of the record, see api/fast_json.py
+
+    @property
+    def route(self) -> str:
+        return self._route if self._route is not None else blob_store.path(self.checksum)
+
+    @property
+    def url(self) -> str:
+        return f"/f/{self.id}"
+
+    def replace(self, **changes) -> "FileRecord":
+        """ Returns a new record with the changed fields, e.g. `file.replace(size=10)` """
+        fields = dict(id=self.id, name=self.name, route=self.route, media_type=self.media_type,
+                      size=self.size, checksum=self.checksum)
+        fields.update(changes)
+        return FileRecord(**fields)
+
+    def state(self) -> tuple:
+        """ Fields of the record as stored, rebuilt with `restore_file` or `restore_files` """
+        return self.id, self.name, self._route, self.media_type, self.size, self.checksum
+
+    def __reduce__(self):
+        return restore_file, self.state()
+
+    def __repr__(self) -> str:
+        return f"FileRecord(id={self.id!r}, name={self.name!r}, size={self.size})"
+
+
+class TokenRecord:
+    __slots__ = ("id", "expires_at", "available_calls", "user_id")
+
+    def __init__(self, id: str, expires_at: datetime, available_calls: int, user_id: Optional[str] = None):
+        self.id = id
+        self.expires_at = expires_at
+        self.available_calls = available_calls
+        self.user_id = user_id
+
+    def __reduce__(self):
+        return TokenRecord, (self.id, self.expires_at, self.available_calls, self.user_id)
+
+
+class ShareLinkRecord:
+    __slots__ = ("id", "file", "owner", "expires_at")
+
+    def __init__(self, id: str, file: FileRecord, owner: str, expires_at: Optional[datetime] = None):
+        self.id = id
+        self.file = file
+        self.owner = owner
+        self.expires_at = expires_at
+
+    @property
+    def share_url(self) -> str:
+        return f"/s/{self.id}"
+
+    def __reduce__(self):
+        return ShareLinkRecord, (self.id, self.file, self.owner, self.expires_at)
+
+
+def restore_file(
+    id: str, name: str, route: Optional[str], media_type: str, size: int, checksum: Optional[str]
+) -> FileRecord:
+    """ Returns the record of a `FileRecord.state`, a million of them are restored at startup """
+    file = FileRecord.__new__(FileRecord)
+    file.id = id
+    file.name = name
+    file._route = route
+    file.media_type = sys.intern(media_type)
+    file.size = size
+    file.checksum = checksum
+    file._json = None
+    return file
+
+
+def file_columns(files: List[FileRecord]) -> List[list]:
+    """ Returns the columns of the fields of `FileRecord.state` of the files, restored with `restore_files` """
+    return [list(map(attrgetter(field), files)) for field in ("id", "name", "_route", "media_type", "size", "checksum")]
+
+
+def restore_files(
+    ids: List[str], names: List[str], routes: List[Optional[str]], media_types: List[str], sizes: List[int],
+    checksums: List[Optional[str]]
+) -> List[FileRecord]:
+    """ Returns the records of the columns of the fields of `FileRecord.state`, set a column at a time """
+    files = list(map(FileRecord.__new__, repeat(FileRecord, len(ids))))
+    for field, column in (
+        (FileRecord.id, ids), (FileRecord.name, names), (FileRecord._route, routes),
+        (FileRecord.media_type, map(sys.intern, media_types)), (FileRecord.size, sizes),
+        (FileRecord.checksum, checksums), (FileRecord._json, repeat(None)),
+    ):
+        deque(map(field.__set__, files, column), 0)
+    return files
+
+
+def file_record(file) -> FileRecord:
+    """ Returns the record of a file, converting the FileInDB of older journals """
+    if isinstance(file, FileRecord):
+        return file
+    return FileRecord(file.id, file.name, file.route, file.media_type, file.size, file.checksum)
+
+
+def token_record(token) -> TokenRecord:
+    """ Returns the record of a token, converting the TokenInDB of older journals """
+    if isinstance(token, TokenRecord):
+        return token
+    return TokenRecord(token.id, token.expires_at, token.available_calls, token.user_id)
+
+
+def share_link_record(share_link) -> ShareLinkRecord:
+    """ Returns the record of a share link, converting the ShareUrlInDB of older journals """
+    if isinstance(share_link, ShareLinkRecord):
+        return share_link
+    return ShareLinkRecord(share_link.id, file_record(share_link.file), share_link.owner, share_link.expires_at)
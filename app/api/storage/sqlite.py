@@ -0,0 +1,653 @@
+""" SQLite backend for the state shared by several worker processes
+
+With settings.STATE_BACKEND == "sqlite", registered users, files, access tokens, signed token counters,
+share links, blob references and download quotas live in a single SQLite database in
+WAL mode, so every Gunicorn worker sees the same state. The classes implement the same
+methods as the in memory stores, and the read-modify-write operations (token calls,
+share link claims, reference counts, quotas) run in `BEGIN IMMEDIATE` transactions,
+which are atomic across processes.
+
+Each thread uses its own connection, as sqlite3 connections can't be shared between threads.
+"""
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from typing import Any, Iterator, List, Optional, Tuple
+
+from api.config import settings
+from api.storage.file_store import PageFilters
+from api.storage.records import FileRecord, ShareLinkRecord, TokenRecord
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS files (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id TEXT NOT NULL,
+    id TEXT NOT NULL,
+    name TEXT NOT NULL,
+    url TEXT NOT NULL,
+    route TEXT NOT NULL,
+    media_type TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    checksum TEXT,
+    -- Fed to the eviction policy
+    size_class INTEGER NOT NULL DEFAULT 0,
+    hits INTEGER NOT NULL DEFAULT 0,
+    last_access REAL NOT NULL DEFAULT 0,
+    UNIQUE (user_id, id),
+    UNIQUE (user_id, name)
+);
+CREATE TABLE IF NOT EXISTS file_versions (
+    user_id TEXT PRIMARY KEY,
+    version INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS tokens (
+    id TEXT PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    expires_at REAL NOT NULL,
+    available_calls INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS users (
+    user_id TEXT PRIMARY KEY,
+    password_hash BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS token_calls (
+    nonce TEXT PRIMARY KEY,
+    calls INTEGER NOT NULL,
+    expires_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS share_links (
+    id TEXT PRIMARY KEY,
+    share_url TEXT NOT NULL,
+    owner TEXT NOT NULL,
+    expires_at REAL,
+    file_id TEXT NOT NULL,
+    name TEXT NOT NULL,
+    url TEXT NOT NULL,
+    route TEXT NOT NULL,
+    media_type TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    checksum TEXT
+);
+CREATE TABLE IF NOT EXISTS blob_refs (
+    checksum TEXT PRIMARY KEY,
+    refs INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS quotas (
+    user_id TEXT PRIMARY KEY,
+    amount REAL NOT NULL,
+    updated_at REAL
+);
+CREATE TABLE IF NOT EXISTS downloads (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id TEXT NOT NULL,
+    timestamp REAL NOT NULL,
+    size INTEGER NOT NULL,
+    file_id TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS used_nonces (
+    nonce TEXT PRIMARY KEY,
+    expires_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS used_nonces_by_expiration ON used_nonces (expires_at);
+CREATE INDEX IF NOT EXISTS files_by_access ON files (user_id, last_access, seq);
+CREATE INDEX IF NOT EXISTS files_by_hits ON files (user_id, hits, last_access, seq);
+CREATE INDEX IF NOT EXISTS files_by_size ON files (user_id, size_class DESC, last_access, seq);
+-- Pages of files, the index by name is the unique constraint
+CREATE INDEX IF NOT EXISTS files_by_upload ON files (user_id, seq);
+CREATE INDEX IF NOT EXISTS files_by_media_type ON files (user_id, media_type, seq);
+CREATE INDEX IF NOT EXISTS files_by_exact_size ON files (user_id, size, seq);
+CREATE INDEX IF NOT EXISTS downloads_by_user ON downloads (user_id, timestamp);
+"""
+
+FILE_COLUMNS = "id, name, url, route, media_type, size, checksum"
+
+# Order of the files to evict of each policy, same as the ones of api/core/eviction.py
+EVICTION_ORDER = {
+    "fifo": "seq",
+    "lru": "last_access, seq",
+    "lfu": "hits, last_access, seq",
+    "size": "size_class DESC, last_access, seq",
+}
+
+# Columns of the order of the pages of files, see api.storage.file_store.PageFilters
+PAGE_ORDER = {
+    "upload": ["seq"],
+    "media_type": ["seq"],
+    "name": ["name"],
+    "size": ["size", "seq"],
+}
+
+
+def _file(row: tuple) -> FileRecord:
+    # The url column is not read, records derive the url from the id
+    return FileRecord(row[0], row[1], row[3], row[4], row[5], row[6])
+
+
+def _timestamp(value: Optional[datetime]) -> Optional[float]:
+    return value.timestamp() if value is not None else None
+
+
+def _datetime(value: Optional[float]) -> Optional[datetime]:
+    return datetime.fromtimestamp(value) if value is not None else None
+
+
+class SqliteState:
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        self.connection.executescript(SCHEMA)
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            # Autocommit mode, transactions are explicit
+            connection = sqlite3.connect(self.path, isolation_level=None, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        """Write transaction, it takes the database write lock from the start.
+
+        A transaction opened inside another one of the same thread joins it, the outer
+        transaction commits or rolls back all the changes.
+        """
+        connection = self.connection
+        if connection.in_transaction:
+            yield connection
+            return
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield connection
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    def shared_value(self, key: str, default: str) -> str:
+        """ Returns the value stored for the key, storing `default` if it's the first process asking """
+        with self.transaction() as connection:
+            connection.execute("INSERT OR IGNORE INTO meta (key, value) VALUES (?, ?)", (key, default))
+            return connection.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()[0]
+
+    def remove_expired(self, now: datetime):
+        """ Removes the tokens expired while no worker was running to sweep them """
+        with self.transaction() as connection:
+            connection.execute("DELETE FROM tokens WHERE expires_at <= ?", (now.timestamp(),))
+            connection.execute("DELETE FROM token_calls WHERE expires_at <= ?", (now.timestamp(),))
+
+
+class SqliteFileStore:
+    """ Same methods as api.storage.file_store.FileStore, for the files of a user """
+
+    def __init__(self, state: SqliteState, user_id: str, policy: str = "fifo"):
+        if policy not in EVICTION_ORDER:
+            raise ValueError(f"Unknown EVICTION_POLICY: {policy}")
+        self.state = state
+        self.user_id = user_id
+        self.policy = policy
+        self.epoch = state.shared_value("files_epoch", uuid.uuid4().hex[:8])
+
+    def _query(self, sql: str, *args) -> List[tuple]:
+        return self.state.connection.execute(sql, (self.user_id, *args)).fetchall()
+
+    @property
+    def version(self) -> int:
+        rows = self._query("SELECT version FROM file_versions WHERE user_id = ?")
+        return rows[0][0] if rows else 0
+
+    @property
+    def etag(self) -> str:
+        return f'"{self.epoch}-{self.version}"'
+
+    def _bump_version(self, connection: sqlite3.Connection):
+        connection.execute(
+            "INSERT INTO file_versions (user_id, version) VALUES (?, 1) "
+            "ON CONFLICT (user_id) DO UPDATE SET version = version + 1", (self.user_id,))
+
+    def __len__(self) -> int:
+        return self._query("SELECT COUNT(*) FROM files WHERE user_id = ?")[0][0]
+
+    def __iter__(self) -> Iterator[FileRecord]:
+        return iter([_file(row) for row in self._query(
+            f"SELECT {FILE_COLUMNS} FROM files WHERE user_id = ? ORDER BY seq")])
+
+    def __contains__(self, file_id: str) -> bool:
+        return bool(self._query("SELECT 1 FROM files WHERE user_id = ? AND id = ?", file_id))
+
+    def get(self, file_id: str) -> Optional[FileRecord]:
+        rows = self._query(f"SELECT {FILE_COLUMNS} FROM files WHERE user_id = ? AND id = ?", file_id)
+        return _file(rows[0]) if rows else None
+
+    def get_by_name(self, name: str) -> Optional[FileRecord]:
+        rows = self._query(f"SELECT {FILE_COLUMNS} FROM files WHERE user_id = ? AND name = ?", name)
+        return _file(rows[0]) if rows else None
+
+    def _insert(self, connection: sqlite3.Connection, file: FileRecord):
+        connection.execute(
+            f"INSERT INTO files (user_id, {FILE_COLUMNS}, size_class, last_access) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (self.user_id, file.id, file.name, file.url, file.route, file.media_type, file.size, file.checksum,
+             file.size.bit_length(), time.time()))
+        self._bump_version(connection)
+
+    def add(self, file: FileRecord):
+        try:
+            with self.state.transaction() as connection:
+                self._insert(connection, file)
+        except sqlite3.IntegrityError:
+            raise ValueError(f"File {file.id} ({file.name}) already stored")
+
+    def put(self, file: FileRecord):
+        """ Adds the file, or replaces the stored file with the same id keeping its position """
+        with self.state.transaction() as connection:
+            row = connection.execute(
+                "SELECT name FROM files WHERE user_id = ? AND id = ?", (self.user_id, file.id)).fetchone()
+            if row is None:
+                self._insert(connection, file)
+                return
+            connection.execute(
+                "UPDATE files SET name = ?, url = ?, route = ?, media_type = ?, size = ?, checksum = ?, size_class = ? "
+                "WHERE user_id = ? AND id = ?",
+                (file.name, file.url, file.route, file.media_type, file.size, file.checksum, file.size.bit_length(),
+                 self.user_id, file.id))
+            if self.policy == "lru":
+                self._touch(connection, file.id)
+            if row[0] != file.name:
+                self._bump_version(connection)
+
+    def _touch(self, connection: sqlite3.Connection, file_id: str):
+        connection.execute(
+            "UPDATE files SET hits = hits + 1, last_access = ? WHERE user_id = ? AND id = ?",
+            (time.time(), self.user_id, file_id))
+
+    def touch(self, file_id: str):
+        """ Tells the eviction policy that the file was downloaded """
+        if self.policy != "fifo":
+            with self.state.transaction() as connection:
+                self._touch(connection, file_id)
+
+    def _pop(self, where: str, *args, order: str = "seq") -> Optional[FileRecord]:
+        with self.state.transaction() as connection:
+            row = connection.execute(
+                f"SELECT seq, {FILE_COLUMNS} FROM files WHERE user_id = ? {where} ORDER BY {order} LIMIT 1",
+                (self.user_id, *args)).fetchone()
+            if row is None:
+                return None
+            connection.execute("DELETE FROM files WHERE seq = ?", (row[0],))
+            self._bump_version(connection)
+            return _file(row[1:])
+
+    def remove(self, file_id: str) -> FileRecord:
+        file = self._pop("AND id = ?", file_id)
+        if file is None:
+            raise KeyError(file_id)
+        return file
+
+    def pop_victim(self) -> FileRecord:
+        """ Removes and returns the file chosen by the eviction policy """
+        file = self._pop("", order=EVICTION_ORDER[self.policy])
+        if file is None:
+            raise KeyError("pop_victim(): no files")
+        return file
+
+    def page(self, filters: PageFilters, limit: int, after: Any = None) -> Tuple[List[FileRecord], Optional[Any]]:
+        """ Returns a page of the files that match the filters, read in the order of one of the indexes """
+        conditions, args = [], []
+        if filters.name_prefix:
+            conditions.append("name >= ? AND substr(name, 1, ?) = ?")
+            args += [filters.name_prefix, len(filters.name_prefix), filters.name_prefix]
+            if filters.name_prefix[-1] != "\U0010ffff":
+                # Names are compared as UTF-8 bytes, in code point order like python strings
+                conditions.append("name < ?")
+                args.append(filters.name_prefix[:-1] + chr(ord(filters.name_prefix[-1]) + 1))
+        if filters.media_type:
+            conditions.append("media_type = ?")
+            args.append(filters.media_type)
+        if filters.min_size is not None:
+            conditions.append("size >= ?")
+            args.append(filters.min_size)
+        if filters.max_size is not None:
+            conditions.append("size <= ?")
+            args.append(filters.max_size)
+
+        columns = PAGE_ORDER[filters.order]
+        if after is not None:
+            values = after if filters.order == "size" else [after]
+            types = (int, int) if filters.order == "size" else (str,) if filters.order == "name" else (int,)
+            if not isinstance(values, list) or len(values) != len(types) or not all(
+                    isinstance(value, kind) and not isinstance(value, bool) for value, kind in zip(values, types)):
+                raise ValueError("Invalid page key")
+            conditions.append(f"({', '.join(columns)}) > ({', '.join('?' for _ in columns)})")
+            args += values
+
+        where = "".join(f" AND {condition}" for condition in conditions)
+        rows = self._query(
+            f"SELECT {', '.join(columns)}, {FILE_COLUMNS} FROM files WHERE user_id = ?{where} "
+            f"ORDER BY {', '.join(columns)} LIMIT ?", *args, limit + 1)
+        files = [_file(row[len(columns):]) for row in rows[:limit]]
+        if len(rows) <= limit:
+            return files, None
+        last = rows[limit - 1][:len(columns)]
+        return files, list(last) if filters.order == "size" else last[0]
+
+
+class SqliteTokenStore:
+    """ Same methods as api.storage.stores.TokenStore, the tokens of all the users """
+
+    def __init__(self, state: SqliteState):
+        self.state = state
+
+    @staticmethod
+    def _token(row: tuple) -> TokenRecord:
+        return TokenRecord(row[0], _datetime(row[1]), row[2], row[3])
+
+    def __len__(self) -> int:
+        return self.state.connection.execute("SELECT COUNT(*) FROM tokens").fetchone()[0]
+
+    def values(self) -> List[TokenRecord]:
+        return [self._token(row) for row in self.state.connection.execute(
+            "SELECT id, expires_at, available_calls, user_id FROM tokens")]
+
+    def add(self, token: TokenRecord):
+        with self.state.transaction() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO tokens (id, user_id, expires_at, available_calls) VALUES (?, ?, ?, ?)",
+                (token.id, token.user_id, token.expires_at.timestamp(), token.available_calls))
+
+    def get(self, token_id: str) -> Optional[TokenRecord]:
+        row = self.state.connection.execute(
+            "SELECT id, expires_at, available_calls, user_id FROM tokens WHERE id = ?", (token_id,)).fetchone()
+        return self._token(row) if row else None
+
+    def consume_call(self, token_id: str) -> Optional[int]:
+        with self.state.transaction() as connection:
+            cursor = connection.execute(
+                "UPDATE tokens SET available_calls = available_calls - 1 "
+                "WHERE id = ? AND available_calls > 0", (token_id,))
+            if cursor.rowcount == 0:
+                return None
+            return connection.execute(
+                "SELECT available_calls FROM tokens WHERE id = ?", (token_id,)).fetchone()[0]
+
+    def remove(self, token_id: str) -> bool:
+        with self.state.transaction() as connection:
+            return connection.execute("DELETE FROM tokens WHERE id = ?", (token_id,)).rowcount > 0
+
+
+class SqliteUserRegistry:
+    """ Same methods as api.storage.users.UserRegistry, shared by all the workers """
+
+    def __init__(self, state: SqliteState):
+        self.state = state
+
+    def __len__(self) -> int:
+        return self.state.connection.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+
+    def __contains__(self, user_id: str) -> bool:
+        return self.state.connection.execute(
+            "SELECT 1 FROM users WHERE user_id = ?", (user_id,)).fetchone() is not None
+
+    def items(self) -> Iterator[Tuple[str, bytes]]:
+        return iter(self.state.connection.execute("SELECT user_id, password_hash FROM users").fetchall())
+
+    def add(self, user_id: str, password_hash: bytes) -> bool:
+        with self.state.transaction() as connection:
+            return connection.execute(
+                "INSERT OR IGNORE INTO users (user_id, password_hash) VALUES (?, ?)",
+                (user_id, password_hash)).rowcount > 0
+
+    def put(self, user_id: str, password_hash: bytes):
+        with self.state.transaction() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO users (user_id, password_hash) VALUES (?, ?)", (user_id, password_hash))
+
+    def get(self, user_id: str) -> Optional[bytes]:
+        row = self.state.connection.execute(
+            "SELECT password_hash FROM users WHERE user_id = ?", (user_id,)).fetchone()
+        return row[0] if row else None
+
+
+class SqliteCallCounters:
+    """ Same methods as api.storage.stores.CallCounters """
+
+    def __init__(self, state: SqliteState):
+        self.state = state
+
+    def __len__(self) -> int:
+        return self.state.connection.execute("SELECT COUNT(*) FROM token_calls").fetchone()[0]
+
+    def consume(self, nonce: str, budget: int, expires_at: datetime) -> Tuple[Optional[int], bool]:
+        with self.state.transaction() as connection:
+            created = connection.execute(
+                "INSERT OR IGNORE INTO token_calls (nonce, calls, expires_at) VALUES (?, ?, ?)",
+                (nonce, budget, expires_at.timestamp())).rowcount > 0
+            cursor = connection.execute(
+                "UPDATE token_calls SET calls = calls - 1 WHERE nonce = ? AND calls > 0", (nonce,))
+            if cursor.rowcount == 0:
+                return None, created
+            return connection.execute("SELECT calls FROM token_calls WHERE nonce = ?", (nonce,)).fetchone()[0], created
+
+    def remove(self, nonce: str) -> bool:
+        with self.state.transaction() as connection:
+            return connection.execute("DELETE FROM token_calls WHERE nonce = ?", (nonce,)).rowcount > 0
+
+
+SHARE_LINK_COLUMNS = "id, share_url, owner, expires_at, file_id, name, url, route, media_type, size, checksum"
+
+
+class SqliteShareLinkStore:
+    """ Same methods as api.storage.stores.ShareLinkStore """
+
+    def __init__(self, state: SqliteState):
+        self.state = state
+
+    @staticmethod
+    def _share_link(row: tuple) -> ShareLinkRecord:
+        return ShareLinkRecord(row[0], _file(row[4:]), row[2], _datetime(row[3]))
+
+    def __len__(self) -> int:
+        return self.state.connection.execute("SELECT COUNT(*) FROM share_links").fetchone()[0]
+
+    def __contains__(self, share_id: str) -> bool:
+        return self.state.connection.execute(
+            "SELECT 1 FROM share_links WHERE id = ?", (share_id,)).fetchone() is not None
+
+    def values(self) -> List[ShareLinkRecord]:
+        return [self._share_link(row) for row in self.state.connection.execute(
+            f"SELECT {SHARE_LINK_COLUMNS} FROM share_links")]
+
+    def add(self, share_link: ShareLinkRecord):
+        file = share_link.file
+        with self.state.transaction() as connection:
+            connection.execute(
+                f"INSERT OR REPLACE INTO share_links ({SHARE_LINK_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (share_link.id, share_link.share_url, share_link.owner, _timestamp(share_link.expires_at),
+                 file.id, file.name, file.url, file.route, file.media_type, file.size, file.checksum))
+
+    def get(self, share_id: str) -> Optional[ShareLinkRecord]:
+        row = self.state.connection.execute(
+            f"SELECT {SHARE_LINK_COLUMNS} FROM share_links WHERE id = ?", (share_id,)).fetchone()
+        return self._share_link(row) if row else None
+
+    def claim(self, share_id: str) -> Optional[ShareLinkRecord]:
+        with self.state.transaction() as connection:
+            row = connection.execute(
+                f"SELECT {SHARE_LINK_COLUMNS} FROM share_links WHERE id = ?", (share_id,)).fetchone()
+            if row is None:
+                return None
+            connection.execute("DELETE FROM share_links WHERE id = ?", (share_id,))
+            return self._share_link(row)
+
+    def remove(self, share_id: str) -> Optional[ShareLinkRecord]:
+        return self.claim(share_id)
+
+
+class SqliteUsedNonces:
+    """Same methods as api.storage.nonces.UsedNonces, shared by all the workers.
+
+    The nonces are exact rows instead of a Bloom filter, the expired ones are purged at most once a minute.
+    """
+
+    purge_interval = 60
+
+    def __init__(self, state: SqliteState):
+        self.state = state
+        self._purged_at = 0.0
+
+    def add(self, nonce: str, expires_at: datetime) -> bool:
+        now = time.time()
+        with self.state.transaction() as connection:
+            if now - self._purged_at > self.purge_interval:
+                connection.execute("DELETE FROM used_nonces WHERE expires_at < ?", (now,))
+                self._purged_at = now
+            return connection.execute(
+                "INSERT OR IGNORE INTO used_nonces (nonce, expires_at) VALUES (?, ?)",
+                (nonce, expires_at.timestamp())).rowcount > 0
+
+    def stats(self) -> dict:
+        return {"rows": self.state.connection.execute("SELECT COUNT(*) FROM used_nonces").fetchone()[0]}
+
+
+class SqliteRefCounts:
+    """ Same methods as api.storage.blobs.RefCounts, `locked` is a database transaction """
+
+    def __init__(self, state: SqliteState):
+        self.state = state
+
+    @contextmanager
+    def locked(self):
+        with self.state.transaction():
+            yield
+
+    def __len__(self) -> int:
+        return self.state.connection.execute("SELECT COUNT(*) FROM blob_refs").fetchone()[0]
+
+    def __getitem__(self, checksum: str) -> int:
+        row = self.state.connection.execute("SELECT refs FROM blob_refs WHERE checksum = ?", (checksum,)).fetchone()
+        if row is None:
+            raise KeyError(checksum)
+        return row[0]
+
+    def get(self, checksum: str, default: Optional[int] = None) -> Optional[int]:
+        try:
+            return self[checksum]
+        except KeyError:
+            return default
+
+    def values(self) -> List[int]:
+        return [row[0] for row in self.state.connection.execute("SELECT refs FROM blob_refs")]
+
+    def incr(self, checksum: str) -> int:
+        connection = self.state.connection
+        connection.execute(
+            "INSERT INTO blob_refs (checksum, refs) VALUES (?, 1) "
+            "ON CONFLICT (checksum) DO UPDATE SET refs = refs + 1", (checksum,))
+        return connection.execute("SELECT refs FROM blob_refs WHERE checksum = ?", (checksum,)).fetchone()[0]
+
+    def decr(self, checksum: str) -> int:
+        connection = self.state.connection
+        connection.execute("UPDATE blob_refs SET refs = refs - 1 WHERE checksum = ?", (checksum,))
+        row = connection.execute("SELECT refs FROM blob_refs WHERE checksum = ?", (checksum,)).fetchone()
+        if row is None or row[0] <= 0:
+            connection.execute("DELETE FROM blob_refs WHERE checksum = ?", (checksum,))
+            return 0
+        return row[0]
+
+
+class SqliteSlidingWindowQuota:
+    """Same as api.core.quota.SlidingWindowQuota, the downloads of all the workers share the window.
+
+    The running total is kept in the quotas table, expired downloads are removed by the
+    (user_id, timestamp) index, so each download is still added and removed once.
+    """
+
+    def __init__(self, state: SqliteState, user_id: str, limit: int, window: timedelta):
+        self.state = state
+        self.user_id = user_id
+        self.limit = limit
+        self.window = window
+
+    def remaining(self, now: datetime) -> int:
+        threshold = (now - self.window).timestamp()
+        with self.state.transaction() as connection:
+            expired = connection.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM downloads WHERE user_id = ? AND timestamp < ?",
+                (self.user_id, threshold)).fetchone()[0]
+            if expired:
+                connection.execute(
+                    "DELETE FROM downloads WHERE user_id = ? AND timestamp < ?", (self.user_id, threshold))
+                connection.execute(
+                    "UPDATE quotas SET amount = amount - ? WHERE user_id = ?", (expired, self.user_id))
+            row = connection.execute("SELECT amount FROM quotas WHERE user_id = ?", (self.user_id,)).fetchone()
+        return self.limit - int(row[0] if row else 0)
+
+    def consume(self, size: int, now: datetime, file_id: str):
+        with self.state.transaction() as connection:
+            connection.execute(
+                "INSERT INTO downloads (user_id, timestamp, size, file_id) VALUES (?, ?, ?, ?)",
+                (self.user_id, now.timestamp(), size, file_id))
+            connection.execute(
+                "INSERT INTO quotas (user_id, amount) VALUES (?, ?) "
+                "ON CONFLICT (user_id) DO UPDATE SET amount = amount + excluded.amount", (self.user_id, size))
+
+
+class SqliteTokenBucketQuota:
+    """ Same as api.core.quota.TokenBucketQuota, the bucket is shared by all the workers """
+
+    def __init__(self, state: SqliteState, user_id: str, limit: int, window: timedelta):
+        self.state = state
+        self.user_id = user_id
+        self.limit = limit
+        self.rate = limit / window.total_seconds()
+
+    def _refill(self, connection: sqlite3.Connection, now: datetime) -> float:
+        row = connection.execute(
+            "SELECT amount, updated_at FROM quotas WHERE user_id = ?", (self.user_id,)).fetchone()
+        tokens, updated_at = row if row else (float(self.limit), None)
+        if updated_at is not None and now.timestamp() > updated_at:
+            tokens = min(self.limit, tokens + (now.timestamp() - updated_at) * self.rate)
+        if updated_at is None or now.timestamp() > updated_at:
+            updated_at = now.timestamp()
+        connection.execute(
+            "INSERT OR REPLACE INTO quotas (user_id, amount, updated_at) VALUES (?, ?, ?)",
+            (self.user_id, tokens, updated_at))
+        return tokens
+
+    def remaining(self, now: datetime) -> int:
+        with self.state.transaction() as connection:
+            return int(self._refill(connection, now))
+
+    def consume(self, size: int, now: datetime, file_id: str):
+        with self.state.transaction() as connection:
+            tokens = self._refill(connection, now)
+            connection.execute("UPDATE quotas SET amount = ? WHERE user_id = ?", (tokens - size, self.user_id))
+
+
+SQLITE_QUOTA_MODES = {
+    "sliding_window": SqliteSlidingWindowQuota,
+    "token_bucket": SqliteTokenBucketQuota,
+}
+
+
+def create_sqlite_download_quota(state: SqliteState, user_id: str):
+    """ Returns the shared download quota engine of a user, following the current settings """
+    try:
+        quota_class = SQLITE_QUOTA_MODES[settings.DOWNLOAD_QUOTA_MODE]
+    except KeyError:
+        raise ValueError(f"Unknown DOWNLOAD_QUOTA_MODE: {settings.DOWNLOAD_QUOTA_MODE}")
+    return quota_class(
+        state,
+        user_id,
+        limit=settings.DOWNLOAD_QUOTA_TRAFFIC,
+        window=timedelta(minutes=settings.DOWNLOAD_QUOTA_MINUTES)
+    )
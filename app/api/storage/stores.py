@@ -0,0 +1,101 @@
+""" In memory stores of access tokens, signed token counters and share links
+
+Their read-modify-write operations (e.g. consuming a token call, using a share link once)
+are single methods, so they are atomic across the threadpool workers. The sqlite backend
+(see api/storage/sqlite.py) implements the same methods for state shared by several processes.
+"""
+import threading
+from datetime import datetime
+from typing import Dict, Iterable, Optional, Tuple
+
+from api.storage.records import ShareLinkRecord, TokenRecord
+
+
+class TokenStore:
+    """ Opaque access tokens of a user, by token id """
+
+    def __init__(self):
+        self._tokens: Dict[str, TokenRecord] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._tokens)
+
+    def values(self) -> Iterable[TokenRecord]:
+        return list(self._tokens.values())
+
+    def add(self, token: TokenRecord):
+        self._tokens[token.id] = token
+
+    def get(self, token_id: str) -> Optional[TokenRecord]:
+        return self._tokens.get(token_id)
+
+    def consume_call(self, token_id: str) -> Optional[int]:
+        """ Decrements the available calls of the token, returns the calls left or None if there were none """
+        with self._lock:
+            token = self._tokens.get(token_id)
+            if token is None or token.available_calls <= 0:
+                return None
+            token.available_calls -= 1
+            return token.available_calls
+
+    def remove(self, token_id: str) -> bool:
+        return self._tokens.pop(token_id, None) is not None
+
+
+class CallCounters:
+    """ Remaining calls of the signed access tokens, by token nonce """
+
+    def __init__(self):
+        self._calls: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._calls)
+
+    def consume(self, nonce: str, budget: int, expires_at: datetime) -> Tuple[Optional[int], bool]:
+        """Decrements the calls of the token, the counter starts at `budget` on the first call.
+
+        Returns:
+            Tuple[Optional[int], bool]: Calls left (None if there were none) and whether the counter was created.
+        """
+        with self._lock:
+            created = nonce not in self._calls
+            available_calls = budget if created else self._calls[nonce]
+            if available_calls <= 0:
+                self._calls[nonce] = 0
+                return None, created
+            self._calls[nonce] = available_calls - 1
+            return available_calls - 1, created
+
+    def remove(self, nonce: str) -> bool:
+        return self._calls.pop(nonce, None) is not None
+
+
+class ShareLinkStore:
+    """ Share links, by share id """
+
+    def __init__(self):
+        self._links: Dict[str, ShareLinkRecord] = {}
+
+    def __len__(self) -> int:
+        return len(self._links)
+
+    def __contains__(self, share_id: str) -> bool:
+        return share_id in self._links
+
+    def values(self) -> Iterable[ShareLinkRecord]:
+        return list(self._links.values())
+
+    def add(self, share_link: ShareLinkRecord):
+        self._links[share_link.id] = share_link
+
+    def get(self, share_id: str) -> Optional[ShareLinkRecord]:
+        return self._links.get(share_id)
+
+    def claim(self, share_id: str) -> Optional[ShareLinkRecord]:
+        """ Removes and returns the share link, only one caller gets it """
+        return self._links.pop(share_id, None)
+
+    def remove(self, share_id: str) -> Optional[ShareLinkRecord]:
+        return self._links.pop(share_id, None)
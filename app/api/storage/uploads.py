@@ -0,0 +1,271 @@
+""" Streaming uploads
+
+The request body is parsed while it's received and the file bytes are written
+once, straight into a temp file inside the destination directory.
+Size and checksum are computed on the fly, so there's no need to read the file again.
+Once the upload is done, the temp file can be moved into place with `os.replace`.
+"""
+import hashlib
+import os
+import tempfile
+from typing import List, NamedTuple, Optional, Union
+
+from fastapi import HTTPException
+from multipart.multipart import MultipartParser, parse_options_header
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import Request
+
+from api.config import settings
+
+DEFAULT_MEDIA_TYPE = "application/octet-stream"
+PART_OVERHEAD = 1024  # Bytes allowed for the boundary and headers of a multipart part
+
+
+class StoredUpload(NamedTuple):
+    filename: str
+    media_type: str
+    size: int
+    checksum: str  # sha256 hex digest of the content
+    path: str  # Temp file holding the content
+
+
+class RejectedUpload(NamedTuple):
+    """ File of a batch that wasn't received, the others are """
+    filename: str
+    status_code: int
+    detail: str
+
+
+class UploadWriter:
+    """Writes an upload into a temp file, counting its size and checksum."""
+
+    def __init__(self, directory: str, filename: str, media_type: str):
+        self.filename = filename
+        self.media_type = media_type or DEFAULT_MEDIA_TYPE
+        self.size = 0
+        self._hash = hashlib.sha256()
+        fd, self.path = tempfile.mkstemp(dir=directory, prefix=".upload-")
+        self._file = os.fdopen(fd, "wb")
+
+    def write(self, data: bytes):
+        self.size += len(data)
+        if self.size > settings.UPLOAD_MAX_SIZE:
+            raise HTTPException(status_code=413, detail="File too large")
+        self._hash.update(data)
+        self._file.write(data)
+
+    def close(self) -> StoredUpload:
+        self._file.close()
+        return StoredUpload(
+            filename=self.filename,
+            media_type=self.media_type,
+            size=self.size,
+            checksum=self._hash.hexdigest(),
+            path=self.path
+        )
+
+    def discard(self):
+        self._file.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def _decode(value: bytes) -> str:
+    try:
+        return value.decode("utf-8")
+    except UnicodeDecodeError:
+        return value.decode("latin-1")
+
+
+def check_content_length(request: Request, max_size: Optional[int] = None, detail: str = "File too large"):
+    """Rejects the requests that announce a body bigger than the upload limit, before reading it.
+
+    Args:
+        request (Request)
+        max_size (int, optional): Largest body, UPLOAD_MAX_SIZE by default. Multipart bodies add their part headers.
+        detail (str): Detail of the 413 error.
+    """
+    if max_size is None:
+        max_size = settings.UPLOAD_MAX_SIZE
+    content_length = request.headers.get("Content-Length")
+    if content_length and content_length.isdigit() and int(content_length) > max_size:
+        raise HTTPException(status_code=413, detail=detail)
+
+
+async def receive_stream(request: Request, directory: str, filename: str) -> StoredUpload:
+    """Writes a raw body (e.g. application/octet-stream) into a temp file of the directory.
+
+    Args:
+        request (Request): Request with the file as body, the body is consumed.
+        directory (str): Destination directory of the file.
+        filename (str): Name of the file for the user.
+    """
+    check_content_length(request)
+    writer = UploadWriter(directory, filename, request.headers.get("Content-Type", ""))
+    try:
+        async for chunk in request.stream():
+            if chunk:
+                await run_in_threadpool(writer.write, chunk)
+        return await run_in_threadpool(writer.close)
+    except BaseException:
+        writer.discard()
+        raise
+
+
+class MultipartFileReceiver:
+    """Parses a multipart/form-data body, writing the parts of a file field as they arrive.
+
+    Other fields, and file parts beyond `max_files`, are ignored. With `reject_files`, a file too large
+    or beyond `max_files` is returned as a RejectedUpload instead of failing the whole body.
+    """
+
+    def __init__(self, directory: str, field_name: str = "file", max_files: int = 1, reject_files: bool = False):
+        self.directory = directory
+        self.field_name = field_name.encode()
+        self.max_files = max_files
+        self.reject_files = reject_files
+        self.uploads: List[Union[StoredUpload, RejectedUpload]] = []
+        self._events = []
+        self._writer: Optional[UploadWriter] = None
+        self._headers = {}
+        self._header_field = b""
+        self._header_value = b""
+
+    def _callbacks(self) -> dict:
+        def event(name):
+            return lambda *args: self._events.append(
+                (name, args[0][args[1]:args[2]] if args else b""))
+
+        return {
+            "on_part_begin": event("part_begin"),
+            "on_part_data": event("part_data"),
+            "on_part_end": event("part_end"),
+            "on_header_field": event("header_field"),
+            "on_header_value": event("header_value"),
+            "on_header_end": event("header_end"),
+            "on_headers_finished": event("headers_finished"),
+        }
+
+    def _start_part(self):
+        disposition, options = parse_options_header(self._headers.get(b"content-disposition", b""))
+        if options.get(b"name") != self.field_name or b"filename" not in options:
+            return
+        filename = _decode(options[b"filename"])
+        if len(self.uploads) >= self.max_files:
+            if self.reject_files:
+                self.uploads.append(RejectedUpload(filename, 413, "Too many files"))
+            return
+        self._writer = UploadWriter(
+            self.directory,
+            filename=filename,
+            # Header values are latin-1, as the Content-Type of the downloads that will send it
+            media_type=self._headers.get(b"content-type", b"").decode("latin-1")
+        )
+
+    def _write(self, data: bytes):
+        try:
+            self._writer.write(data)
+        except HTTPException as error:
+            if not self.reject_files:
+                raise
+            # The rest of the part is skipped, the next files of the body are still received
+            self._writer.discard()
+            self.uploads.append(RejectedUpload(self._writer.filename, error.status_code, error.detail))
+            self._writer = None
+
+    def _process_events(self):
+        """ Handles the parser events of a chunk, runs in the threadpool as it writes to disk """
+        for name, data in self._events:
+            if name == "part_begin":
+                self._headers = {}
+            elif name == "header_field":
+                self._header_field += data
+            elif name == "header_value":
+                self._header_value += data
+            elif name == "header_end":
+                self._headers[self._header_field.lower()] = self._header_value
+                self._header_field = b""
+                self._header_value = b""
+            elif name == "headers_finished":
+                self._start_part()
+            elif name == "part_data" and self._writer:
+                self._write(data)
+            elif name == "part_end" and self._writer:
+                self.uploads.append(self._writer.close())
+                self._writer = None
+        self._events.clear()
+
+    def discard(self):
+        """ Removes the temp files, the uploads won't be stored """
+        if self._writer:
+            self._writer.discard()
+        for upload in self.uploads:
+            if isinstance(upload, RejectedUpload):
+                continue
+            try:
+                os.remove(upload.path)
+            except FileNotFoundError:
+                pass
+
+    async def receive(self, request: Request):
+        content_type, params = parse_options_header(request.headers.get("Content-Type", ""))
+        boundary = params.get(b"boundary")
+        if content_type != b"multipart/form-data" or not boundary:
+            raise HTTPException(status_code=400, detail="Validation error")
+
+        parser = MultipartParser(boundary, self._callbacks())
+        try:
+            async for chunk in request.stream():
+                parser.write(chunk)
+                if self._events:
+                    await run_in_threadpool(self._process_events)
+            parser.finalize()
+            await run_in_threadpool(self._process_events)
+        except BaseException:
+            self.discard()
+            raise
+
+        if self._writer:  # The body ended in the middle of the file
+            self.discard()
+            raise HTTPException(status_code=400, detail="Validation error")
+        return self.uploads
+
+
+async def receive_multipart_file(request: Request, directory: str, field_name: str = "file") -> StoredUpload:
+    """Receives a single file sent as multipart/form-data into a temp file of the directory.
+
+    Args:
+        request (Request): Request with the multipart body, the body is consumed.
+        directory (str): Destination directory of the file.
+        field_name (str): Name of the form field that holds the file.
+    """
+    # The file can be up to UPLOAD_MAX_SIZE, plus the boundary and headers of its part
+    check_content_length(request, settings.UPLOAD_MAX_SIZE + PART_OVERHEAD)
+    uploads = await MultipartFileReceiver(directory, field_name).receive(request)
+    if not uploads:
+        raise HTTPException(status_code=400, detail="Validation error")
+    return uploads[0]
+
+
+async def receive_multipart_files(
+    request: Request, directory: str, max_files: int, field_name: str = "files"
+) -> List[Union[StoredUpload, RejectedUpload]]:
+    """Receives the files sent as multipart/form-data into temp files of the directory, as they arrive.
+
+    Args:
+        request (Request): Request with the multipart body, the body is consumed.
+        directory (str): Destination directory of the files.
+        max_files (int): Files beyond this are rejected.
+        field_name (str): Name of the form field that holds the files, repeated for each file.
+
+    Returns:
+        The received files in the order they were sent, the files too large or beyond `max_files` are rejected.
+    """
+    # Each file can be up to UPLOAD_MAX_SIZE, plus the boundary and headers of its part
+    check_content_length(request, max_files * (settings.UPLOAD_MAX_SIZE + PART_OVERHEAD), "Files too large")
+    uploads = await MultipartFileReceiver(directory, field_name, max_files, reject_files=True).receive(request)
+    if not uploads:
+        raise HTTPException(status_code=400, detail="Validation error")
+    return uploads
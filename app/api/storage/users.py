@@ -0,0 +1,146 @@
+""" Registered users and their partitions of the db
+
+The registry only keeps the password hash of each user, a few dozen bytes, so it holds millions
+of users. The rest of the state of a user (files, download quota) is a partition that is loaded
+on the first request of the user and released after USER_IDLE_SECONDS without requests, so the
+memory follows the active users and not the registered ones.
+
+With the in memory stores a partition is the only copy of its state, it's only released when
+there's nothing to keep: no files and the whole download quota available. The sqlite partitions
+are views of the database, they are always released.
+"""
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from api.core.expiry import expiry_index
+from api.core.locks import user_locks
+
+
+class UserRegistry:
+    """ Password hashes of the registered users, by user id """
+
+    def __init__(self):
+        self._users: Dict[str, bytes] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._users)
+
+    def __contains__(self, user_id: str) -> bool:
+        return user_id in self._users
+
+    def items(self) -> Iterator[Tuple[str, bytes]]:
+        return iter(list(self._users.items()))
+
+    def add(self, user_id: str, password_hash: bytes) -> bool:
+        """ Registers the user, returns False if the user id is already taken """
+        with self._lock:
+            if user_id in self._users:
+                return False
+            self._users[user_id] = password_hash
+            return True
+
+    def put(self, user_id: str, password_hash: bytes):
+        self._users[user_id] = password_hash
+
+    def get(self, user_id: str) -> Optional[bytes]:
+        return self._users.get(user_id)
+
+
+class UserPartitions:
+    """Partitions of the registered users, `db["users"][user_id]` loads the partition if needed.
+
+    A request that took a partition before it's released would change a copy no longer in db.
+    The routes get the partitions while holding the lock of the user, and a partition is only
+    released once nobody asked for it in USER_IDLE_SECONDS, checked while holding the same lock.
+    """
+
+    def __init__(self, registry, create: Callable[[str], dict], releasable: Callable[[dict], bool],
+                 idle_seconds: float):
+        """
+        Args:
+            registry: UserRegistry, or the sqlite one.
+            create (Callable): Returns a new partition of a user.
+            releasable (Callable): Whether a partition can be released without losing anything.
+            idle_seconds (float): Time without requests before a partition is released.
+        """
+        self.registry = registry
+        self.idle_seconds = idle_seconds
+        self._create = create
+        self._releasable = releasable
+        self._loaded: Dict[str, dict] = {}
+        self._accessed_at: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        self.released = 0
+
+    def __len__(self) -> int:
+        return len(self.registry)
+
+    def __contains__(self, user_id: str) -> bool:
+        return user_id in self._loaded or user_id in self.registry
+
+    def __getitem__(self, user_id: str) -> dict:
+        partition = self._loaded.get(user_id)
+        if partition is None:
+            partition = self._load(user_id)
+        self._accessed_at[user_id] = time.monotonic()
+        return partition
+
+    def get(self, user_id: str) -> Optional[dict]:
+        """ Returns the partition of the user, None if the user is not registered """
+        try:
+            return self[user_id]
+        except KeyError:
+            return None
+
+    def items(self) -> List[Tuple[str, dict]]:
+        """ Returns the loaded partitions """
+        return list(self._loaded.items())
+
+    def _load(self, user_id: str) -> dict:
+        if user_id not in self.registry:
+            raise KeyError(user_id)
+        with self._lock:
+            partition = self._loaded.get(user_id)
+            if partition is None:
+                partition = self._loaded[user_id] = self._create(user_id)
+                self._accessed_at[user_id] = time.monotonic()
+                expiry_index.schedule(
+                    "user_partition", user_id, datetime.now() + timedelta(seconds=self.idle_seconds))
+        return partition
+
+    def release(self, user_id: str) -> bool:
+        """Releases the partition if it's idle, otherwise checks it again when it could be.
+
+        Returns:
+            bool: True if the partition was released.
+        """
+        # The routes get the partitions under the user lock, a partition checked idle and
+        # releasable under it can't be in use by a request
+        with user_locks(user_id):
+            partition = self._loaded.get(user_id)
+            if partition is None:
+                return False
+            idle_for = time.monotonic() - self._accessed_at[user_id]
+            if idle_for < self.idle_seconds:
+                expiry_index.schedule(
+                    "user_partition", user_id, datetime.now() + timedelta(seconds=self.idle_seconds - idle_for))
+                return False
+            if not self._releasable(partition):
+                expiry_index.schedule(
+                    "user_partition", user_id, datetime.now() + timedelta(seconds=self.idle_seconds))
+                return False
+            with self._lock:
+                del self._loaded[user_id]
+                self._accessed_at.pop(user_id, None)
+        self.released += 1
+        return True
+
+    def stats(self) -> dict:
+        return {
+            "registered": len(self.registry),
+            "loaded": len(self._loaded),
+            "released": self.released,
+        }
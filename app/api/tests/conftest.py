@@ -0,0 +1,4 @@
+import os
+
+# Password hashes as slow as in production would make every login of the tests take a fraction of a second
+os.environ.setdefault("PASSWORD_HASH_ITERATIONS", "1000")
@@ -1,9 +1,14 @@
 from fastapi.testclient import TestClient
 import datetime
+import sys
+import threading
+import pytest
 
 from api.main import app
-from api.auth import deps
+from api.auth import deps, signing
 from api.config import settings
+from api.database import RECORD_HANDLERS, db
+from api.storage.journal import Journal, journal
 
 client = TestClient(app)
 
@@ -99,3 +104,134 @@ def test_token_quota_expired():
     temporal_response = client.get("/me", headers={"Authorization": f"Bearer {response.json().get('token')}"})
     assert temporal_response.status_code == 401
     assert temporal_response.json()
+
+def test_missing_or_malformed_authorization():
+    for headers in ({}, {"Authorization": "Basic abc"}, {"Authorization": "Bearer"}, {"Authorization": "Bearer "}):
+        response = client.get("/me", headers=headers)
+        assert response.status_code == 401
+        assert response.headers["www-authenticate"] == "Bearer"
+
+def test_request_consumes_one_token_call():
+    response = client.post("/auth", files={"user_id": (None, f"{settings.DEMO_USER_ID}"), "password":(None, f"{settings.DEMO_USER_PASSWORD}")})
+    token = response.json().get("token")
+
+    # The header is parsed and the token resolved once, whatever the dependencies of the route
+    response = client.get("/me", headers={"Authorization": f"Bearer {token}"})
+    assert response.status_code == 200
+    token_data = db["access_tokens"].get(token)
+    assert token_data.available_calls == settings.ACCESS_TOKEN_EXPIRE_QUOTA - 1
+
+def test_concurrent_calls_of_a_token_with_the_journal(tmp_path, monkeypatch):
+    if settings.STATE_BACKEND != "memory":
+        pytest.skip("The journal is only written with the memory backend")
+    monkeypatch.setattr(settings, "ACCESS_TOKEN_EXPIRE_QUOTA", 2000)
+    token = deps.generate_access_token(settings.DEMO_USER_ID)
+    calls_left = []
+
+    def authenticate_calls():
+        for _ in range(250):
+            calls_left.append(deps.authenticate(token, datetime.datetime.now()).token.available_calls)
+
+    switch_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    journal.open(str(tmp_path))
+    try:
+        threads = [threading.Thread(target=authenticate_calls) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        journal.close()
+        sys.setswitchinterval(switch_interval)
+
+    # Each request got its own count, and the replay of the journaled counts in any order restores the last one
+    token_data = db["access_tokens"].get(token)
+    assert sorted(calls_left) == list(range(2000))
+    assert token_data.available_calls == 0
+    token_data.available_calls = 2000
+    replayed = Journal()
+    replayed.open(str(tmp_path))
+    for op, args in replayed.replay():
+        RECORD_HANDLERS[op](*args)
+    replayed.close()
+    assert token_data.available_calls == 0
+
+# Registered users
+
+def register(user_id, password="a long password"):
+    return client.post("/users", files={"user_id": (None, user_id), "password": (None, password)})
+
+def test_register_and_login_user():
+    response = register("registered-user")
+    assert response.status_code == 201
+    assert response.json() == {"user_id": "registered-user"}
+
+    response = client.post("/auth", files={"user_id": (None, "registered-user"), "password": (None, "a long password")})
+    assert response.status_code == 200
+    token = response.json().get("token")
+    assert db["access_tokens"].get(token).user_id == "registered-user"
+
+    response = client.get("/me", headers={"Authorization": f"Bearer {token}"})
+    assert response.status_code == 200
+    assert response.json().get("user") == "registered-user"
+
+    response = client.post("/auth", files={"user_id": (None, "registered-user"), "password": (None, "another password")})
+    assert response.status_code == 400
+
+def test_register_taken_user_id():
+    assert register(settings.DEMO_USER_ID).status_code == 409
+    assert register("taken-user").status_code == 201
+    assert register("taken-user").status_code == 409
+
+def test_register_invalid_user():
+    assert register("../escape").status_code == 400
+    assert register("blobs").status_code == 400
+    assert register("x" * 65).status_code == 400
+    assert register("short-password", "short").status_code == 400
+
+def test_register_closed(monkeypatch):
+    monkeypatch.setattr(settings, "USER_REGISTRATION", False)
+    assert register("closed-user").status_code == 403
+
+# Signed tokens
+
+@pytest.fixture
+def signed_tokens(monkeypatch):
+    monkeypatch.setattr(settings, "ACCESS_TOKEN_FORMAT", "signed")
+
+def test_signed_token_is_not_stored(signed_tokens):
+    stored_tokens = len(db["access_tokens"])
+    response = client.post("/auth", files={"user_id": (None, f"{settings.DEMO_USER_ID}"), "password":(None, f"{settings.DEMO_USER_PASSWORD}")})
+
+    assert response.status_code == 200
+    assert "." in response.json().get("token")
+    assert len(db["access_tokens"]) == stored_tokens
+
+def test_signed_token_quota_expired(signed_tokens):
+    response = client.post("/auth", files={"user_id": (None, f"{settings.DEMO_USER_ID}"), "password":(None, f"{settings.DEMO_USER_PASSWORD}")})
+    token = response.json().get("token")
+
+    for _ in range(settings.ACCESS_TOKEN_EXPIRE_QUOTA):
+        temporal_response = client.get("/me", headers={"Authorization": f"Bearer {token}"})
+        assert temporal_response.status_code == 200
+        assert temporal_response.json().get("user") == settings.DEMO_USER_ID
+
+    temporal_response = client.get("/me", headers={"Authorization": f"Bearer {token}"})
+    assert temporal_response.status_code == 401
+
+def test_signed_token_time_expired(signed_tokens):
+    app.dependency_overrides[deps.get_datetime_now] = custom_get_datetime_now
+    response = client.post("/auth", files={"user_id": (None, f"{settings.DEMO_USER_ID}"), "password":(None, f"{settings.DEMO_USER_PASSWORD}")})
+
+    response = client.get("/me", headers={"Authorization": f"Bearer {response.json().get('token')}"})
+    assert response.status_code == 401
+    app.dependency_overrides = {}
+
+def test_signed_token_tampered(signed_tokens):
+    response = client.post("/auth", files={"user_id": (None, f"{settings.DEMO_USER_ID}"), "password":(None, f"{settings.DEMO_USER_PASSWORD}")})
+    payload, signature = response.json().get("token").split(".")
+    forged_payload = signing.sign("other:9999999999:1000:nonce").split(".")[0]
+
+    response = client.get("/me", headers={"Authorization": f"Bearer {forged_payload}.{signature}"})
+    assert response.status_code == 401
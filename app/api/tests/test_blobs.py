@@ -0,0 +1,66 @@
+import os
+from api.storage.blobs import BlobStore
+from api.storage.deletions import DeletionQueue
+
+
+def write_temp(tmp_path, name: str, content: bytes) -> str:
+    path = tmp_path / name
+    path.write_bytes(content)
+    return str(path)
+
+
+def test_blob_store_deduplicates_contents(tmp_path):
+    deletions = DeletionQueue()
+    store = BlobStore(str(tmp_path / "blobs"), deletions=deletions)
+
+    first = store.put(write_temp(tmp_path, "upload1", b"content"), "ab12")
+    second = store.put(write_temp(tmp_path, "upload2", b"content"), "ab12")
+
+    assert first == second
+    assert store.refs == {"ab12": 2}
+    assert os.listdir(tmp_path / "blobs" / "ab") == ["ab12"]
+    # The temp files are moved or removed
+    deletions.drain(10)
+    assert not os.path.exists(tmp_path / "upload1")
+    assert not os.path.exists(tmp_path / "upload2")
+
+
+def test_blob_store_deletes_blob_with_last_reference(tmp_path):
+    deletions = DeletionQueue()
+    store = BlobStore(str(tmp_path / "blobs"), deletions=deletions)
+    path = store.put(write_temp(tmp_path, "upload", b"content"), "cd34")
+    store.incref("cd34")
+
+    store.decref("cd34")
+    assert len(deletions) == 0
+    store.decref("cd34")
+    # The blob is deleted by the deletion queue, not by the request
+    assert os.path.isfile(path)
+    deletions.drain(10)
+    assert not os.path.exists(path)
+    assert store.stats() == {"blobs": 0, "references": 0}
+
+
+def test_blob_store_keeps_blob_uploaded_again_before_deletion(tmp_path):
+    deletions = DeletionQueue()
+    store = BlobStore(str(tmp_path / "blobs"), deletions=deletions)
+    path = store.put(write_temp(tmp_path, "upload1", b"content"), "ef56")
+    store.decref("ef56")
+    store.put(write_temp(tmp_path, "upload2", b"content"), "ef56")
+
+    deletions.drain(10)
+    assert os.path.isfile(path)
+
+
+def test_blob_store_enqueues_orphans(tmp_path):
+    deletions = DeletionQueue()
+    store = BlobStore(str(tmp_path / "blobs"), deletions=deletions)
+    kept = store.put(write_temp(tmp_path, "upload", b"content"), "ab12")
+    orphan = store.path("cd34")
+    os.makedirs(os.path.dirname(orphan))
+    open(orphan, "wb").close()
+
+    assert store.enqueue_orphans() == 1
+    deletions.drain(10)
+    assert os.path.isfile(kept)
+    assert not os.path.exists(orphan)
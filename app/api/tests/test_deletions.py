@@ -0,0 +1,51 @@
+import errno
+from api.storage.deletions import DeletionQueue
+
+
+def test_deletion_queue_drains_in_batches(tmp_path):
+    queue = DeletionQueue()
+    paths = []
+    for i in range(5):
+        path = tmp_path / f"file{i}"
+        path.write_bytes(b"content")
+        paths.append(path)
+        queue.enqueue(str(path))
+    queue.enqueue(str(paths[0]))  # Enqueued twice, removed once
+    queue.enqueue(str(tmp_path / "missing"))
+
+    assert queue.drain(4) == 4
+    assert len(queue) == 2
+    assert queue.drain(4) == 2
+    assert not any(path.exists() for path in paths)
+    assert queue.stats() == {"depth": 0, "deleted": 6, "retried": 0, "failed": 0}
+
+
+def test_deletion_queue_retries_failed_deletions():
+    attempts = []
+    def delete(path: str):
+        attempts.append(path)
+        if len(attempts) < 3:
+            raise OSError(errno.EBUSY, "busy")
+
+    queue = DeletionQueue(max_attempts=5)
+    queue.enqueue("busy", delete)
+
+    # A failed deletion waits for the next batch
+    assert queue.drain(10) == 1
+    assert queue.drain(10) == 1
+    assert queue.drain(10) == 1
+    assert attempts == ["busy"] * 3
+    assert queue.stats() == {"depth": 0, "deleted": 1, "retried": 2, "failed": 0}
+
+
+def test_deletion_queue_gives_up_after_max_attempts():
+    def delete(path: str):
+        raise PermissionError(errno.EACCES, "denied")
+
+    queue = DeletionQueue(max_attempts=2)
+    queue.enqueue("denied", delete)
+    queue.drain(10)
+    queue.drain(10)
+
+    assert len(queue) == 0
+    assert queue.stats()["failed"] == 1
@@ -0,0 +1,61 @@
+import pytest
+from api.core.eviction import FifoPolicy, LfuPolicy, LruPolicy, SizeAwarePolicy
+
+
+def fill(policy, sizes):
+    for i, size in enumerate(sizes):
+        policy.add(f"id{i}", size)
+    return policy
+
+
+def drain(policy):
+    victims = []
+    while True:
+        file_id = policy.pop()
+        if file_id is None:
+            return victims
+        victims.append(file_id)
+
+
+def test_fifo_policy_ignores_downloads():
+    policy = fill(FifoPolicy(), [1, 1, 1])
+    policy.access("id0")
+
+    assert drain(policy) == ["id0", "id1", "id2"]
+
+
+def test_lru_policy_keeps_recently_downloaded_files():
+    policy = fill(LruPolicy(), [1, 1, 1])
+    policy.access("id0")
+    policy.access("id1")
+
+    assert drain(policy) == ["id2", "id0", "id1"]
+
+
+def test_lfu_policy_keeps_most_downloaded_files():
+    policy = fill(LfuPolicy(), [1, 1, 1, 1])
+    for file_id in ("id0", "id0", "id0", "id1", "id2", "id2"):
+        policy.access(file_id)
+    policy.remove("id2")
+    policy.add("id4", 1)
+
+    # Ties are broken by the least recently used
+    assert drain(policy) == ["id3", "id4", "id1", "id0"]
+    assert len(policy) == 0
+
+
+def test_size_policy_evicts_the_largest_files_first():
+    policy = fill(SizeAwarePolicy(), [10, 5000, 6000, 20])
+    policy.access("id1")
+    policy.update("id3", 9000)
+
+    assert drain(policy) == ["id3", "id2", "id1", "id0"]
+
+
+@pytest.mark.parametrize("policy_class", [FifoPolicy, LruPolicy, LfuPolicy, SizeAwarePolicy])
+def test_policies_ignore_unknown_files(policy_class):
+    policy = policy_class()
+    policy.access("missing")
+    policy.remove("missing")
+
+    assert policy.pop() is None
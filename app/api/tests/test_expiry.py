@@ -0,0 +1,57 @@
+from datetime import datetime, timedelta
+from api.core.expiry import ExpiryIndex
+
+
+def test_expiry_index_sweeps_in_deadline_order():
+    now = datetime.now()
+    index = ExpiryIndex()
+    store = {"a": 1, "b": 2, "c": 3}
+    index.register("record", lambda key: store.pop(key, None) is not None)
+
+    index.schedule("record", "c", now + timedelta(minutes=3))
+    index.schedule("record", "a", now + timedelta(minutes=1))
+    index.schedule("record", "b", now + timedelta(minutes=2))
+
+    assert index.sweep(now, max_batch=10) == 0
+    assert index.sweep(now + timedelta(minutes=2), max_batch=10) == 2
+    assert store == {"c": 3}
+    assert index.stats() == {"entries": {"record": 1}, "live": {"record": 1}, "swept": {"record": 2}}
+
+
+def test_expiry_index_sweeps_bounded_batches():
+    now = datetime.now()
+    index = ExpiryIndex()
+    store = {key: key for key in range(10)}
+    index.register("record", lambda key: store.pop(key, None) is not None)
+    for key in range(10):
+        index.schedule("record", key, now)
+
+    assert index.sweep(now, max_batch=4) == 4
+    assert len(index) == 6
+    assert len(store) == 6
+
+
+def test_expiry_index_ignores_already_removed_records():
+    now = datetime.now()
+    index = ExpiryIndex()
+    index.register("record", lambda key: False)
+    index.schedule("record", "used", now)
+
+    assert index.sweep(now, max_batch=10) == 1
+    assert index.stats() == {"entries": {"record": 0}, "live": {"record": 0}, "swept": {}}
+
+
+def test_expiry_index_counts_rescheduled_keys_once():
+    now = datetime.now()
+    index = ExpiryIndex()
+    index.register("record", lambda key: True)
+    index.schedule("record", "a", now)
+    index.schedule("record", "a", now + timedelta(minutes=1))
+    index.schedule("record", "b", now + timedelta(minutes=1))
+    assert (index.stats()["entries"], index.stats()["live"]) == ({"record": 3}, {"record": 2})
+
+    # The key is still live until its last entry is swept
+    index.sweep(now, max_batch=10)
+    assert (index.stats()["entries"], index.stats()["live"]) == ({"record": 2}, {"record": 2})
+    index.sweep(now + timedelta(minutes=1), max_batch=10)
+    assert (index.stats()["entries"], index.stats()["live"]) == ({"record": 0}, {"record": 0})
@@ -0,0 +1,59 @@
+import os
+import pytest
+from api.storage.fd_cache import FdCache
+
+
+def is_open(fd: int) -> bool:
+    try:
+        os.fstat(fd)
+        return True
+    except OSError:
+        return False
+
+
+@pytest.fixture
+def paths(tmp_path):
+    paths = []
+    for i in range(3):
+        path = tmp_path / f"blob{i}"
+        path.write_bytes(b"content %d" % i)
+        paths.append(str(path))
+    return paths
+
+
+def test_fd_cache_shares_descriptors(paths):
+    cache = FdCache(max_entries=2)
+    first = cache.acquire(paths[0])
+    second = cache.acquire(paths[0])
+
+    assert first is second
+    assert os.pread(first.fd, 9, 0) == b"content 0"
+    cache.release(first)
+    cache.release(second)
+    # Cached descriptors stay open for the next downloads
+    assert is_open(first.fd)
+    assert cache.stats() == {"entries": 1, "open": 1, "hits": 1, "misses": 1}
+
+
+def test_fd_cache_closes_evicted_descriptors_after_last_release(paths):
+    cache = FdCache(max_entries=1)
+    in_use = cache.acquire(paths[0])
+    other = cache.acquire(paths[1])
+    cache.release(other)
+
+    # Evicted while a download uses it
+    assert is_open(in_use.fd)
+    cache.release(in_use)
+    assert not is_open(in_use.fd)
+
+
+def test_fd_cache_invalidate(paths):
+    cache = FdCache(max_entries=2)
+    file = cache.acquire(paths[0])
+    cache.release(file)
+    cache.invalidate(paths[0])
+
+    assert not is_open(file.fd)
+    assert len(cache) == 0
+    with pytest.raises(FileNotFoundError):
+        cache.acquire(paths[0] + ".missing")
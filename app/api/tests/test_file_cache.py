@@ -0,0 +1,32 @@
+from api.storage.file_cache import CachedFile, FileCache
+
+
+def test_file_cache_evicts_least_recently_used():
+    cache = FileCache(max_bytes=10, max_file_size=5)
+    cache.put("a", CachedFile(b"aaaa", 0))
+    cache.put("b", CachedFile(b"bbbb", 0))
+    cache.get("a")
+    cache.put("c", CachedFile(b"cccc", 0))
+
+    assert cache.get("b") is None
+    assert cache.get("a").content == b"aaaa"
+    assert cache.get("c").content == b"cccc"
+    assert cache.size == 8
+
+
+def test_file_cache_skips_large_files():
+    cache = FileCache(max_bytes=100, max_file_size=5)
+    cache.put("large", CachedFile(b"123456", 0))
+
+    assert len(cache) == 0
+    assert not cache.accepts(6)
+
+
+def test_file_cache_invalidate_and_stats():
+    cache = FileCache(max_bytes=100, max_file_size=50)
+    cache.put("a", CachedFile(b"content", 0))
+    cache.get("a")
+    cache.invalidate("a")
+    cache.get("a")
+
+    assert cache.stats() == {"entries": 0, "bytes": 0, "hits": 1, "misses": 1, "hit_rate": 0.5}
@@ -0,0 +1,164 @@
+import json
+import pytest
+from api.core.eviction import LruPolicy
+from api.storage.file_store import FileStore, PageFilters
+from api.storage.records import FileRecord
+from api.storage.sqlite import SqliteFileStore, SqliteState
+
+
+def make_file(idx: int) -> FileRecord:
+    return FileRecord(
+        name=f"file{idx}.txt",
+        route=f"./files/test/id{idx}",
+        id=f"id{idx}",
+        media_type="text/plain",
+        size=idx
+    )
+
+
+def test_file_store_lookup_by_id_and_name():
+    store = FileStore()
+    for i in range(10):
+        store.add(make_file(i))
+
+    assert len(store) == 10
+    assert store.get("id3").name == "file3.txt"
+    assert store.get_by_name("file7.txt").id == "id7"
+    assert store.get("missing") is None
+    assert store.get_by_name("missing") is None
+
+
+def test_file_store_keeps_upload_order():
+    store = FileStore()
+    for i in range(5):
+        store.add(make_file(i))
+
+    assert [file.id for file in store] == ["id0", "id1", "id2", "id3", "id4"]
+    assert store.pop_victim().id == "id0"
+    assert next(iter(store)).id == "id1"
+    assert store.get_by_name("file0.txt") is None
+
+
+def test_file_store_load():
+    files = [make_file(i).replace(media_type=["text/plain", "image/png"][i % 2], size=i % 7) for i in range(200)]
+    added, loaded = FileStore(LruPolicy()), FileStore(LruPolicy())
+    for file in files:
+        added.add(file)
+    loaded.load(files)
+
+    assert list(loaded) == files
+    assert loaded.get_by_name("file7.txt").id == "id7"
+    for filters in (PageFilters(), PageFilters(name_prefix="file1"), PageFilters(media_type="image/png"),
+                    PageFilters(min_size=3, max_size=4)):
+        assert loaded.page(filters, 20) == added.page(filters, 20)
+    loaded.add(make_file(200))
+    assert loaded.pop_victim().id == "id0"
+
+    # A store that isn't empty puts the files one by one
+    loaded.load([files[1].replace(size=50), make_file(201)])
+    assert (loaded.get("id1").size, len(loaded)) == (50, 201)
+    with pytest.raises(ValueError):
+        FileStore().load([files[1], files[1]])
+
+
+def test_file_store_remove_frees_the_name():
+    store = FileStore()
+    store.add(make_file(1))
+    store.remove("id1")
+
+    assert len(store) == 0
+    store.add(make_file(1))
+    assert store.get_by_name("file1.txt").id == "id1"
+
+
+def test_file_store_rejects_duplicated_names():
+    store = FileStore()
+    store.add(make_file(1))
+    duplicated = make_file(2)
+    duplicated.name = "file1.txt"
+
+    with pytest.raises(ValueError):
+        store.add(duplicated)
+
+
+def test_file_store_pops_the_eviction_policy_victim():
+    store = FileStore(LruPolicy())
+    for i in range(3):
+        store.add(make_file(i))
+    store.touch("id0")
+    store.touch("missing")
+
+    assert store.pop_victim().id == "id1"
+    assert store.get_by_name("file1.txt") is None
+    assert [file.id for file in store] == ["id0", "id2"]
+    store.remove("id2")
+    assert store.pop_victim().id == "id0"
+    with pytest.raises(KeyError):
+        store.pop_victim()
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def paged_store(request, tmp_path):
+    """ Store with 30 files: 3 media types, sizes 0 to 29, names `a00`... and `b15`... """
+    if request.param == "memory":
+        store = FileStore()
+    else:
+        store = SqliteFileStore(SqliteState(str(tmp_path / "state.db")), "user")
+    for i in range(30):
+        store.add(FileRecord(
+            name=f"{'a' if i < 15 else 'b'}{i:02}.txt", route=f"./files/test/id{i}", id=f"id{i}",
+            media_type=["text/plain", "image/png", "image/jpeg"][i % 3], size=i))
+    return store
+
+
+def read_pages(store, filters: PageFilters, limit: int):
+    pages, after = [], None
+    while True:
+        files, after = store.page(filters, limit, after)
+        pages.append([file.id for file in files])
+        if after is None:
+            return pages
+        # Keys are sent to the clients in the cursors, as json
+        after = json.loads(json.dumps(after))
+
+
+def test_file_store_pages_in_upload_order(paged_store):
+    pages = read_pages(paged_store, PageFilters(), 8)
+    assert [len(page) for page in pages] == [8, 8, 8, 6]
+    assert sum(pages, []) == [f"id{i}" for i in range(30)]
+
+    # Removed and overwritten files keep the pages consistent
+    paged_store.remove("id3")
+    paged_store.put(paged_store.get("id4").replace(size=100))
+    assert sum(read_pages(paged_store, PageFilters(), 8), []) == [f"id{i}" for i in range(30) if i != 3]
+
+
+def test_file_store_pages_filtered(paged_store):
+    by_name = sum(read_pages(paged_store, PageFilters(name_prefix="b2"), 3), [])
+    assert by_name == [f"id{i}" for i in range(20, 30)]
+
+    by_media_type = sum(read_pages(paged_store, PageFilters(media_type="image/png"), 4), [])
+    assert by_media_type == [f"id{i}" for i in range(1, 30, 3)]
+
+    by_size = sum(read_pages(paged_store, PageFilters(min_size=5, max_size=12), 3), [])
+    assert by_size == [f"id{i}" for i in range(5, 13)]
+
+    combined = sum(read_pages(paged_store, PageFilters(name_prefix="a", media_type="image/jpeg", max_size=10), 2), [])
+    assert combined == ["id2", "id5", "id8"]
+
+
+def test_file_store_page_rejects_other_keys(paged_store):
+    with pytest.raises(ValueError):
+        paged_store.page(PageFilters(name_prefix="a"), 10, after=3)
+    with pytest.raises(ValueError):
+        paged_store.page(PageFilters(min_size=1), 10, after="a")
+
+
+def test_file_store_page_scan_is_bounded():
+    # A filter that the order doesn't narrow can't make a page walk all the files
+    store = FileStore()
+    for i in range(100):
+        store.add(make_file(i))
+    files, after = store.page(PageFilters(name_prefix="file", media_type="image/png"), 2)
+    assert files == []
+    assert after == "file26.txt"  # 20 files looked at, in name order
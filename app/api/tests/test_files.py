@@ -4,7 +4,12 @@ import shutil
 import os
 from api.main import app
 from api.config import settings
+from api import database
+from api.auth import signing
+from api.storage.blobs import blob_store
+from api.storage.deletions import deletion_queue
 import hashlib
+import sys
 
 client = TestClient(app)
 
@@ -385,3 +390,300 @@ def test_download_share_link_file_not_authenticated_multiple(token):
     # The second time it MUST fail
     response = client.get(share_url)
     assert response.status_code == 404
+
+
+def test_download_share_link_file_expired(token, monkeypatch):
+    # Upload a file, generate a share link and try to download it after the expiration
+
+    with open('./tests/house.jpg', 'rb') as file:
+        files = {'file': ("house.jpg", file)}
+        response = client.post(
+            "/me", headers={"Authorization": f"Bearer {token}"}, files=files)
+        assert response.status_code == 200
+        file_id = response.json().get("url").split('/')[2]
+
+    monkeypatch.setattr(settings, "SHARE_LINK_EXPIRE_MINUTES", -1)
+    response = client.get(f"/f/{file_id}/share",
+                          headers={"Authorization": f"Bearer {token}"})
+    assert response.status_code == 200
+    share_url = response.json().get("share_url")
+
+    response = client.get(share_url)
+    assert response.status_code == 404
+
+
+@pytest.fixture
+def signed_share_links(monkeypatch):
+    monkeypatch.setattr(settings, "SHARE_LINK_FORMAT", "signed")
+
+
+def test_signed_share_link_file(token, signed_share_links):
+    # Nothing is stored for a signed share link, it can be downloaded once
+
+    response = client.get("/me", headers={"Authorization": f"Bearer {token}"})
+    file_id = response.json()["files"][0].get("url").split('/')[2]
+    share_links = len(database.db["share_links"])
+    response = client.get(f"/f/{file_id}/share", headers={"Authorization": f"Bearer {token}"})
+    assert response.status_code == 200
+    share_url = response.json().get("share_url")
+    assert len(database.db["share_links"]) == share_links
+
+    response = client.get(share_url)
+    assert response.status_code == 200
+    assert response.content
+    response = client.get(share_url)
+    assert response.status_code == 404
+
+
+def test_signed_share_link_tampered(token, signed_share_links):
+    response = client.get("/me", headers={"Authorization": f"Bearer {token}"})
+    file_id = response.json()["files"][0].get("url").split('/')[2]
+    response = client.get(f"/f/{file_id}/share", headers={"Authorization": f"Bearer {token}"})
+    payload, signature = response.json().get("share_url")[3:].split(".")
+
+    # An access token signature is not valid for a share link
+    forged_payload = signing.sign(f"{settings.DEMO_USER_ID}:{file_id}:9999999999:nonce").split(".")[0]
+    assert client.get(f"/s/{forged_payload}.{signature}").status_code == 404
+    forged = signing.sign(f"{settings.DEMO_USER_ID}:{file_id}:9999999999:nonce")
+    assert client.get(f"/s/{forged}").status_code == 404
+    assert client.get(f"/s/{payload}.{signature}").status_code == 200
+
+
+def test_signed_share_link_expired(token, signed_share_links, monkeypatch):
+    response = client.get("/me", headers={"Authorization": f"Bearer {token}"})
+    file_id = response.json()["files"][0].get("url").split('/')[2]
+    monkeypatch.setattr(settings, "SHARE_LINK_EXPIRE_MINUTES", -1)
+    response = client.get(f"/f/{file_id}/share", headers={"Authorization": f"Bearer {token}"})
+    assert response.status_code == 200
+
+    response = client.get(response.json().get("share_url"))
+    assert response.status_code == 404
+
+
+def test_authorized_post_user_file_too_large(token, monkeypatch):
+    # Temp files of the previous duplicated uploads are removed by the deletion queue
+    deletion_queue.drain(1000)
+    monkeypatch.setattr(settings, "UPLOAD_MAX_SIZE", 1024)
+    with open('./tests/house.jpg', 'rb') as file:
+        files = {'file': ("house_too_large.jpg", file)}
+        response = client.post(
+            "/me", headers={"Authorization": f"Bearer {token}"}, files=files)
+        assert response.status_code == 413
+
+    # No temp files are left in the user space
+    assert not [name for name in os.listdir(f"./files/{settings.DEMO_USER_ID}") if name.startswith(".upload-")]
+
+
+def test_post_user_file_of_the_size_limit(token, monkeypatch):
+    monkeypatch.setattr(settings, "UPLOAD_MAX_SIZE", 1024)
+    # The limit is the size of the file, as with PUT, not the size of the multipart body
+    files = {'file': ("size_limit.bin", os.urandom(1024), "application/octet-stream")}
+    response = client.post("/me", headers={"Authorization": f"Bearer {token}"}, files=files)
+    assert response.status_code == 200
+
+    files = {'file': ("size_limit.bin", os.urandom(1025), "application/octet-stream")}
+    response = client.post("/me", headers={"Authorization": f"Bearer {get_token()}"}, files=files)
+    assert response.status_code == 413
+
+
+def test_post_user_file_with_utf8_media_type(token):
+    # Header values are latin-1, the download sends the media type back without failing to encode it
+    files = {'file': ("utf8_media_type.txt", b"content", "text/plain; name=caf\u00e9")}
+    response = client.post("/me", headers={"Authorization": f"Bearer {token}"}, files=files)
+    assert response.status_code == 200
+
+    # The download quota is already used by the previous tests, the share link has none
+    file_id = response.json()["url"].split('/')[2]
+    response = client.get(f"/f/{file_id}/share", headers={"Authorization": f"Bearer {get_token()}"})
+    assert response.status_code == 200
+    response = client.get(response.json()["share_url"])
+    assert response.status_code == 200
+    assert response.content == b"content"
+
+
+def test_authorized_post_user_file_without_file(token):
+    response = client.post(
+        "/me", headers={"Authorization": f"Bearer {token}"}, files={'other': ("house.jpg", b"data")})
+    assert response.status_code == 400
+
+
+def test_unauthorized_put_user_file():
+    response = client.put("/me/house.jpg", data=b"data")
+
+    assert response.status_code == 401
+    assert response.json()
+
+
+def test_authorized_put_user_file(token):
+    with open('./tests/house.jpg', 'rb') as file:
+        content = file.read()
+
+    response = client.put("/me/house_raw.jpg", data=content, headers={
+        "Authorization": f"Bearer {token}", "Content-Type": "application/octet-stream"})
+    assert response.status_code == 200
+    assert response.json().get("name") == "house_raw.jpg"
+    file_url = response.json().get("url")
+
+    # Uploading again with the same name overwrites the file
+    response = client.put("/me/house_raw.jpg", data=content[:100], headers={
+        "Authorization": f"Bearer {token}", "Content-Type": "application/octet-stream"})
+    assert response.status_code == 200
+    assert response.json().get("url") == file_url
+
+    # The download quota is already used by the previous tests, check the stored file instead
+    file_data = database.db["users"][settings.DEMO_USER_ID]["files"].get(file_url.split('/')[2])
+    assert file_data.size == 100
+    with open(file_data.route, 'rb') as file:
+        assert file.read() == content[:100]
+
+
+def test_authorized_post_user_file_deduplicated(token):
+    """ Uploading the same content with different names stores it once """
+    with open('./tests/house.jpg', 'rb') as file:
+        content = file.read()
+    urls = []
+    for name in ("house_copy1.jpg", "house_copy2.jpg"):
+        response = client.put(f"/me/{name}", data=content, headers={"Authorization": f"Bearer {token}"})
+        assert response.status_code == 200
+        urls.append(response.json().get("url"))
+
+    user_files = database.db["users"][settings.DEMO_USER_ID]["files"]
+    first, second = (user_files.get(url.split('/')[2]) for url in urls)
+    assert first.id != second.id
+    assert first.route == second.route
+    assert blob_store.refs[first.checksum] >= 2
+
+
+def test_concurrent_uploads_of_the_same_name():
+    """ Concurrent uploads of a name keep a single file, with the content of one of them """
+    from concurrent.futures import ThreadPoolExecutor
+    from api.routes.files import get_user_directory, store_user_file
+    from api.storage.uploads import StoredUpload
+
+    directory = get_user_directory(settings.DEMO_USER_ID)
+    uploads = []
+    for i in range(8):
+        content = f"concurrent upload {i}".encode()
+        path = os.path.join(directory, f".upload-test-{i}")
+        with open(path, "wb") as file:
+            file.write(content)
+        uploads.append(StoredUpload("concurrent.txt", "text/plain", len(content), hashlib.sha256(content).hexdigest(), path))
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        urls = {result.url for result in executor.map(
+            lambda upload: store_user_file(settings.DEMO_USER_ID, upload), uploads)}
+
+    assert len(urls) == 1
+    file_data = database.db["users"][settings.DEMO_USER_ID]["files"].get_by_name("concurrent.txt")
+    with open(file_data.route, "rb") as file:
+        assert hashlib.sha256(file.read()).hexdigest() == file_data.checksum
+    # Only the content of the stored file is kept
+    assert all(blob_store.refs.get(upload.checksum) is None
+               for upload in uploads if upload.checksum != file_data.checksum)
+
+
+def test_list_files_while_uploading(monkeypatch):
+    """ The files are listed while uploads of the user add files, and evict them once the user has USER_MAX_FILES """
+    import threading
+    from api.routes.files import get_user_directory, store_user_file
+    from api.storage.uploads import StoredUpload
+
+    monkeypatch.setattr(settings, "ACCESS_TOKEN_EXPIRE_QUOTA", 1000)
+    token = get_token()
+    directory = get_user_directory(settings.DEMO_USER_ID)
+    stop = threading.Event()
+
+    def upload():
+        i = 0
+        while not stop.is_set():
+            content = f"listing upload {i}".encode()
+            path = os.path.join(directory, f".upload-listing-{i}")
+            with open(path, "wb") as file:
+                file.write(content)
+            store_user_file(settings.DEMO_USER_ID, StoredUpload(
+                f"listing-{i}.txt", "text/plain", len(content), hashlib.sha256(content).hexdigest(), path))
+            i += 1
+
+    # Threads switch more often, so the listings are interrupted by the uploads
+    switch_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    uploader = threading.Thread(target=upload)
+    uploader.start()
+    try:
+        for _ in range(200):
+            response = client.get("/me", headers={"Authorization": f"Bearer {token}"})
+            assert response.status_code == 200
+    finally:
+        stop.set()
+        uploader.join()
+        sys.setswitchinterval(switch_interval)
+        # The evicted contents are removed now, the next tests expect a short deletion queue
+        while deletion_queue.drain(1000):
+            pass
+
+
+# Batch uploads
+
+def test_batch_upload_user_files(token):
+    user_files = database.db["users"][settings.DEMO_USER_ID]["files"]
+    client.put("/me/batch_existing.txt", data=b"old", headers={"Authorization": f"Bearer {token}"})
+    files = [
+        ("files", ("batch_new.txt", b"new", "text/plain")),
+        ("files", ("batch_existing.txt", b"overwritten", "text/plain")),
+        ("files", ("batch_new.txt", b"new, sent twice", "text/plain")),
+    ]
+    response = client.post("/me/batch", headers={"Authorization": f"Bearer {token}"}, files=files)
+    assert response.status_code == 200
+    results = response.json()["files"]
+    assert [result["name"] for result in results] == ["batch_new.txt", "batch_existing.txt", "batch_new.txt"]
+    assert all(result["status_code"] == 200 for result in results)
+    # The last upload of a name is the stored one
+    assert results[0]["url"] == results[2]["url"]
+    with open(user_files.get_by_name("batch_new.txt").route, "rb") as file:
+        assert file.read() == b"new, sent twice"
+    with open(user_files.get_by_name("batch_existing.txt").route, "rb") as file:
+        assert file.read() == b"overwritten"
+
+
+def test_batch_upload_evicts_once(token, monkeypatch):
+    user_files = database.db["users"][settings.DEMO_USER_ID]["files"]
+    monkeypatch.setattr(settings, "USER_MAX_FILES", len(user_files) + 1)
+    oldest = [file.id for file in user_files][:2]
+    files = [("files", (f"batch_evict_{i}.txt", f"content {i}".encode(), "text/plain")) for i in range(3)]
+    response = client.post("/me/batch", headers={"Authorization": f"Bearer {token}"}, files=files)
+    assert response.status_code == 200
+
+    assert len(user_files) == settings.USER_MAX_FILES
+    assert all(user_files.get_by_name(f"batch_evict_{i}.txt") for i in range(3))
+    assert all(file_id not in user_files for file_id in oldest)
+
+
+def test_batch_upload_rejects_some_files(token, monkeypatch):
+    # Temp files of the previous duplicated uploads are removed by the deletion queue
+    deletion_queue.drain(1000)
+    monkeypatch.setattr(settings, "UPLOAD_MAX_SIZE", 1024)
+    monkeypatch.setattr(settings, "UPLOAD_BATCH_MAX_FILES", 2)
+    files = [
+        ("files", ("batch_large.bin", os.urandom(2048), "application/octet-stream")),
+        ("files", ("batch_small.txt", b"small", "text/plain")),
+        ("files", ("batch_extra.txt", b"extra", "text/plain")),
+    ]
+    response = client.post("/me/batch", headers={"Authorization": f"Bearer {token}"}, files=files)
+    assert response.status_code == 200
+    results = response.json()["files"]
+    assert [(result["name"], result["status_code"]) for result in results] == [
+        ("batch_large.bin", 413), ("batch_small.txt", 200), ("batch_extra.txt", 413)]
+    assert results[0]["url"] is None
+
+    user_files = database.db["users"][settings.DEMO_USER_ID]["files"]
+    assert user_files.get_by_name("batch_small.txt")
+    assert not user_files.get_by_name("batch_large.bin")
+    # No temp file is left for the rejected file
+    directory = f"./files/{settings.DEMO_USER_ID}"
+    assert not [name for name in os.listdir(directory) if name.startswith(".upload-")]
+
+
+def test_batch_upload_without_files(token):
+    response = client.post("/me/batch", headers={"Authorization": f"Bearer {token}"},
+                           files={"other": ("a.txt", b"a", "text/plain")})
+    assert response.status_code == 400
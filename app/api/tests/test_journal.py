@@ -0,0 +1,109 @@
+import os
+import pickle
+
+import pytest
+
+from api.config import settings
+from api.database import RECORD_HANDLERS, capture_records, db
+from api.storage import journal as journal_module
+from api.storage.journal import Journal
+from api.storage.records import FileRecord
+
+
+def reopen(directory) -> Journal:
+    journal = Journal()
+    journal.open(str(directory))
+    return journal
+
+
+def test_journal_replays_records_after_restart(tmp_path):
+    journal = reopen(tmp_path)
+    journal.record("put", "a", 1)
+    journal.record("put", "b", 2)
+    journal.record("del", "a")
+    journal.close()
+
+    assert list(reopen(tmp_path).replay()) == [("put", ("a", 1)), ("put", ("b", 2)), ("del", ("a",))]
+
+
+def test_journal_snapshot_replaces_segments(tmp_path):
+    journal = reopen(tmp_path)
+    for i in range(10):
+        journal.record("put", i, i)
+    journal.snapshot(lambda: [("put", (9, 9))])
+    journal.record("del", 9)
+    journal.close()
+
+    # Only the snapshot and the segments written after it are kept
+    assert sorted(os.listdir(tmp_path)) == ["journal.2", "snapshot"]
+    assert list(reopen(tmp_path).replay()) == [("put", (9, 9)), ("del", (9,))]
+
+
+def test_journal_snapshot_in_columns(tmp_path, monkeypatch):
+    monkeypatch.setattr(journal_module, "SNAPSHOT_BATCH", 4)
+    records = [("put", (i, str(i))) for i in range(10)] + [("clear", ())] * 3 + \
+        [("tag", ("a",)), ("tag", ("b", "c")), ("put", (10, "10"))]
+    journal = reopen(tmp_path)
+    journal.snapshot(lambda: records)
+    journal.close()
+
+    # Runs of the same op are batched, the arguments of different lengths are pickled one by one
+    ops = [op for op, _ in Journal._read(str(tmp_path / "snapshot"))]
+    assert ops == ["snapshot", "columns", "columns", "columns", "columns", "tag", "tag", "columns"]
+    assert list(reopen(tmp_path).replay()) == records
+
+
+def test_journal_replays_older_snapshots(tmp_path):
+    # Snapshots written before the columns have a pickle per record
+    with open(tmp_path / "snapshot", "wb") as file:
+        for record in [("snapshot", (1,)), ("put", ("a", 1)), ("put", ("b", 2))]:
+            file.write(pickle.dumps(record))
+    journal = reopen(tmp_path)
+    journal.record("del", "a")
+    journal.close()
+
+    assert list(reopen(tmp_path).replay()) == [("put", ("a", 1)), ("put", ("b", 2)), ("del", ("a",))]
+
+
+def test_journal_ignores_torn_record(tmp_path):
+    journal = reopen(tmp_path)
+    journal.record("put", "a", 1)
+    journal.record("put", "b", 2)
+    journal.close()
+
+    # Simulate a crash in the middle of the last write
+    segment = tmp_path / "journal.1"
+    segment.write_bytes(segment.read_bytes()[:-5])
+
+    assert list(reopen(tmp_path).replay()) == [("put", ("a", 1))]
+
+
+def test_journal_disabled_until_opened():
+    journal = Journal()
+    journal.record("put", "a", 1)
+
+    assert not journal.enabled
+    assert journal.pending == 0
+
+
+def test_journal_restores_the_files_of_a_user(tmp_path):
+    if settings.STATE_BACKEND != "memory":
+        pytest.skip("The journal is only written with the memory backend")
+    db["users"].registry.put("journal-user", b"hash")
+    store = db["users"]["journal-user"]["files"]
+    files = [FileRecord(f"journal-{i}", f"{i}.txt", f"./files/journal-user/{i}", "text/plain", i) for i in range(3)]
+    try:
+        for file in files:
+            store.add(file)
+        journal = reopen(tmp_path)
+        journal.snapshot(lambda: [record for record in capture_records() if record[1][0] == "journal-user"])
+        journal.close()
+        for file in files:
+            store.remove(file.id)
+
+        for op, args in reopen(tmp_path).replay():
+            RECORD_HANDLERS[op](*args)
+        assert [file.state() for file in store] == [file.state() for file in files]
+    finally:
+        for file in list(store):
+            store.remove(file.id)
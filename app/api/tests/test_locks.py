@@ -0,0 +1,17 @@
+from api.core.locks import StripedLock
+
+
+def test_striped_lock_returns_the_same_lock_for_a_key():
+    locks = StripedLock(4)
+
+    assert locks("user") is locks("user")
+    assert len({id(locks(f"user{i}")) for i in range(100)}) == len(locks)
+
+
+def test_striped_lock_keys_dont_wait_for_other_stripes():
+    locks = StripedLock(16)
+    other = next(key for key in range(100) if locks(key) is not locks("user"))
+
+    with locks("user"):
+        assert locks(other).acquire(blocking=False)
+        locks(other).release()
@@ -0,0 +1,29 @@
+from api.storage import nonces
+from api.storage.nonces import UsedNonces
+
+
+def test_nonce_used_once():
+    used = UsedNonces(1024, 60)
+    assert used.add("a")
+    assert used.add("b")
+    assert not used.add("a")
+    assert used.stats() == {"bytes": 1024, "current": 2, "previous": 0}
+
+
+def test_nonces_rotation(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(nonces.time, "monotonic", lambda: now[0])
+    used = UsedNonces(1024, 60)
+    assert used.add("a")
+
+    # The previous generation is still checked
+    now[0] += 61
+    assert not used.add("a")
+    assert used.add("b")
+    assert used.stats()["previous"] == 1
+
+    # Two periods later, the links of "a" and "b" are expired
+    now[0] += 121
+    assert used.add("a")
+    assert used.add("b")
+    assert used.stats()["previous"] == 0
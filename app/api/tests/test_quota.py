@@ -0,0 +1,68 @@
+import sys
+import threading
+from datetime import datetime, timedelta
+
+import pytest
+
+from api.core.quota import SlidingWindowQuota, TokenBucketQuota
+
+WINDOW = timedelta(minutes=5)
+
+
+def test_sliding_window_quota_consume():
+    now = datetime.now()
+    quota = SlidingWindowQuota(limit=100, window=WINDOW)
+
+    assert quota.remaining(now) == 100
+    quota.consume(60, now, "file")
+    assert quota.remaining(now) == 40
+    # The download that surpasses the quota is accepted, leaving the quota below zero
+    quota.consume(60, now, "file")
+    assert quota.remaining(now) == -20
+
+
+def test_sliding_window_quota_expires_old_downloads():
+    now = datetime.now()
+    quota = SlidingWindowQuota(limit=100, window=WINDOW)
+    quota.consume(70, now, "file")
+    quota.consume(30, now + timedelta(minutes=3), "file")
+
+    assert quota.remaining(now + timedelta(minutes=4)) == 0
+    assert quota.remaining(now + timedelta(minutes=6)) == 70
+    assert len(quota.records) == 1
+    assert quota.remaining(now + timedelta(minutes=9)) == 100
+    assert len(quota.records) == 0
+
+
+def test_token_bucket_quota_refills():
+    now = datetime.now()
+    quota = TokenBucketQuota(limit=100, window=WINDOW)
+    quota.consume(150, now, "file")
+
+    assert quota.remaining(now) == -50
+    assert quota.remaining(now + WINDOW) == 50
+    # The bucket never holds more than the limit
+    assert quota.remaining(now + WINDOW * 10) == 100
+
+
+@pytest.mark.parametrize("quota_class", [SlidingWindowQuota, TokenBucketQuota])
+def test_quota_of_concurrent_downloads(quota_class):
+    now = datetime.now()
+    quota = quota_class(limit=100_000, window=WINDOW)
+
+    def download():
+        for _ in range(10_000):
+            if quota.remaining(now) > 0:
+                quota.consume(1, now, "file")
+
+    switch_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        threads = [threading.Thread(target=download) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        sys.setswitchinterval(switch_interval)
+    assert quota.remaining(now) == 100_000 - 8 * 10_000
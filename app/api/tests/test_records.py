@@ -0,0 +1,63 @@
+import pickle
+from datetime import datetime
+
+from api.schemas.file import FileInDB, ShareUrlInDB
+from api.storage.blobs import blob_store
+from api.storage.records import (
+    FileRecord, ShareLinkRecord, file_columns, file_record, restore_files, share_link_record
+)
+
+CHECKSUM = "ab" * 32
+
+
+def test_file_record_derives_url_and_blob_route():
+    file = FileRecord("id1", "a.txt", blob_store.path(CHECKSUM), "/".join(["text", "plain"]), 10, CHECKSUM)
+    assert file.url == "/f/id1"
+    assert file.route == blob_store.path(CHECKSUM)
+    assert file._route is None
+    # Media types are shared by all the files of a type
+    assert file.media_type is FileRecord("id2", "b.txt", "./files/b", "/".join(["text", "plain"]), 5).media_type
+
+    # Routes outside of the blob store are kept
+    assert FileRecord("id2", "b.txt", "./files/b", "text/plain", 5).route == "./files/b"
+
+
+def test_file_record_replace_and_pickle():
+    file = FileRecord("id1", "a.txt", "./files/a", "text/plain", 10)
+    file._json = b"{}"
+    overwritten = file.replace(route=blob_store.path(CHECKSUM), size=20, checksum=CHECKSUM)
+    assert (overwritten.id, overwritten.name, overwritten.size, overwritten.route) == \
+        ("id1", "a.txt", 20, blob_store.path(CHECKSUM))
+    assert file.size == 10
+    assert overwritten._json is None
+
+    # The cached JSON is not written to the journal
+    restored = pickle.loads(pickle.dumps(file))
+    assert (restored.id, restored.name, restored.route, restored.size, restored._json) == \
+        ("id1", "a.txt", "./files/a", 10, None)
+
+
+def test_file_records_in_columns():
+    files = [FileRecord("id1", "a.txt", blob_store.path(CHECKSUM), "text/plain", 10, CHECKSUM),
+             FileRecord("id2", "b.txt", "./files/b", "text/plain", 5)]
+    restored = restore_files(*pickle.loads(pickle.dumps(file_columns(files))))
+    assert [file.state() for file in restored] == [file.state() for file in files]
+    assert [file.route for file in restored] == [blob_store.path(CHECKSUM), "./files/b"]
+    assert restored[0].media_type is files[0].media_type
+    assert restored[1]._json is None
+
+
+def test_records_from_older_journals():
+    old = FileInDB(name="a.txt", url="/f/id1", route=blob_store.path(CHECKSUM), id="id1",
+                   media_type="text/plain", size=10, checksum=CHECKSUM)
+    file = file_record(old)
+    assert isinstance(file, FileRecord)
+    assert (file.id, file.name, file.route, file.checksum) == ("id1", "a.txt", old.route, CHECKSUM)
+    assert file_record(file) is file
+
+    expires_at = datetime.now()
+    share_link = share_link_record(ShareUrlInDB(share_url="/s/abc", id="abc", file=old, owner="user",
+                                                expires_at=expires_at))
+    assert isinstance(share_link, ShareLinkRecord)
+    assert (share_link.share_url, share_link.owner, share_link.expires_at) == ("/s/abc", "user", expires_at)
+    assert share_link.file.url == "/f/id1"
@@ -0,0 +1,449 @@
+from fastapi.testclient import TestClient
+from datetime import datetime
+import hashlib
+import io
+import os
+import zipfile
+import pytest
+from api import archive as archive_module
+from api.archive import is_compressed
+from api.main import app
+from api.config import settings
+from api.core.expiry import expiry_index
+from api.core.quota import create_download_quota
+from api.database import db
+from api.responses import parse_range
+from api.storage.blobs import blob_store
+from api.storage.deletions import deletion_queue
+from api.storage.file_cache import file_cache
+
+client = TestClient(app)
+
+
+def get_token():
+    response = client.post("/auth", files={"user_id": (
+        None, f"{settings.DEMO_USER_ID}"), "password": (None, f"{settings.DEMO_USER_PASSWORD}")})
+    assert response.status_code == 200
+    return response.json().get("token")
+
+
+@pytest.fixture
+def quota(monkeypatch):
+    """ Fresh download quota for the demo user, previous tests may have used it """
+    quota = create_download_quota()
+    monkeypatch.setitem(db["users"][settings.DEMO_USER_ID]["quotas"], "by_download_traffic", quota)
+    return quota
+
+
+@pytest.fixture
+def uploaded_file():
+    """ Uploads the test image, returns its id and content """
+    with open('./tests/house.jpg', 'rb') as file:
+        content = file.read()
+    response = client.put("/me/house_ranges.jpg", data=content, headers={
+        "Authorization": f"Bearer {get_token()}", "Content-Type": "image/jpeg"})
+    assert response.status_code == 200
+    return response.json().get("url").split('/')[2], content
+
+
+# Range header parsing
+
+def test_parse_range():
+    assert parse_range("bytes=0-99", 1000) == [(0, 100)]
+    assert parse_range("bytes=900-", 1000) == [(900, 1000)]
+    assert parse_range("bytes=-100", 1000) == [(900, 1000)]
+    assert parse_range("bytes=990-2000", 1000) == [(990, 1000)]
+
+
+def test_parse_range_merges_overlapping_ranges():
+    assert parse_range("bytes=500-599, 0-99, 50-149", 1000) == [(0, 150), (500, 600)]
+    assert parse_range("bytes=0-99,100-199", 1000) == [(0, 200)]
+
+
+def test_parse_range_invalid():
+    assert parse_range("items=0-99", 1000) is None
+    assert parse_range("bytes=a-b", 1000) is None
+    assert parse_range("bytes=100-0", 1000) is None
+    assert parse_range("bytes=-", 1000) is None
+    assert parse_range("bytes=2000-", 1000) == []
+
+
+# Range downloads
+
+def test_download_user_file_headers(quota, uploaded_file):
+    file_id, content = uploaded_file
+    response = client.get(f"/f/{file_id}", headers={"Authorization": f"Bearer {get_token()}"})
+
+    assert response.status_code == 200
+    assert response.content == content
+    assert response.headers["accept-ranges"] == "bytes"
+    assert response.headers["etag"]
+    assert response.headers["last-modified"]
+
+
+def test_download_user_file_single_range(quota, uploaded_file):
+    file_id, content = uploaded_file
+    response = client.get(f"/f/{file_id}", headers={
+        "Authorization": f"Bearer {get_token()}", "Range": "bytes=100-199"})
+
+    assert response.status_code == 206
+    assert response.content == content[100:200]
+    assert response.headers["content-range"] == f"bytes 100-199/{len(content)}"
+    # Only the bytes sent are charged to the quota
+    assert quota.total == 100
+
+
+def test_download_user_file_multiple_ranges(quota, uploaded_file):
+    file_id, content = uploaded_file
+    response = client.get(f"/f/{file_id}", headers={
+        "Authorization": f"Bearer {get_token()}", "Range": "bytes=0-9,-10"})
+
+    assert response.status_code == 206
+    assert response.headers["content-type"].startswith("multipart/byteranges; boundary=")
+    assert content[:10] in response.content
+    assert content[-10:] in response.content
+    assert f"Content-Range: bytes 0-9/{len(content)}".encode() in response.content
+    assert quota.total == 20
+
+
+def test_download_user_file_if_range(quota, uploaded_file):
+    file_id, content = uploaded_file
+    response = client.get(f"/f/{file_id}", headers={"Authorization": f"Bearer {get_token()}"})
+    etag = response.headers["etag"]
+
+    response = client.get(f"/f/{file_id}", headers={
+        "Authorization": f"Bearer {get_token()}", "Range": "bytes=0-9", "If-Range": etag})
+    assert response.status_code == 206
+
+    # The client has an old version of the file, the full file is sent
+    response = client.get(f"/f/{file_id}", headers={
+        "Authorization": f"Bearer {get_token()}", "Range": "bytes=0-9", "If-Range": '"old"'})
+    assert response.status_code == 200
+    assert response.content == content
+
+
+def test_download_user_file_unsatisfiable_range(quota, uploaded_file):
+    file_id, content = uploaded_file
+    response = client.get(f"/f/{file_id}", headers={
+        "Authorization": f"Bearer {get_token()}", "Range": f"bytes={len(content)}-"})
+
+    assert response.status_code == 416
+    assert response.headers["content-range"] == f"bytes */{len(content)}"
+
+
+def test_download_share_link_file_range(uploaded_file):
+    file_id, content = uploaded_file
+    response = client.get(f"/f/{file_id}/share", headers={"Authorization": f"Bearer {get_token()}"})
+    share_url = response.json().get("share_url")
+
+    response = client.get(share_url, headers={"Range": "bytes=-100"})
+    assert response.status_code == 206
+    assert response.content == content[-100:]
+
+
+# Conditional requests
+
+def test_download_user_file_not_modified(quota, uploaded_file):
+    file_id, content = uploaded_file
+    response = client.get(f"/f/{file_id}", headers={"Authorization": f"Bearer {get_token()}"})
+    etag = response.headers["etag"]
+    downloaded = quota.total
+
+    response = client.get(f"/f/{file_id}", headers={
+        "Authorization": f"Bearer {get_token()}", "If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.headers["etag"] == etag
+    assert not response.content
+    # A 304 doesn't count against the download quota
+    assert quota.total == downloaded
+
+    response = client.get(f"/f/{file_id}", headers={
+        "Authorization": f"Bearer {get_token()}", "If-None-Match": '"old"'})
+    assert response.status_code == 200
+
+
+def test_get_user_files_not_modified():
+    token = get_token()
+    response = client.get("/me", headers={"Authorization": f"Bearer {token}"})
+    assert response.status_code == 200
+    etag = response.headers["etag"]
+
+    response = client.get("/me", headers={"Authorization": f"Bearer {token}", "If-None-Match": etag})
+    assert response.status_code == 304
+
+    # The ETag changes when the list of files changes
+    response = client.put("/me/house_etag.txt", data=b"etag", headers={"Authorization": f"Bearer {token}"})
+    assert response.status_code == 200
+    response = client.get("/me", headers={"Authorization": f"Bearer {token}", "If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["etag"] != etag
+
+
+# File cache
+
+def test_download_user_file_from_cache(quota, uploaded_file):
+    file_id, content = uploaded_file
+    client.get(f"/f/{file_id}", headers={"Authorization": f"Bearer {get_token()}"})
+    hits = file_cache.hits
+
+    response = client.get(f"/f/{file_id}", headers={
+        "Authorization": f"Bearer {get_token()}", "Range": "bytes=100-199"})
+    assert response.status_code == 206
+    assert response.content == content[100:200]
+    assert file_cache.hits == hits + 1
+    assert quota.total > 100  # The cached download is charged too
+
+
+def test_download_user_file_without_cache(quota, uploaded_file, monkeypatch):
+    monkeypatch.setattr(file_cache, "max_bytes", 0)
+    file_id, content = uploaded_file
+    hits, misses = file_cache.hits, file_cache.misses
+
+    response = client.get(f"/f/{file_id}", headers={
+        "Authorization": f"Bearer {get_token()}", "Range": "bytes=0-9,-10"})
+    assert response.status_code == 206
+    assert content[:10] in response.content
+    assert content[-10:] in response.content
+    assert (file_cache.hits, file_cache.misses) == (hits, misses)
+
+
+def test_overwritten_file_is_not_served_from_cache(quota):
+    token = get_token()
+    response = client.put("/me/cached.txt", data=b"first version", headers={"Authorization": f"Bearer {token}"})
+    file_url = response.json().get("url")
+    assert client.get(file_url, headers={"Authorization": f"Bearer {get_token()}"}).content == b"first version"
+
+    client.put("/me/cached.txt", data=b"second version", headers={"Authorization": f"Bearer {get_token()}"})
+    assert client.get(file_url, headers={"Authorization": f"Bearer {get_token()}"}).content == b"second version"
+
+
+def test_cache_of_a_shared_blob_outlives_its_files(quota):
+    content = b"same content in two files"
+    checksum = hashlib.sha256(content).hexdigest()
+    first_url = client.put("/me/shared-1.txt", data=content, headers={"Authorization": f"Bearer {get_token()}"}).json()["url"]
+    second_url = client.put("/me/shared-2.txt", data=content, headers={"Authorization": f"Bearer {get_token()}"}).json()["url"]
+    assert client.get(first_url, headers={"Authorization": f"Bearer {get_token()}"}).content == content
+
+    # Overwriting a file doesn't drop the cache of the other one
+    client.put("/me/shared-1.txt", data=b"overwritten", headers={"Authorization": f"Bearer {get_token()}"})
+    hits = file_cache.hits
+    assert client.get(second_url, headers={"Authorization": f"Bearer {get_token()}"}).content == content
+    assert file_cache.hits == hits + 1
+
+    # The entry is dropped with the blob
+    client.put("/me/shared-2.txt", data=b"overwritten", headers={"Authorization": f"Bearer {get_token()}"})
+    while deletion_queue.drain(1000):
+        pass
+    assert not os.path.exists(blob_store.path(checksum))
+    assert file_cache.get(checksum) is None
+
+
+# Reverse proxy offload
+
+def test_download_user_file_offloaded(quota, uploaded_file, monkeypatch):
+    monkeypatch.setattr(settings, "DOWNLOAD_OFFLOAD", "x-accel-redirect")
+    file_id, content = uploaded_file
+    checksum = hashlib.sha256(content).hexdigest()
+
+    response = client.get(f"/f/{file_id}", headers={"Authorization": f"Bearer {get_token()}"})
+    assert response.status_code == 200
+    assert not response.content
+    assert response.headers["x-accel-redirect"] == f"/internal/blobs/{checksum[:2]}/{checksum}"
+    assert response.headers["content-type"] == "image/jpeg"
+    # The whole file is charged, the proxy doesn't tell how much it sent
+    assert quota.total == len(content)
+
+
+def test_download_share_link_offloaded(uploaded_file, monkeypatch):
+    monkeypatch.setattr(settings, "DOWNLOAD_OFFLOAD", "x-sendfile")
+    file_id, content = uploaded_file
+    checksum = hashlib.sha256(content).hexdigest()
+    response = client.get(f"/f/{file_id}/share", headers={"Authorization": f"Bearer {get_token()}"})
+    share_url = response.json().get("share_url")
+    references = blob_store.refs[checksum]
+
+    response = client.get(share_url)
+    assert response.status_code == 200
+    assert response.headers["x-sendfile"] == os.path.abspath(blob_store.path(checksum))
+    # The share link reference is kept until the proxy had time to open the file
+    assert blob_store.refs[checksum] == references
+
+
+@pytest.mark.parametrize("link", ["file", "signed share"])
+def test_offloaded_file_overwritten_keeps_its_blob(quota, link, monkeypatch):
+    monkeypatch.setattr(settings, "DOWNLOAD_OFFLOAD", "x-accel-redirect")
+    monkeypatch.setattr(settings, "DOWNLOAD_OFFLOAD_GRACE_SECONDS", 0)
+    monkeypatch.setattr(settings, "SHARE_LINK_FORMAT", "signed")
+    headers = {"Authorization": f"Bearer {get_token()}"}
+    content = f"offloaded {link}".encode()
+    checksum = hashlib.sha256(content).hexdigest()
+    url = client.put("/me/offloaded.txt", data=content, headers=headers).json()["url"]
+    if link == "signed share":
+        url = client.get(f"{url}/share", headers=headers).json()["share_url"]
+
+    assert client.get(url, headers=headers).status_code == 200
+    assert blob_store.refs[checksum] == 2
+    # The file is overwritten before the proxy opens the blob, the download keeps its reference
+    client.put("/me/offloaded.txt", data=b"overwritten", headers=headers)
+    assert blob_store.refs[checksum] == 1
+    assert os.path.exists(blob_store.path(checksum))
+
+    # Released after the grace period
+    expiry_index.sweep(datetime.now(), 1000)
+    assert blob_store.refs.get(checksum, 0) == 0
+
+
+# Pages of files
+
+def test_get_user_files_pages():
+    names = [file.name for file in db["users"][settings.DEMO_USER_ID]["files"]]
+    listed, cursor = [], None
+    while True:
+        params = {"limit": 3}
+        if cursor:
+            params["cursor"] = cursor
+        response = client.get("/me", params=params, headers={"Authorization": f"Bearer {get_token()}"})
+        assert response.status_code == 200
+        listed += [file["name"] for file in response.json()["files"]]
+        cursor = response.json().get("next_cursor")
+        if not cursor:
+            break
+    assert listed == names
+
+
+def test_get_user_files_filtered():
+    client.put("/me/paged.txt", data=b"paged", headers={"Authorization": f"Bearer {get_token()}"})
+    response = client.get("/me", params={"name_prefix": "paged", "max_size": 5},
+                          headers={"Authorization": f"Bearer {get_token()}"})
+    assert response.status_code == 200
+    assert [file["name"] for file in response.json()["files"]] == ["paged.txt"]
+    assert "next_cursor" not in response.json()
+
+
+def test_get_user_files_invalid_cursor():
+    response = client.get("/me", params={"limit": 1}, headers={"Authorization": f"Bearer {get_token()}"})
+    cursor = response.json()["next_cursor"]
+    # A cursor only continues the pages of the same filters
+    response = client.get("/me", params={"cursor": cursor, "name_prefix": "a"},
+                          headers={"Authorization": f"Bearer {get_token()}"})
+    assert response.status_code == 400
+    response = client.get("/me", params={"cursor": "not a cursor"}, headers={"Authorization": f"Bearer {get_token()}"})
+    assert response.status_code == 400
+
+
+# Fast responses
+
+def test_get_user_files_fast_responses(monkeypatch):
+    headers = {"Authorization": f"Bearer {get_token()}"}
+    response = client.get("/me", headers=headers)
+    page = client.get("/me", params={"limit": 2}, headers=headers)
+
+    monkeypatch.setattr(settings, "FAST_RESPONSES", True)
+    fast_response = client.get("/me", headers=headers)
+    assert fast_response.status_code == 200
+    assert fast_response.headers["content-type"] == "application/json"
+    assert fast_response.headers["etag"] == response.headers["etag"]
+    assert fast_response.json() == response.json()
+    assert client.get("/me", params={"limit": 2}, headers=headers).json() == page.json()
+
+    # The JSON of each file is kept on its record
+    user_files = db["users"][settings.DEMO_USER_ID]["files"]
+    if settings.STATE_BACKEND == "memory":
+        assert all(file._json is not None for file in user_files)
+
+
+def test_upload_fast_responses(monkeypatch):
+    monkeypatch.setattr(settings, "FAST_RESPONSES", True)
+    response = client.put("/me/fast.txt", data=b"fast", headers={"Authorization": f"Bearer {get_token()}"})
+    assert response.status_code == 200
+    assert set(response.json()) == {"name", "url"}
+    assert response.json()["name"] == "fast.txt"
+
+
+# ZIP archives
+
+def test_download_user_archive(quota, uploaded_file):
+    file_id, content = uploaded_file
+    client.put("/me/notes.txt", data=b"notes " * 1000, headers={
+        "Authorization": f"Bearer {get_token()}", "Content-Type": "text/plain"})
+
+    response = client.get("/me/archive", headers={"Authorization": f"Bearer {get_token()}"})
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/zip"
+    archive = zipfile.ZipFile(io.BytesIO(response.content))
+    assert archive.testzip() is None
+    names = [file.name for file in db["users"][settings.DEMO_USER_ID]["files"]]
+    assert archive.namelist() == names
+    assert archive.read("house_ranges.jpg") == content
+    assert archive.read("notes.txt") == b"notes " * 1000
+    # Images are stored as they are, text is deflated
+    assert archive.getinfo("house_ranges.jpg").compress_type == zipfile.ZIP_STORED
+    assert archive.getinfo("notes.txt").compress_type == zipfile.ZIP_DEFLATED
+    # The bytes sent are charged
+    assert quota.total == len(response.content)
+
+
+def test_download_user_archive_of_some_files(quota, uploaded_file):
+    file_id, content = uploaded_file
+    response = client.get("/me/archive", params={"ids": [file_id, file_id]},
+                          headers={"Authorization": f"Bearer {get_token()}"})
+    assert response.status_code == 200
+    archive = zipfile.ZipFile(io.BytesIO(response.content))
+    assert archive.namelist() == ["house_ranges.jpg"]
+
+    response = client.get("/me/archive", params={"ids": [file_id, "unknown"]},
+                          headers={"Authorization": f"Bearer {get_token()}"})
+    assert response.status_code == 404
+
+
+def test_download_user_archive_zip64_entries(quota, uploaded_file, monkeypatch):
+    # Entries close to 4 GiB announce their sizes in ZIP64 records
+    monkeypatch.setattr(archive_module, "ZIP64_ENTRY_SIZE", 0)
+    file_id, content = uploaded_file
+    response = client.get("/me/archive", params={"ids": [file_id]}, headers={"Authorization": f"Bearer {get_token()}"})
+    archive = zipfile.ZipFile(io.BytesIO(response.content))
+    assert archive.read("house_ranges.jpg") == content
+
+
+def test_download_user_archive_opens_one_file_at_a_time(quota, uploaded_file, monkeypatch):
+    user_files = list(db["users"][settings.DEMO_USER_ID]["files"])
+    refs = {file.checksum: blob_store.refs.get(file.checksum) for file in user_files}
+    cached_bytes = file_cache.size
+    open_files = []
+    most_open = 0
+
+    def open_file(*args):
+        nonlocal most_open
+        source = real_open_file(*args)
+        open_files.append(source)
+        most_open = max(most_open, len(open_files))
+        return source
+
+    def close_file(source):
+        open_files.remove(source)
+        real_close_file(source)
+
+    real_open_file, real_close_file = archive_module.open_file, archive_module.close_file
+    monkeypatch.setattr(archive_module, "open_file", open_file)
+    monkeypatch.setattr(archive_module, "close_file", close_file)
+    response = client.get("/me/archive", headers={"Authorization": f"Bearer {get_token()}"})
+    assert response.status_code == 200
+    assert len(zipfile.ZipFile(io.BytesIO(response.content)).namelist()) == len(user_files)
+
+    assert most_open == 1 and not open_files
+    # The archive doesn't fill the file cache, and the references to the blobs are released
+    assert file_cache.size <= cached_bytes
+    assert {checksum: blob_store.refs.get(checksum) for checksum in refs} == refs
+
+
+def test_download_user_archive_quota_exceeded(quota):
+    quota.consume(settings.DOWNLOAD_QUOTA_TRAFFIC, datetime.now(), "test")
+    response = client.get("/me/archive", headers={"Authorization": f"Bearer {get_token()}"})
+    assert response.status_code == 429
+
+
+def test_is_compressed():
+    assert is_compressed("image/jpeg")
+    assert is_compressed("application/zip")
+    assert not is_compressed("image/svg+xml")
+    assert not is_compressed("text/plain; charset=utf-8")
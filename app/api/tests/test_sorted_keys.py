@@ -0,0 +1,55 @@
+import random
+
+import pytest
+
+from api.core.sorted_keys import SortedKeys
+
+
+def test_sorted_keys_against_a_sorted_list():
+    keys = SortedKeys(load=4)
+    expected = set()
+    rng = random.Random(7)
+    for _ in range(2000):
+        key = rng.randrange(500)
+        if key in expected:
+            keys.remove(key)
+            expected.remove(key)
+        else:
+            keys.add(key)
+            expected.add(key)
+    assert list(keys) == sorted(expected)
+    assert len(keys) == len(expected)
+
+
+def test_sorted_keys_update():
+    keys = SortedKeys(load=4)
+    keys.update([5, 3, 9, 1, 7, 11, 13, 15, 17, 19])
+    assert list(keys) == [1, 3, 5, 7, 9, 11, 13, 15, 17, 19]
+    assert len(keys) == 10
+    assert list(keys.irange(8))[:2] == [9, 11]
+
+    # Keys of a set that isn't empty are added one by one
+    keys.update([4, 20])
+    keys.remove(9)
+    assert list(keys) == [1, 3, 4, 5, 7, 11, 13, 15, 17, 19, 20]
+
+
+def test_sorted_keys_range():
+    keys = SortedKeys(load=2)
+    for key in range(0, 40, 2):
+        keys.add(key)
+    assert list(keys.irange(10))[:3] == [10, 12, 14]
+    assert list(keys.irange(10, exclusive=True))[:3] == [12, 14, 16]
+    assert list(keys.irange(11))[:2] == [12, 14]
+    assert list(keys.irange(38, exclusive=True)) == []
+    assert list(keys.irange(100)) == []
+
+
+def test_sorted_keys_remove_missing():
+    keys = SortedKeys()
+    keys.add("a")
+    with pytest.raises(KeyError):
+        keys.remove("b")
+    keys.remove("a")
+    with pytest.raises(KeyError):
+        keys.remove("a")
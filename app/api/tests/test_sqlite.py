@@ -0,0 +1,215 @@
+import hashlib
+import multiprocessing
+import os
+import sys
+import threading
+from collections import Counter
+from datetime import datetime, timedelta
+
+import pytest
+
+from api.storage import sqlite
+from api.storage.records import FileRecord, ShareLinkRecord, TokenRecord
+
+
+@pytest.fixture
+def state(tmp_path):
+    return sqlite.SqliteState(str(tmp_path / "state.db"))
+
+
+def make_file(file_id: str, name: str, checksum: str = "ab12") -> FileRecord:
+    return FileRecord(name=name, route=f"./blobs/{checksum}", id=file_id,
+                      media_type="text/plain", size=10, checksum=checksum)
+
+
+def test_sqlite_file_store(state):
+    files = sqlite.SqliteFileStore(state, "user")
+    etag = files.etag
+    files.add(make_file("a", "a.txt"))
+    files.add(make_file("b", "b.txt"))
+
+    assert files.etag != etag
+    assert len(files) == 2
+    assert "a" in files
+    assert files.get_by_name("b.txt").id == "b"
+    with pytest.raises(ValueError):
+        files.add(make_file("c", "a.txt"))
+
+    # Replacing a file keeps its position
+    files.put(make_file("a", "a.txt", checksum="cd34"))
+    assert [file.checksum for file in files] == ["cd34", "ab12"]
+    assert files.pop_victim().id == "a"
+    assert [file.id for file in files] == ["b"]
+    # Other users and other processes see their own files, with the same etag
+    assert len(sqlite.SqliteFileStore(state, "other")) == 0
+    assert sqlite.SqliteFileStore(state, "user").etag == files.etag
+
+
+@pytest.mark.parametrize("policy,victims", [
+    ("fifo", ["a", "b", "c"]),
+    ("lru", ["c", "a", "b"]),
+    ("lfu", ["c", "b", "a"]),
+    ("size", ["b", "c", "a"]),
+])
+def test_sqlite_file_store_eviction_policies(state, policy, victims):
+    files = sqlite.SqliteFileStore(state, policy, policy)
+    for file_id, size in (("a", 10), ("b", 5000), ("c", 20)):
+        files.add(make_file(file_id, f"{file_id}.txt").replace(size=size))
+    for file_id in ("a", "a", "b"):
+        files.touch(file_id)
+
+    assert [files.pop_victim().id for _ in range(3)] == victims
+
+
+def test_sqlite_token_calls_are_consumed_once(state):
+    tokens = sqlite.SqliteTokenStore(state)
+    tokens.add(TokenRecord(id="token", expires_at=datetime.now() + timedelta(minutes=1), available_calls=50, user_id="user"))
+
+    results = []
+    def use_token():
+        for _ in range(10):
+            results.append(tokens.consume_call("token"))
+
+    threads = [threading.Thread(target=use_token) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    calls_left = [calls for calls in results if calls is not None]
+    assert sorted(calls_left) == list(range(50))
+    assert tokens.get("token").available_calls == 0
+    assert tokens.get("token").user_id == "user"
+
+
+def test_sqlite_user_registry(state):
+    users = sqlite.SqliteUserRegistry(state)
+
+    assert users.add("user", b"hash")
+    assert not users.add("user", b"other hash")
+    assert "user" in users and "other" not in users
+    assert users.get("user") == b"hash"
+    assert users.get("other") is None
+
+    users.put("user", b"new hash")
+    assert dict(users.items()) == {"user": b"new hash"}
+    assert len(users) == 1
+
+
+def test_sqlite_call_counters(state):
+    counters = sqlite.SqliteCallCounters(state)
+    expires_at = datetime.now() + timedelta(minutes=1)
+
+    assert counters.consume("nonce", 2, expires_at) == (1, True)
+    assert counters.consume("nonce", 2, expires_at) == (0, False)
+    assert counters.consume("nonce", 2, expires_at) == (None, False)
+    assert counters.remove("nonce")
+
+
+def test_sqlite_share_link_is_claimed_once(state):
+    share_links = sqlite.SqliteShareLinkStore(state)
+    share_links.add(ShareLinkRecord(id="abc", file=make_file("a", "a.txt"), owner="user"))
+
+    assert "abc" in share_links
+    assert share_links.claim("abc").file.name == "a.txt"
+    assert share_links.claim("abc") is None
+
+
+def test_sqlite_used_nonces(state):
+    used = sqlite.SqliteUsedNonces(state)
+    assert used.add("a", datetime.now() + timedelta(minutes=1))
+    assert not sqlite.SqliteUsedNonces(state).add("a", datetime.now() + timedelta(minutes=1))
+
+    # Expired nonces are purged
+    assert used.add("b", datetime.now() - timedelta(minutes=1))
+    used._purged_at = 0
+    assert used.add("c", datetime.now() + timedelta(minutes=1))
+    assert used.stats() == {"rows": 2}
+
+
+def test_sqlite_ref_counts(state):
+    refs = sqlite.SqliteRefCounts(state)
+    with refs.locked():
+        assert refs.incr("ab12") == 1
+        assert refs.incr("ab12") == 2
+    with refs.locked():
+        assert refs.decr("ab12") == 1
+        assert refs.decr("ab12") == 0
+    assert len(refs) == 0
+
+
+def test_sqlite_sliding_window_quota_is_shared(state):
+    now = datetime.now()
+    quota = sqlite.SqliteSlidingWindowQuota(state, "user", limit=100, window=timedelta(minutes=5))
+    other_worker = sqlite.SqliteSlidingWindowQuota(state, "user", limit=100, window=timedelta(minutes=5))
+
+    quota.consume(70, now, "file")
+    other_worker.consume(30, now + timedelta(minutes=3), "file")
+    assert quota.remaining(now + timedelta(minutes=4)) == 0
+    assert other_worker.remaining(now + timedelta(minutes=6)) == 70
+    assert quota.remaining(now + timedelta(minutes=9)) == 100
+
+
+def test_sqlite_token_bucket_quota_refills(state):
+    now = datetime.now()
+    quota = sqlite.SqliteTokenBucketQuota(state, "user", limit=100, window=timedelta(minutes=5))
+    quota.consume(150, now, "file")
+
+    assert quota.remaining(now) == -50
+    assert quota.remaining(now + timedelta(minutes=5)) == 50
+    assert quota.remaining(now + timedelta(minutes=20)) == 100
+
+
+def test_sqlite_transactions_nest(state):
+    refs = sqlite.SqliteRefCounts(state)
+    with pytest.raises(RuntimeError):
+        with state.transaction():
+            with refs.locked():
+                refs.incr("ab12")
+            raise RuntimeError()
+    # The inner transaction joined the outer one, which was rolled back
+    assert len(refs) == 0
+
+
+def upload_from_worker(directory: str, rounds: int):
+    """ Uploads files of the demo user as another worker of the api, exits with the number of failed uploads """
+    os.chdir(directory)
+    from api.config import settings
+    from api.routes.files import get_user_directory, store_user_file
+    from api.storage.uploads import StoredUpload
+
+    user_directory = get_user_directory(settings.DEMO_USER_ID)
+    failures = 0
+    for i in range(rounds):
+        # The names and contents repeat, in the other worker too, to overwrite, evict and share blobs
+        content = str(i % 7).encode()
+        path = os.path.join(user_directory, f"upload-{os.getpid()}-{i}")
+        with open(path, "wb") as file:
+            file.write(content)
+        upload = StoredUpload(f"file-{i % 8}.txt", "text/plain", len(content), hashlib.sha256(content).hexdigest(), path)
+        try:
+            store_user_file(settings.DEMO_USER_ID, upload)
+        except Exception:
+            failures += 1
+    sys.exit(failures)
+
+
+def test_sqlite_uploads_of_several_workers(tmp_path, monkeypatch):
+    monkeypatch.setenv("STATE_BACKEND", "sqlite")
+    monkeypatch.setenv("SQLITE_PATH", str(tmp_path / "state.db"))
+    monkeypatch.setenv("USER_MAX_FILES", "5")
+    context = multiprocessing.get_context("spawn")
+    workers = [context.Process(target=upload_from_worker, args=(str(tmp_path), 200)) for _ in range(2)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    assert [worker.exitcode for worker in workers] == [0, 0]
+
+    # Every blob reference belongs to a stored file, and every referenced blob exists
+    connection = sqlite.SqliteState(str(tmp_path / "state.db")).connection
+    checksums = Counter(row[0] for row in connection.execute("SELECT checksum FROM files"))
+    assert 0 < sum(checksums.values()) <= 5
+    assert dict(connection.execute("SELECT checksum, refs FROM blob_refs").fetchall()) == checksums
+    for checksum in checksums:
+        assert (tmp_path / "files" / "blobs" / checksum[:2] / checksum).exists()
@@ -0,0 +1,20 @@
+from fastapi.testclient import TestClient
+
+from api.config import settings
+from api.main import app
+
+client = TestClient(app)
+
+
+def test_stats_disabled_without_token():
+    assert client.get("/stats").status_code == 404
+
+
+def test_stats_require_the_token(monkeypatch):
+    monkeypatch.setattr(settings, "STATS_TOKEN", "monitoring token")
+    assert client.get("/stats").status_code == 401
+    assert client.get("/stats", headers={"Authorization": "Bearer other token"}).status_code == 401
+
+    response = client.get("/stats", headers={"Authorization": "Bearer monitoring token"})
+    assert response.status_code == 200
+    assert set(response.json()["expiry"]) == {"entries", "live", "swept"}
@@ -0,0 +1,79 @@
+import threading
+import time
+
+import pytest
+
+from api.core.locks import user_locks
+from api.storage.users import UserPartitions, UserRegistry
+
+
+def make_partitions(idle_seconds: float = 0) -> UserPartitions:
+    registry = UserRegistry()
+    registry.add("user", b"hash")
+    return UserPartitions(registry, lambda user_id: {"files": []}, lambda user: not user["files"], idle_seconds)
+
+
+def test_user_registry_add_is_exclusive():
+    registry = UserRegistry()
+    assert registry.add("user", b"hash")
+    assert not registry.add("user", b"other hash")
+    assert registry.get("user") == b"hash"
+    assert len(registry) == 1
+
+
+def test_partition_is_loaded_on_first_access():
+    partitions = make_partitions()
+    assert partitions.items() == []
+    assert len(partitions) == 1
+
+    partition = partitions["user"]
+    assert partitions["user"] is partition
+    assert partitions.items() == [("user", partition)]
+
+
+def test_unregistered_user_has_no_partition():
+    partitions = make_partitions()
+    with pytest.raises(KeyError):
+        partitions["other"]
+    assert partitions.get("other") is None
+    assert partitions.items() == []
+
+
+def test_idle_partition_is_released():
+    partitions = make_partitions()
+    partitions["user"]["files"].append("file")
+
+    # A partition with state to keep stays loaded
+    assert not partitions.release("user")
+    assert partitions.stats()["loaded"] == 1
+
+    partitions["user"]["files"].clear()
+    assert partitions.release("user")
+    assert partitions.stats() == {"registered": 1, "loaded": 0, "released": 1}
+    assert partitions["user"] == {"files": []}
+
+
+def test_recently_used_partition_is_not_released():
+    partitions = make_partitions(idle_seconds=60)
+    partitions["user"]
+    assert not partitions.release("user")
+    assert partitions.stats()["loaded"] == 1
+
+
+def test_partition_taken_while_released_is_kept():
+    partitions = make_partitions(idle_seconds=60)
+    partition = partitions["user"]
+    partitions._accessed_at["user"] -= 120
+
+    # A request takes the partition under the user lock while the release waits for it
+    released = []
+    with user_locks("user"):
+        releaser = threading.Thread(target=lambda: released.append(partitions.release("user")))
+        releaser.start()
+        time.sleep(0.05)
+        assert partitions["user"] is partition
+    releaser.join()
+
+    assert released == [False]
+    partition["files"].append("file")
+    assert partitions["user"] is partition
@@ -0,0 +1,81 @@
+""" Benchmark of the authentication overhead per request
+
+Drives a small ASGI app directly, with an async route that only depends on the user of the
+request and the same route without authentication. The difference is the cost of authenticating
+a request with the dependencies of the api.
+Run it from the app folder: `python -m benchmarks.bench_auth`
+"""
+import asyncio
+import time
+
+from fastapi import Depends, FastAPI
+
+from api.auth import deps
+from api.config import settings
+from api.database import db
+from api.storage.stores import CallCounters, TokenStore
+
+REQUESTS = 5_000
+ROUNDS = 5  # The best round is reported
+
+app = FastAPI()
+
+
+@app.get("/anonymous")
+async def anonymous():
+    return None
+
+
+@app.get("/user")
+async def user(user_id: str = Depends(deps.get_current_user)):
+    return None
+
+
+async def request(path: str, token: str) -> int:
+    scope = {
+        "type": "http", "http_version": "1.1", "method": "GET", "scheme": "http", "path": path,
+        "raw_path": path.encode(), "root_path": "", "query_string": b"", "server": ("bench", 80),
+        "client": ("bench", 1), "headers": [(b"host", b"bench"), (b"authorization", f"Bearer {token}".encode())],
+    }
+    status = None
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+
+    await app(scope, receive, send)
+    return status
+
+
+async def run(path: str, token: str) -> float:
+    best = float("inf")
+    for _ in range(ROUNDS):
+        start = time.perf_counter()
+        for _ in range(REQUESTS):
+            assert await request(path, token) == 200
+        best = min(best, time.perf_counter() - start)
+    return best / REQUESTS
+
+
+def main():
+    settings.ACCESS_TOKEN_EXPIRE_QUOTA = ROUNDS * REQUESTS
+    db["access_tokens"] = TokenStore()
+    db["token_calls"] = CallCounters()
+
+    loop = asyncio.new_event_loop()
+    baseline = loop.run_until_complete(run("/anonymous", "none"))
+    print(f"{'token':>8} {'request (us)':>13} {'auth (us)':>10}")
+    print(f"{'none':>8} {baseline * 1e6:>13.1f} {0:>10.1f}")
+    for token_format in ("opaque", "signed"):
+        settings.ACCESS_TOKEN_FORMAT = token_format
+        token = deps.generate_access_token(settings.DEMO_USER_ID)
+        elapsed = loop.run_until_complete(run("/user", token))
+        print(f"{token_format:>8} {elapsed * 1e6:>13.1f} {(elapsed - baseline) * 1e6:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+""" Benchmark of the download responses
+
+Drives the ASGI responses of api.responses directly, without the routes and the HTTP server.
+The bodies are written to /dev/null, as the server would write them to the socket.
+Run it from the app folder:
+    `python -m benchmarks.bench_downloads`: small files, from disk and from the file cache.
+    `python -m benchmarks.bench_downloads large [MB]`: large file, reopened against the fd cache.
+"""
+import asyncio
+import hashlib
+import os
+import sys
+import tempfile
+import time
+
+from starlette.requests import Request
+
+from api.responses import FileRangeResponse, file_response
+from api.storage.fd_cache import fd_cache
+from api.storage.file_cache import file_cache
+
+SIZES = [1024, 16 * 1024, 256 * 1024]
+DOWNLOADS = 2_000
+
+
+async def download(path: str, checksum: str, size: int) -> int:
+    scope = {"type": "http", "method": "GET", "path": "/", "headers": []}
+    response = file_response(Request(scope), path, "bench.bin", "application/octet-stream", checksum=checksum)
+    received = 0
+    sink = os.open(os.devnull, os.O_WRONLY)
+
+    async def receive():
+        await asyncio.sleep(3600)  # The client never disconnects
+
+    async def send(message):
+        nonlocal received
+        if message.get("body"):
+            os.write(sink, message["body"])
+            received += len(message["body"])
+
+    try:
+        await response(scope, receive, send)
+    finally:
+        os.close(sink)
+    return received
+
+
+async def run(path: str, checksum: str, size: int, downloads: int):
+    start, cpu_start = time.perf_counter(), time.process_time()
+    for _ in range(downloads):
+        assert await download(path, checksum, size) == size
+    return time.perf_counter() - start, time.process_time() - cpu_start
+
+
+def write_file(directory: str, size: int):
+    content = os.urandom(size)
+    checksum = hashlib.sha256(content).hexdigest()
+    path = os.path.join(directory, checksum)
+    with open(path, "wb") as file:
+        file.write(content)
+    return path, checksum
+
+
+def small_files():
+    print(f"{'size':>8} {'disk (us)':>12} {'cache (us)':>12}")
+    with tempfile.TemporaryDirectory() as directory:
+        for size in SIZES:
+            path, checksum = write_file(directory, size)
+            file_cache.max_bytes = 0
+            disk, _ = asyncio.run(run(path, checksum, size, DOWNLOADS))
+            file_cache.max_bytes = 64 * 1024 ** 2
+            cache, _ = asyncio.run(run(path, checksum, size, DOWNLOADS))
+            print(f"{size:>8} {disk / DOWNLOADS * 1e6:>12.1f} {cache / DOWNLOADS * 1e6:>12.1f}")
+
+
+def large_file(megabytes: int):
+    size = megabytes * 1024 ** 2
+    downloads = max(1, 2048 // megabytes)
+    gigabytes = size * downloads / 1024 ** 3
+    print(f"{downloads} downloads of {megabytes} MB")
+    print(f"{'mode':>28} {'MB/s':>8} {'cpu s/GB':>9}")
+    with tempfile.TemporaryDirectory() as directory:
+        path, checksum = write_file(directory, size)
+        modes = [
+            ("reopen, pread 64 KiB", 64 * 1024, 0),
+            ("fd cache, pread 256 KiB", 256 * 1024, 256),
+        ]
+        for name, chunk_size, max_entries in modes:
+            FileRangeResponse.chunk_size = chunk_size
+            fd_cache.max_entries = max_entries
+            elapsed, cpu = asyncio.run(run(path, checksum, size, downloads))
+            print(f"{name:>28} {size * downloads / 1024 ** 2 / elapsed:>8.0f} {cpu / gigabytes:>9.2f}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "large":
+        large_file(int(sys.argv[2]) if len(sys.argv) > 2 else 1024)
+    else:
+        small_files()
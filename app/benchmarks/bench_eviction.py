@@ -0,0 +1,42 @@
+""" Micro-benchmark of the eviction policies
+
+Cost of evicting a file and adding a new one on a full store, against the previous `del files[0]` on a list.
+Run it from the app folder: `python -m benchmarks.bench_eviction`
+"""
+import random
+import timeit
+
+from api.core.eviction import EVICTION_POLICIES
+
+SIZES = [100, 10_000, 1_000_000]
+OPERATIONS = 10_000
+
+
+def main():
+    print(f"{'files':>8} {'list (us)':>10} " + " ".join(f"{name + ' (us)':>11}" for name in EVICTION_POLICIES))
+    for size in SIZES:
+        files = [f"{i:08x}" for i in range(size)]
+
+        def evict_list():
+            del files[0]
+            files.append("new")
+        results = [timeit.timeit(evict_list, number=OPERATIONS)]
+
+        for policy_class in EVICTION_POLICIES.values():
+            policy = policy_class()
+            for i in range(size):
+                policy.add(f"{i:08x}", random.randrange(1 << 30))
+            downloads = [f"{random.randrange(size):08x}" for _ in range(OPERATIONS)]
+            new_ids = iter(range(size, size + OPERATIONS))
+
+            def evict():
+                policy.access(downloads[len(policy) % OPERATIONS])
+                policy.pop()
+                policy.add(f"{next(new_ids):08x}", 1024)
+            results.append(timeit.timeit(evict, number=OPERATIONS))
+
+        print(f"{size:>8} " + " ".join(f"{elapsed / OPERATIONS * 1e6:>10.2f} " for elapsed in results))
+
+
+if __name__ == "__main__":
+    main()
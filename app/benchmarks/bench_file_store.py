@@ -0,0 +1,85 @@
+""" Micro-benchmark of the file lookups done by the files router
+
+Compares the indexed FileStore against the previous linear scan over a list.
+Run it from the app folder: `python -m benchmarks.bench_file_store`
+`python -m benchmarks.bench_file_store pages` times a page of GET /me against the whole list.
+"""
+import random
+import sys
+import timeit
+
+from api.schemas.file import BaseFile
+from api.storage.file_store import FileStore, PageFilters
+from api.storage.records import FileRecord
+
+SIZES = [10, 100, 1_000, 10_000, 100_000]
+LOOKUPS = 1_000
+PAGE_SIZES = [1_000, 100_000, 1_000_000]
+PAGE_LIMIT = 100
+MEDIA_TYPES = ["text/plain", "image/png", "image/jpeg", "application/pdf"]
+
+
+def make_files(amount: int):
+    return [
+        FileRecord(
+            name=f"file{i}.txt",
+            route=f"./files/bench/{i:08x}",
+            id=f"{i:08x}",
+            media_type=MEDIA_TYPES[i % len(MEDIA_TYPES)],
+            size=i
+        )
+        for i in range(amount)
+    ]
+
+
+def linear_get(files, file_id):
+    for file_data in files:
+        if file_data.id == file_id:
+            return file_data
+    return None
+
+
+def main():
+    print(f"{'files':>8} {'list scan (us)':>16} {'store.get (us)':>16} {'store.get_by_name (us)':>24}")
+    for size in SIZES:
+        files = make_files(size)
+        store = FileStore()
+        for file in files:
+            store.add(file)
+        targets = [random.choice(files) for _ in range(LOOKUPS)]
+
+        scan = timeit.timeit(lambda: [linear_get(files, t.id) for t in targets], number=1)
+        by_id = min(timeit.repeat(lambda: [store.get(t.id) for t in targets], number=1, repeat=5))
+        by_name = min(timeit.repeat(lambda: [store.get_by_name(t.name) for t in targets], number=1, repeat=5))
+
+        print(f"{size:>8} {scan / LOOKUPS * 1e6:>16.3f} {by_id / LOOKUPS * 1e6:>16.3f} {by_name / LOOKUPS * 1e6:>24.3f}")
+
+
+def pages():
+    filters = {
+        "upload": PageFilters(),
+        "name": PageFilters(name_prefix="file1"),
+        "media_type": PageFilters(media_type="image/png"),
+        "size": PageFilters(min_size=500),
+    }
+    print(f"{'files':>8} {'add (us)':>9} {'whole list (ms)':>16} " + " ".join(f"{order + ' (us)':>16}" for order in filters))
+    for size in PAGE_SIZES:
+        files = make_files(size)
+        store = FileStore()
+        add = timeit.timeit(lambda: [store.add(file) for file in files], number=1)
+        whole = "" if size > 100_000 else f"{timeit.timeit(lambda: [BaseFile(**dict(f)) for f in store], number=1) * 1e3:.1f}"
+        timings = []
+        for page_filters in filters.values():
+            # A page in the middle of the files, after the first one
+            _, after = store.page(page_filters, PAGE_LIMIT)
+            timings.append(min(timeit.repeat(
+                lambda: [BaseFile(name=f.name, url=f.url) for f in store.page(page_filters, PAGE_LIMIT, after)[0]],
+                number=100, repeat=3)) / 100)
+        print(f"{size:>8} {add / size * 1e6:>9.2f} {whole:>16} " + " ".join(f"{t * 1e6:>16.1f}" for t in timings))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "pages":
+        pages()
+    else:
+        main()
@@ -0,0 +1,63 @@
+""" Benchmark of the db journal: append cost and restart time
+
+Run it from the app folder: `python -m benchmarks.bench_journal [records]`
+"""
+import gc
+import sys
+import tempfile
+import time
+import timeit
+
+from api.storage.journal import Journal
+from api.storage.file_store import FileStore
+from api.storage.records import FileRecord, file_columns, restore_files
+
+
+def make_file(i: int) -> FileRecord:
+    return FileRecord(
+        name=f"file{i}.txt",
+        route=f"./files/blobs/{i:064x}"[:80],
+        id=f"{i:08x}",
+        media_type="text/plain",
+        size=i,
+        checksum=f"{i:064x}"
+    )
+
+
+def main():
+    records = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    files = [make_file(i) for i in range(records)]
+
+    with tempfile.TemporaryDirectory() as directory:
+        for fsync_every in (1, 64, 1024):
+            journal = Journal()
+            journal.open(directory, fsync_every)
+            amount = min(records, 2_000)
+            elapsed = timeit.timeit(lambda: [journal.record("file_put", "user", file) for file in files[:amount]], number=1)
+            journal.close()
+            print(f"append, fsync every {fsync_every:>5}: {elapsed / amount * 1e6:>8.1f} us/record")
+
+        journal = Journal()
+        journal.open(directory)
+        start = time.perf_counter()
+        journal.snapshot(lambda: [("user_files", ("user", *file_columns(files)))])
+        print(f"snapshot of {records} files: {time.perf_counter() - start:.2f} s")
+        journal.close()
+
+        journal = Journal()
+        journal.open(directory)
+        # Rebuilds the files and their store as database.restore does, with the collector off
+        gc.disable()
+        start = time.perf_counter()
+        restored = [restore_files(*columns) for _, (_, *columns) in journal.replay()]
+        print(f"replay of {sum(map(len, restored))} files: {time.perf_counter() - start:.2f} s")
+        start = time.perf_counter()
+        store = FileStore()
+        for files in restored:
+            store.load(files)
+        print(f"indexing of {len(store)} files: {time.perf_counter() - start:.2f} s")
+        gc.enable()
+
+
+if __name__ == "__main__":
+    main()
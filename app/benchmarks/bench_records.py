@@ -0,0 +1,89 @@
+""" Benchmark of the memory of the db records: pydantic models against the slotted records
+
+Builds the records of each kind as the routes do (strings created per request) and reports
+the bytes allocated per record, measured with tracemalloc.
+Run it from the app folder: `python -m benchmarks.bench_records [records]`
+"""
+import gc
+import hashlib
+import sys
+import tracemalloc
+from datetime import datetime
+
+from pydantic import BaseModel
+
+from api.schemas.file import FileInDB, ShareUrlInDB
+from api.schemas.token import TokenInDB
+from api.storage.blobs import blob_store
+from api.storage.records import FileRecord, ShareLinkRecord, TokenRecord
+
+MEDIA_TYPES = ["text/plain", "image/png", "application/pdf", "video/mp4"]
+
+
+class DownloadRecord(BaseModel):
+    # Model of the downloads in the sliding window quotas before the tuples
+    timestamp: datetime
+    size: int
+    file_id: str
+
+
+def media_type(i: int) -> str:
+    # A new string per file, as parsed from the upload headers
+    return "/".join(MEDIA_TYPES[i % len(MEDIA_TYPES)].split("/"))
+
+
+def checksum(i: int) -> str:
+    return hashlib.sha256(str(i).encode()).hexdigest()
+
+
+def old_file(i: int) -> FileInDB:
+    file_id = f"{i:08x}"
+    return FileInDB(name=f"file{i}.txt", url=f"/f/{file_id}", route=blob_store.path(checksum(i)), id=file_id,
+                    media_type=media_type(i), size=i, checksum=checksum(i))
+
+
+def new_file(i: int) -> FileRecord:
+    return FileRecord(f"{i:08x}", f"file{i}.txt", blob_store.path(checksum(i)), media_type(i), i, checksum(i))
+
+
+def measure(build, count: int) -> float:
+    """ Returns the bytes allocated per record by `build`, without the list that holds them """
+    gc.collect()
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    records = [build(i) for i in range(count)]
+    allocated = tracemalloc.get_traced_memory()[0] - start - sys.getsizeof(records)
+    tracemalloc.stop()
+    del records
+    return allocated / count
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    now = datetime.now()
+    # The files of the share links are already stored, only the links are measured
+    old_files = [old_file(i) for i in range(count)]
+    new_files = [new_file(i) for i in range(count)]
+
+    kinds = [
+        ("file", old_file, new_file),
+        ("share link",
+         lambda i: ShareUrlInDB(share_url=f"/s/{i:06x}", id=f"{i:06x}", file=FileInDB(**dict(old_files[i])),
+                                owner="user", expires_at=now),
+         lambda i: ShareLinkRecord(f"{i:06x}", new_files[i], "user", now)),
+        ("access token",
+         lambda i: TokenInDB(id=f"{i:036x}", expires_at=now, available_calls=5000, user_id="user"),
+         lambda i: TokenRecord(f"{i:036x}", now, 5000, "user")),
+        ("download",
+         lambda i: DownloadRecord(timestamp=now, size=i, file_id=f"{i:08x}"),
+         lambda i: (now, i)),
+    ]
+    print(f"{count} records of each kind")
+    print(f"{'record':>14} {'before (B)':>11} {'after (B)':>10} {'ratio':>6}")
+    for name, before, after in kinds:
+        before_bytes, after_bytes = measure(before, count), measure(after, count)
+        print(f"{name:>14} {before_bytes:>11.0f} {after_bytes:>10.0f} {before_bytes / after_bytes:>6.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+""" Benchmark of the GET /me responses, standard against settings.FAST_RESPONSES
+
+Drives the whole app in process with the test client, the demo user gets `files` records.
+Run it from the app folder: `python -m benchmarks.bench_responses`
+"""
+import time
+
+from fastapi.testclient import TestClient
+
+from api.config import settings
+from api.database import db
+from api.main import app
+from api.storage.file_store import FileStore
+from api.storage.records import FileRecord
+
+SIZES = [100, 1_000, 10_000]
+REQUESTS = 50
+
+
+def cpu_per_request(client: TestClient, headers: dict, requests: int) -> float:
+    client.get("/me", headers=headers)  # Warm up, the fast mode caches the JSON of the files
+    start = time.process_time()
+    for _ in range(requests):
+        assert client.get("/me", headers=headers).status_code == 200
+    return (time.process_time() - start) / requests
+
+
+def main():
+    settings.ACCESS_TOKEN_EXPIRE_QUOTA = 10 ** 6
+    settings.ACCESS_TOKEN_EXPIRE_MINUTES = 60
+    client = TestClient(app)
+    response = client.post("/auth", files={
+        "user_id": (None, settings.DEMO_USER_ID), "password": (None, settings.DEMO_USER_PASSWORD)})
+    headers = {"Authorization": f"Bearer {response.json()['token']}"}
+
+    print(f"{'files':>8} {'standard (ms)':>14} {'fast (ms)':>10} {'saved':>7}")
+    for size in SIZES:
+        files = FileStore()
+        for i in range(size):
+            files.add(FileRecord(name=f"file{i}.txt", route=f"./files/bench/{i:08x}",
+                                 id=f"{i:08x}", media_type="text/plain", size=i))
+        db["users"][settings.DEMO_USER_ID]["files"] = files
+        requests = max(5, REQUESTS * 1_000 // size)
+
+        settings.FAST_RESPONSES = False
+        standard = cpu_per_request(client, headers, requests)
+        settings.FAST_RESPONSES = True
+        fast = cpu_per_request(client, headers, requests)
+        print(f"{size:>8} {standard * 1e3:>14.2f} {fast * 1e3:>10.2f} {1 - fast / standard:>7.0%}")
+
+
+if __name__ == "__main__":
+    main()
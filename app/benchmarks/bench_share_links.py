@@ -0,0 +1,52 @@
+""" Micro-benchmark of share link creation and validation
+
+Compares the stored share links against the signed ones, the download itself is not included.
+Run it from the app folder: `python -m benchmarks.bench_share_links`
+"""
+import timeit
+from datetime import datetime
+
+from api.config import settings
+from api.database import db
+from api.routes import files
+from api.storage.stores import ShareLinkStore
+from api.storage.records import FileRecord
+
+LINKS = 20_000
+FILE = FileRecord(name="bench.txt", route="./blobs/bench", id="bench",
+                  media_type="text/plain", size=10, checksum="bench")
+
+
+def validate(share_url: str, now: datetime):
+    share_id = share_url[3:]
+    if "." in share_id:
+        files.validate_signed_share_link(share_id, now)
+    elif db["share_links"].claim(share_id).expires_at < now:
+        raise ValueError("Expired share link")
+
+
+def run(share_link_format: str):
+    settings.SHARE_LINK_FORMAT = share_link_format
+    db["share_links"] = ShareLinkStore()
+    user_files = db["users"][settings.DEMO_USER_ID]["files"]
+    if FILE.id not in user_files:
+        user_files.add(FILE)
+
+    links = []
+    create = timeit.timeit(
+        lambda: links.append(files.generate_user_file_share_url(FILE.id, settings.DEMO_USER_ID).share_url),
+        number=LINKS)
+    stored = len(db["share_links"])
+    now = datetime.now()
+    check = timeit.timeit(lambda: [validate(link, now) for link in links], number=1)
+    print(f"{share_link_format:>8} {create / LINKS * 1e6:>12.2f} {check / LINKS * 1e6:>14.2f} {stored:>10}")
+
+
+def main():
+    print(f"{'format':>8} {'create (us)':>12} {'validate (us)':>14} {'db links':>10}")
+    run("stored")
+    run("signed")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,37 @@
+""" Micro-benchmark of access token issuance and validation
+
+Compares the stored opaque tokens against the signed ones.
+Run it from the app folder: `python -m benchmarks.bench_tokens`
+"""
+import timeit
+from datetime import datetime
+
+from api.auth import deps
+from api.config import settings
+from api.database import db
+from api.storage.stores import CallCounters, TokenStore
+
+TOKENS = 10_000
+
+
+def run(token_format: str):
+    settings.ACCESS_TOKEN_FORMAT = token_format
+    stored_tokens = db["access_tokens"] = TokenStore()
+    db["token_calls"] = CallCounters()
+
+    tokens = []
+    issue = timeit.timeit(lambda: tokens.append(deps.generate_access_token(settings.DEMO_USER_ID)), number=TOKENS)
+    now = datetime.now()
+    validate = timeit.timeit(lambda: [deps.get_user_access_token(token, now) for token in tokens], number=1)
+    stored = len(stored_tokens) + len(db["token_calls"])
+    print(f"{token_format:>8} {issue / TOKENS * 1e6:>12.2f} {validate / TOKENS * 1e6:>14.2f} {stored:>14}")
+
+
+def main():
+    print(f"{'format':>8} {'issue (us)':>12} {'validate (us)':>14} {'db entries':>14}")
+    run("opaque")
+    run("signed")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+""" Benchmark of the user registry: auth latency and memory with up to a million registered users
+
+Registers the users straight in the registry (their hashes are copies of one hash, hashing a
+million passwords would only measure PBKDF2), then drives the api ASGI app directly to log in and
+to make an authenticated request as random users. Logins verify a hash of LOGIN_ITERATIONS, the
+PBKDF2 cost of production hashes is the same whatever the number of users.
+Run it from the app folder: `python -m benchmarks.bench_users [users...]`
+"""
+import asyncio
+import gc
+import random
+import sys
+import time
+import tracemalloc
+from urllib.parse import urlencode
+
+from api.auth.passwords import hash_password
+from api.config import settings
+from api.database import db
+from api.main import app
+from api.storage.users import UserRegistry
+
+USERS = [1_000, 100_000, 1_000_000]
+LOGIN_ITERATIONS = 1_000
+REQUESTS = 2_000
+PASSWORD = "a long password"
+
+
+async def request(method: str, path: str, headers: list, body: bytes = b"") -> bytes:
+    scope = {
+        "type": "http", "http_version": "1.1", "method": method, "scheme": "http", "path": path,
+        "raw_path": path.encode(), "root_path": "", "query_string": b"", "server": ("bench", 80),
+        "client": ("bench", 1), "headers": [(b"host", b"bench")] + headers,
+    }
+    status, chunks = None, []
+
+    async def receive():
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    async def send(message):
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+        elif message["type"] == "http.response.body":
+            chunks.append(message.get("body", b""))
+
+    await app(scope, receive, send)
+    assert status == 200, (status, b"".join(chunks))
+    return b"".join(chunks)
+
+
+async def login(user_id: str) -> str:
+    body = urlencode({"user_id": user_id, "password": PASSWORD}).encode()
+    response = await request("POST", "/auth", [(b"content-type", b"application/x-www-form-urlencoded")], body)
+    return response.split(b'"token":"')[1].split(b'"')[0].decode()
+
+
+async def run(users: int):
+    password_hash = hash_password(PASSWORD, LOGIN_ITERATIONS)
+
+    # Each user has its own id and hash objects, as when they are registered or restored
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    registry = UserRegistry()
+    for i in range(users):
+        registry.put(f"user-{i}", password_hash[:1] + password_hash[1:])
+    registry_bytes = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    db["users"].registry = registry
+    user_ids = [user_id for user_id, _ in registry.items()]
+
+    sample = random.Random(users).choices(user_ids, k=REQUESTS)
+    start = time.perf_counter()
+    tokens = [await login(user_id) for user_id in sample]
+    login_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for token in tokens:
+        await request("GET", "/me", [(b"authorization", f"Bearer {token}".encode())])
+    me_time = time.perf_counter() - start
+
+    print(f"{users:>10} {registry_bytes / users:>12.0f} {login_time / REQUESTS * 1e6:>12.1f} "
+          f"{me_time / REQUESTS * 1e6:>12.1f} {db['users'].stats()['loaded']:>8}")
+
+
+def main():
+    users = [int(arg) for arg in sys.argv[1:]] or USERS
+    settings.ACCESS_TOKEN_EXPIRE_QUOTA = 1
+    print(f"{'users':>10} {'bytes/user':>12} {'login (us)':>12} {'GET /me (us)':>12} {'loaded':>8}")
+    loop = asyncio.new_event_loop()
+    for count in users:
+        loop.run_until_complete(run(count))
+
+
+if __name__ == "__main__":
+    main()